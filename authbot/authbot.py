@@ -19,10 +19,8 @@
 #
 
 import base64
-from functools import wraps
 import gevent
 import gevent.subprocess as sp
-import inspect
 import itertools
 import json
 import logging
@@ -30,6 +28,7 @@ import time
 import urllib.request as urlreq
 
 from common.datatypes import *
+from common.dispatchtable import build_dispatch_table
 from common.errors import FatalError
 from common.connectionhandler import PeerConnectedMessage, PeerDisconnectedMessage
 from common.loginprotocol import LoginProtocolMessage
@@ -51,12 +50,7 @@ def handles(packet):
 
     def real_decorator(func):
         func.handles_packet = packet
-
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrapper
+        return func
 
     return real_decorator
 
@@ -178,18 +172,12 @@ class AuthBot:
         requests = ' '.join(['%04X' % req.ident for req in msg.requests])
 
         for request in msg.requests:
-            methods = [
-                func for name, func in inspect.getmembers(self) if
-                getattr(func, 'handles_packet', None) == type(request)
-            ]
-            if not methods:
+            handler = self.request_handlers.get(type(request))
+            if handler is None:
                 self.logger.warning("No handler found for request %s" % request)
                 return
 
-            if len(methods) > 1:
-                raise ValueError("Duplicate handlers found for request")
-
-            methods[0](request)
+            handler(self, request)
 
     @handles(packet=a01bc)
     def handle_a01bc(self, request):
@@ -287,6 +275,10 @@ class AuthBot:
         else:
             return 'Hi %s. Valid commands are "authcode" or "status".' % sender_name
 
+
+AuthBot.request_handlers = build_dispatch_table(AuthBot, 'handles_packet')
+
+
 def handle_authbot(config, incoming_queue):
     authbot = AuthBot(config, incoming_queue)
     # launcher.trace_as('authbot')
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import collections
+import logging
+
+from common.connectionhandler import *
+from common.errors import PortInUseError
+
+
+class AsyncioQueue(asyncio.Queue):
+    """
+    asyncio.Queue that code which is shared with the gevent backend can put
+    messages in the same way as in a gevent queue
+    """
+    def put(self, item):
+        self.put_nowait(item)
+
+
+class AsyncioOutgoingQueue(OutgoingQueueBase):
+    """
+    Queue of messages waiting to be sent to a peer on an asyncio event loop.
+
+    Messages are taken out by the connection soon after they are queued,
+    so they only pile up while the transport does not accept more data.
+    """
+    def __init__(self, limits, on_overflow):
+        super().__init__(limits, on_overflow)
+        self.items = collections.deque()
+
+    def queued_items(self):
+        return self.items
+
+    def put(self, item):
+        if not self.accept(item):
+            return
+        self.items.append(item)
+        self.added(item)
+        if self.on_put is not None:
+            self.on_put()
+
+    def get(self):
+        # Only called when the queue is not empty, so this never has to wait
+        item = self.items.popleft()
+        self.removed(item)
+        return item
+
+    def get_nowait(self):
+        return self.get()
+
+    def empty(self):
+        return not self.items
+
+
+class _TransportSocket:
+    """
+    Stand-in for a socket that lets the readers and writers of the connection
+    handler work on top of an asyncio transport. Receiving only returns data
+    that has already arrived and raises BlockingIOError if there is none.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.received = bytearray()
+
+    def recv_into(self, buffer):
+        if not self.received:
+            raise BlockingIOError()
+        size = min(len(buffer), len(self.received))
+        buffer[:size] = self.received[:size]
+        del self.received[:size]
+        return size
+
+    def sendmsg(self, buffers):
+        if self.transport.is_closing():
+            raise ConnectionAbortedError()
+        self.transport.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    def sendall(self, data):
+        if self.transport.is_closing():
+            raise ConnectionAbortedError()
+        self.transport.write(data)
+
+    def setsockopt(self, *args):
+        sock = self.transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(*args)
+
+    def close(self):
+        self.transport.close()
+
+
+class _AsyncioConnection(asyncio.Protocol):
+    def __init__(self, handler):
+        self.logger = logging.getLogger(__name__)
+        self.handler = handler
+        self.task_id = id(self)
+        self.socket = None
+        self.reader = None
+        self.writer = None
+        self.peer = None
+        self.write_scheduled = False
+        self.writing_paused = False
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        handler = self.handler
+        self.logger.info('%s(%s): connected' % (handler.task_name, self.task_id))
+
+        self.socket = _TransportSocket(transport)
+        reader, writer, peer = handler.create_connection_instances(self.socket, transport.get_extra_info('peername'))
+        handler.check_connection_instances(reader, writer, peer)
+
+        outgoing_queue = AsyncioOutgoingQueue(peer.outgoing_queue_limits or OutgoingQueueLimits(), self._on_overflow)
+        outgoing_queue.on_put = self._schedule_write
+
+        for instance in (reader, writer, peer):
+            instance.task_id = self.task_id
+            instance.task_name = handler.task_name
+        peer.outgoing_queue = outgoing_queue
+        reader.incoming_queue = handler.incoming_queue
+        reader.peer = peer
+        writer.outgoing_queue = outgoing_queue
+
+        self.reader, self.writer, self.peer = reader, writer, peer
+        handler.incoming_queue.put(PeerConnectedMessage(peer))
+
+    def data_received(self, data):
+        self.socket.received += data
+        try:
+            while True:
+                msg = self.reader.decode(self.reader.receive())
+                msg.peer = self.peer
+                self.handler.incoming_queue.put(msg)
+        except BlockingIOError:
+            # Wait for the rest of the message to arrive
+            pass
+        except Exception:
+            self.logger.exception('%s(%s): failed to read a message; disconnecting' %
+                                  (self.handler.task_name, self.task_id))
+            self.socket.transport.abort()
+
+    def connection_lost(self, exc):
+        self.logger.info('%s(%s): disconnected' % (self.handler.task_name, self.task_id))
+        self.handler.incoming_queue.put(PeerDisconnectedMessage(self.peer))
+        self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self._schedule_write()
+
+    def _schedule_write(self):
+        # Everything that is queued before the event loop gets around to
+        # writing is sent in one go
+        if not self.write_scheduled:
+            self.write_scheduled = True
+            asyncio.get_running_loop().call_soon(self._write)
+
+    def _write(self):
+        self.write_scheduled = False
+        try:
+            while not self.writing_paused and not self.writer.outgoing_queue.empty():
+                if not self.writer.write_queued_messages():
+                    break
+        except Exception:
+            self.logger.exception('%s(%s) terminated with an exception' % (self.handler.task_name, self.task_id))
+            self.socket.transport.abort()
+
+    def _on_overflow(self):
+        self.logger.warning('%s(%s): peer is not receiving its messages fast enough; disconnecting' %
+                            (self.handler.task_name, self.task_id))
+        self.socket.transport.abort()
+
+
+class AsyncioIncomingConnectionHandler:
+    """
+    Runs the connections of an IncomingConnectionHandler on an asyncio event
+    loop instead of in greenlets. The handler is still responsible for
+    creating the reader, writer and peer of each connection.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def run(self):
+        handler = self.handler
+        try:
+            server = await asyncio.get_running_loop().create_server(lambda: _AsyncioConnection(handler),
+                                                                    handler.address, handler.port)
+        except OSError as e:
+            if e.errno == 10048:
+                raise PortInUseError('tcp', handler.address, handler.port)
+            else:
+                raise
+
+        async with server:
+            await server.serve_forever()
+
+
+class AsyncioOutgoingConnectionHandler:
+    """
+    Runs the connection of an OutgoingConnectionHandler on an asyncio event
+    loop instead of in greenlets.
+    """
+    def __init__(self, handler):
+        self.logger = logging.getLogger(__name__)
+        self.handler = handler
+
+    async def run(self, retry_time = None):
+        handler = self.handler
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                _, connection = await loop.create_connection(lambda: _AsyncioConnection(handler),
+                                                             str(handler.address), handler.port)
+                await connection.closed
+                break
+            except (ConnectionRefusedError, TimeoutError) as e:
+                if retry_time is not None:
+                    if isinstance(e, ConnectionRefusedError):
+                        reason = 'remote end is refusing connections'
+                    else:
+                        reason = 'connection timed out'
+                    self.logger.info('%s: %s. Reconnecting in %d seconds...' %
+                                     (handler.task_name, reason, retry_time))
+                    await asyncio.sleep(retry_time)
+                else:
+                    break
@@ -18,6 +18,7 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import gevent.hub
 import gevent.server
 import gevent.queue
 from gevent import socket
@@ -59,13 +60,17 @@ class ConnectionReader:
                 msg.peer = self.peer
                 self.incoming_queue.put(msg)
 
-        except (ConnectionResetError, ConnectionAbortedError, gevent._socketcommon.cancel_wait_ex):
+        except (ConnectionResetError, ConnectionAbortedError, socket.cancel_wait_ex):
             self.logger.info('%s(%s): disconnected' % (self.task_name, self.task_id))
 
         finally:
             self.incoming_queue.put(PeerDisconnectedMessage(self.peer))
             self.logger.info('%s(%s): signalled launcher; reader exiting' % (self.task_name, self.task_id))
 
+    def replace_socket(self, sock):
+        """ Make the reader receive from sock instead of the socket it was created with """
+        self.sock = sock
+
     def decode(self, msg_bytes):
         """ Decode a message from a series of bytes """
         raise NotImplementedError('decode must be implemented in a subclass of ConnectionWriter')
@@ -80,6 +85,10 @@ class TcpMessageConnectionReader(ConnectionReader):
         super().__init__(sock)
         self.tcp_reader = TcpMessageReader(sock, max_message_size = max_message_size, dump_queue = dump_queue)
 
+    def replace_socket(self, sock):
+        super().replace_socket(sock)
+        self.tcp_reader.socket = sock
+
     def receive(self):
         return self.tcp_reader.receive()
 
@@ -94,25 +103,43 @@ class ConnectionWriter:
 
     def run(self):
         gevent.getcurrent().name = self.task_name
-        while True:
-            msg = self.outgoing_queue.get()
-            if not isinstance(msg, PeerDisconnectedMessage):
-                try:
-                    msg_bytes = self.encode(msg)
-                    self.send(msg_bytes)
-                except (ConnectionResetError, ConnectionAbortedError):
-                    # Ignore a closed connection here. The reader will notice
-                    # it and send us the DisconnectedMessage to tell us that
-                    # we can close the socket and terminate
-                    pass
-            else:
-                self.sock.close()
-                if msg.exception:
-                    raise msg.exception
-                else:
-                    break
-
-        self.logger.info('%s(%s): writer exiting gracefully' % (self.task_name, self.task_id))
+        while self.write_queued_messages():
+            pass
+
+    def write_queued_messages(self):
+        """
+        Wait for messages in the outgoing queue and send them
+
+        Returns False once the peer has been disconnected.
+        """
+        # Take everything that is queued up to the next disconnect, so
+        # that it can be sent in one go
+        msgs = [self.outgoing_queue.get()]
+        while not isinstance(msgs[-1], PeerDisconnectedMessage) and not self.outgoing_queue.empty():
+            msgs.append(self.outgoing_queue.get_nowait())
+
+        disconnect_msg = msgs.pop() if isinstance(msgs[-1], PeerDisconnectedMessage) else None
+
+        if msgs:
+            try:
+                self.send_many([self.encode(msg) for msg in msgs])
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
+                    socket.cancel_wait_ex):
+                # Ignore a closed connection here. The reader will notice
+                # it and send us the DisconnectedMessage to tell us that
+                # we can close the socket and terminate
+                pass
+
+        if disconnect_msg:
+            self.sock.close()
+            if disconnect_msg.exception:
+                raise disconnect_msg.exception
+
+            self.logger.info('%s(%s): writer exiting gracefully%s' %
+                             (self.task_name, self.task_id, self.get_statistics()))
+            return False
+
+        return True
 
     def encode(self, msg):
         """ Encode msg into a series of bytes """
@@ -122,17 +149,279 @@ class ConnectionWriter:
         """ Send the bytes that make up a message out over the socket """
         raise NotImplementedError('send must be implemented in a subclass of ConnectionWriter')
 
+    def send_many(self, msg_bytes_list):
+        """ Send the bytes of several messages out over the socket """
+        for msg_bytes in msg_bytes_list:
+            self.send(msg_bytes)
+
+    def get_statistics(self):
+        """ Return a description of how the messages were sent, to be appended to a log message """
+        return ''
+
 
 class TcpMessageConnectionWriter(ConnectionWriter):
-    def __init__(self, sock, max_message_size = 0xFFFF, dump_queue = None):
+    def __init__(self, sock, max_message_size = 0xFFFF, dump_queue = None, nodelay = False):
         super().__init__(sock)
-        self.tcp_writer = TcpMessageWriter(sock, max_message_size = max_message_size, dump_queue = dump_queue)
+        self.tcp_writer = TcpMessageWriter(sock, max_message_size = max_message_size, dump_queue = dump_queue,
+                                           nodelay = nodelay)
 
     def send(self, msg_bytes):
         return self.tcp_writer.send(msg_bytes)
 
+    def send_many(self, msg_bytes_list):
+        return self.tcp_writer.send_many(msg_bytes_list)
+
+    def get_statistics(self):
+        tcp_writer = self.tcp_writer
+        if tcp_writer.send_count == 0:
+            return ''
+        return ' (sent %d messages in %d sends, %.1f messages per send on average, at most %d)' % \
+               (tcp_writer.message_count, tcp_writer.send_count,
+                tcp_writer.message_count / tcp_writer.send_count, tcp_writer.max_messages_per_send)
+
+
+class _SingleGreenletSocket:
+    """
+    Stand-in for the socket of a ConnectionReader that lets the greenlet of
+    the reader do the work of the writer as well. Whenever the reader waits
+    for incoming data, the messages that are queued for the peer are sent.
+
+    While a send is waiting for the peer to accept more data, nothing is
+    received from that peer.
+    """
+    def __init__(self, sock, writer):
+        self.sock = sock
+        self.writer = writer
+        self.closed = False
+        self.hub = gevent.get_hub()
+        self.read_watcher = self.hub.loop.io(sock.fileno(), 1)
+        self.may_be_readable = True
+        self.waiter = None
+
+    def recv_into(self, buffer):
+        while True:
+            if self.closed:
+                raise ConnectionAbortedError()
+
+            if not self.writer.outgoing_queue.empty():
+                if not self.writer.write_queued_messages():
+                    self.closed = True
+                continue
+
+            # Only wait if nothing can be received right away. Sends happen
+            # in this greenlet as well, so the timeout of the socket can
+            # briefly be changed to make the receive non-blocking.
+            if self.may_be_readable:
+                timeout = self.sock.gettimeout()
+                self.sock.settimeout(0.0)
+                try:
+                    return self.sock.recv_into(buffer)
+                except BlockingIOError:
+                    self.may_be_readable = False
+                finally:
+                    self.sock.settimeout(timeout)
+
+            # The watcher is only started while waiting, because it keeps
+            # firing for as long as there is unread data
+            self.waiter = gevent.hub.Waiter(self.hub)
+            self.read_watcher.start(self._set_readable)
+            try:
+                self.waiter.get()
+            finally:
+                self.read_watcher.stop()
+                self.waiter = None
+
+    def _set_readable(self):
+        self.may_be_readable = True
+        self.wake_up()
+
+    def wake_up(self):
+        """ Stop waiting for incoming data; must be called from the hub """
+        if self.waiter is not None:
+            waiter, self.waiter = self.waiter, None
+            waiter.switch(None)
+
+    def notify(self):
+        """ Signal that there are messages in the outgoing queue """
+        if self.waiter is not None:
+            self.hub.loop.run_callback(self.wake_up)
+
+    def close(self):
+        self.read_watcher.stop()
+        self.closed = True
+        self.sock.close()
+        self.notify()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+# What to do when an outgoing queue is full
+OVERFLOW_POLICY_DROP = 'drop'
+OVERFLOW_POLICY_DISCONNECT = 'disconnect'
+
+
+def _default_message_size(msg):
+    # Only messages that are already serialized have a size that is known
+    # without encoding them, everything else is counted as zero bytes
+    if isinstance(msg, tuple):
+        msg = msg[0]
+    if isinstance(msg, (bytes, bytearray)):
+        return len(msg)
+    data = getattr(msg, 'data', None)
+    return len(data) if isinstance(data, (bytes, bytearray)) else 0
+
+
+class OutgoingQueueLimits:
+    """
+    Limits on the messages waiting in the outgoing queue of a peer.
+
+    When a message is queued that would exceed max_messages or max_bytes,
+    the OVERFLOW_POLICY_DROP policy makes room by dropping the oldest
+    queued messages for which is_droppable returns True. If that is not
+    enough, or with the OVERFLOW_POLICY_DISCONNECT policy, the peer is
+    disconnected. A limit of None means no limit.
+    """
+    def __init__(self, max_messages=None, max_bytes=None, policy=OVERFLOW_POLICY_DISCONNECT,
+                 is_droppable=lambda msg: False, message_size=_default_message_size):
+        if policy not in (OVERFLOW_POLICY_DROP, OVERFLOW_POLICY_DISCONNECT):
+            raise ValueError('Invalid outgoing queue overflow policy: %s' % policy)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.is_droppable = is_droppable
+        self.message_size = message_size
+
+
+class OutgoingQueueStatistics:
+    def __init__(self):
+        self.peak_messages = 0
+        self.peak_bytes = 0
+        self.dropped_messages = 0
+        self.backpressure_disconnects = 0
+
+    def to_dict(self):
+        return {
+            'peak_messages': self.peak_messages,
+            'peak_bytes': self.peak_bytes,
+            'dropped_messages': self.dropped_messages,
+            'backpressure_disconnects': self.backpressure_disconnects
+        }
+
+
+# Statistics combined over the outgoing queues of all peers
+outgoing_queue_statistics = OutgoingQueueStatistics()
+
+
+class OutgoingQueueBase:
+    """
+    Enforcement of the OutgoingQueueLimits of a peer, so that a peer that
+    stops reading cannot make messages pile up in memory without limit.
+
+    This is shared by the outgoing queues of the gevent and asyncio backends.
+    Subclasses keep the queued messages in the deque that queued_items
+    returns. They call accept before a message is queued and added and
+    removed after a message was added to or removed from the deque.
+
+    on_overflow is called when the peer has to be disconnected. From then
+    on all messages except PeerDisconnectedMessages are discarded. If
+    on_put is set, it is called after a message has been queued.
+    """
+    def __init__(self, limits, on_overflow):
+        self.limits = limits
+        self.on_overflow = on_overflow
+        self.on_put = None
+        self.queued_bytes = 0
+        self.overflowed = False
+        self.statistics = OutgoingQueueStatistics()
+
+    def queued_items(self):
+        raise NotImplementedError('queued_items must be implemented in a subclass of OutgoingQueueBase')
+
+    def accept(self, item):
+        """ Make room for item if needed and return whether it should be queued """
+        if isinstance(item, PeerDisconnectedMessage):
+            return True
+        return not self.overflowed and self._make_room(self.limits.message_size(item))
+
+    def added(self, item):
+        if not isinstance(item, PeerDisconnectedMessage):
+            self.queued_bytes += self.limits.message_size(item)
+
+        statistics = self.statistics
+        statistics.peak_messages = max(statistics.peak_messages, len(self.queued_items()))
+        statistics.peak_bytes = max(statistics.peak_bytes, self.queued_bytes)
+        outgoing_queue_statistics.peak_messages = max(outgoing_queue_statistics.peak_messages,
+                                                      statistics.peak_messages)
+        outgoing_queue_statistics.peak_bytes = max(outgoing_queue_statistics.peak_bytes, statistics.peak_bytes)
+
+    def removed(self, item):
+        if not isinstance(item, PeerDisconnectedMessage):
+            self.queued_bytes -= self.limits.message_size(item)
+
+    def _exceeds_limits(self, extra_size):
+        limits = self.limits
+        return (limits.max_messages is not None and len(self.queued_items()) + 1 > limits.max_messages) or \
+               (limits.max_bytes is not None and self.queued_bytes + extra_size > limits.max_bytes)
+
+    def _drop_oldest_droppable(self):
+        items = self.queued_items()
+        for index, item in enumerate(items):
+            if not isinstance(item, PeerDisconnectedMessage) and self.limits.is_droppable(item):
+                del items[index]
+                self.removed(item)
+                self.statistics.dropped_messages += 1
+                outgoing_queue_statistics.dropped_messages += 1
+                return True
+        return False
+
+    def _make_room(self, size):
+        while self._exceeds_limits(size):
+            if self.limits.policy == OVERFLOW_POLICY_DROP and self._drop_oldest_droppable():
+                continue
+
+            # Nothing more can be dropped, so the messages that are still
+            # queued will never be delivered and the peer has to go
+            self.overflowed = True
+            self.queued_items().clear()
+            self.queued_bytes = 0
+            self.statistics.backpressure_disconnects += 1
+            outgoing_queue_statistics.backpressure_disconnects += 1
+            self.on_overflow()
+            return False
+        return True
+
+
+class OutgoingQueue(OutgoingQueueBase, gevent.queue.Queue):
+    """ A gevent queue of messages waiting to be sent to a peer that enforces the limits of that peer """
+    def __init__(self, limits, on_overflow):
+        gevent.queue.Queue.__init__(self)
+        OutgoingQueueBase.__init__(self, limits, on_overflow)
+
+    def queued_items(self):
+        return self.queue
+
+    def put(self, item, block=True, timeout=None):
+        if not self.accept(item):
+            return
+        super().put(item, block, timeout)
+        if self.on_put is not None:
+            self.on_put()
+
+    def _put(self, item):
+        super()._put(item)
+        self.added(item)
+
+    def _get(self):
+        item = super()._get()
+        self.removed(item)
+        return item
+
 
 class Peer:
+    # Limits on the outgoing queue for this type of peer, None for no limits
+    outgoing_queue_limits = None
+
     def __init__(self):
         self.task_name = None
         self.task_id = None
@@ -146,13 +435,16 @@ class Peer:
 
 
 class ConnectionHandler:
-    def __init__(self, task_name, address, port, incoming_queue):
+    def __init__(self, task_name, address, port, incoming_queue, single_greenlet = False):
         self.logger = logging.getLogger(__name__)
         gevent.getcurrent().name = task_name
         self.task_name = task_name
         self.address = address
         self.port = port
         self.incoming_queue = incoming_queue
+        # Whether to read and write in the greenlet of the connection instead
+        # of spawning a reader and a writer greenlet for every connection
+        self.single_greenlet = single_greenlet
 
     def run(self):
         raise NotImplementedError('ConnectionHandler should not be used directly. '
@@ -161,13 +453,7 @@ class ConnectionHandler:
     def create_connection_instances(self, sock, address):
         raise NotImplementedError('create_connection_instances must be implemented in a subclass of IncomingConnectionHandler')
 
-    def _handle(self, sock, address):
-        gevent.getcurrent().name = self.task_name
-        task_id = id(gevent.getcurrent())
-        self.logger.info('%s(%s): connected' % (self.task_name, task_id))
-
-        reader, writer, peer = self.create_connection_instances(sock, address)
-
+    def check_connection_instances(self, reader, writer, peer):
         if not isinstance(peer, Peer) or \
            not isinstance(reader, ConnectionReader) or \
            not isinstance(writer, ConnectionWriter):
@@ -181,7 +467,32 @@ class ConnectionHandler:
                             'and the type is the only way to distinguish between messages from '
                             'different ConnectionHandlers.')
 
-        outgoing_queue = gevent.queue.Queue()
+    def _handle(self, sock, address):
+        gevent.getcurrent().name = self.task_name
+        task_id = id(gevent.getcurrent())
+        self.logger.info('%s(%s): connected' % (self.task_name, task_id))
+
+        reader, writer, peer = self.create_connection_instances(sock, address)
+        self.check_connection_instances(reader, writer, peer)
+
+        connection_socket = sock
+        if self.single_greenlet:
+            connection_socket = _SingleGreenletSocket(sock, writer)
+            reader.replace_socket(connection_socket)
+
+        def on_overflow():
+            self.logger.warning('%s(%s): peer is not receiving its messages fast enough; disconnecting' %
+                                (self.task_name, task_id))
+            # Closing the socket wakes up a writer that is waiting for a send to
+            # complete and makes the reader signal that the peer disconnected
+            connection_socket.close()
+
+        if peer.outgoing_queue_limits is None and not self.single_greenlet:
+            outgoing_queue = gevent.queue.Queue()
+        else:
+            outgoing_queue = OutgoingQueue(peer.outgoing_queue_limits or OutgoingQueueLimits(), on_overflow)
+            if self.single_greenlet:
+                outgoing_queue.on_put = connection_socket.notify
 
         peer.task_id = task_id
         peer.task_name = self.task_name
@@ -196,12 +507,20 @@ class ConnectionHandler:
         writer.task_name = self.task_name
         writer.outgoing_queue = outgoing_queue
 
-        tasks = [
-            gevent_spawn("%s(%s)'s reader" % (self.task_name, task_id), reader.run),
-            gevent_spawn("%s(%s)'s writer" % (self.task_name, task_id), writer.run)
-        ]
-
-        gevent.joinall(tasks)
+        if self.single_greenlet:
+            try:
+                reader.run()
+            finally:
+                # Without a writer greenlet there is nobody left to close the socket
+                connection_socket.close()
+                connection_socket.read_watcher.close()
+        else:
+            tasks = [
+                gevent_spawn("%s(%s)'s reader" % (self.task_name, task_id), reader.run),
+                gevent_spawn("%s(%s)'s writer" % (self.task_name, task_id), writer.run)
+            ]
+
+            gevent.joinall(tasks)
 
 
     def _handle_and_catch(self, sock, address):
@@ -21,6 +21,9 @@
 from common.game_items import GamePurchase, GameClass, UnlockableGameClass, \
     UnlockableClassSpecificItem, UnlockableWeapon, UnlockableVoice
 from typing import Set, Iterable
+import copy
+import io
+import mmap
 import struct
 from ipaddress import IPv4Address
 
@@ -191,13 +194,155 @@ def hexparse(hexstring):
     return bytes([int('0x' + hexbyte, base=16) for hexbyte in hexstring.split()])
 
 
+ORIGINAL_CAPTURE_PATH = 'data/tribescapture.bin.stripped'
+
+_original_capture = None
+_original_ranges = set()
+
+
+def original_range(start, end):
+    """
+    Declare a range of the original capture that is replayed to clients
+
+    Ranges should be declared at import time, so that load_original_capture
+    can check all of them against the capture file when the server starts.
+
+    :param start: offset of the first byte of the range
+    :param end: offset just past the last byte of the range
+    :return: the range as a (start, end) tuple
+    """
+    _original_ranges.add((start, end))
+    return start, end
+
+
+def load_original_capture(path=ORIGINAL_CAPTURE_PATH):
+    """
+    Map the original capture into memory and check all declared ranges against it
+
+    This only needs to happen once. Fragments of the capture are handed out as
+    memoryview slices of the mapping, so replaying them does not involve any
+    file access or copying until they are written to an output stream.
+
+    :param path: path of the capture file
+    :raises ValueError: if any declared range does not lie within the capture
+    """
+    global _original_capture
+
+    with open(path, 'rb') as f:
+        capture = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    out_of_bounds = sorted((start, end) for start, end in _original_ranges
+                           if not 0 <= start <= end <= len(capture))
+    if out_of_bounds:
+        raise ValueError('The following ranges do not lie within the %d bytes of %s: %s' %
+                         (len(capture), path, ', '.join('0x%X-0x%X' % r for r in out_of_bounds)))
+
+    _original_capture = capture
+
+
 def _originalbytes(start, end):
-    with open('data/tribescapture.bin.stripped', 'rb') as f:
-        f.seek(start)
-        return f.read(end - start)
+    if _original_capture is None:
+        load_original_capture()
+    return _original_capture[start:end]
+
+
+class fieldlist(list):
+    """
+    A list of fields that keeps track of the first field of each type and
+    ident in it, so that findbytype and get don't have to search the list.
+
+    The index is built on the first lookup. Appending fields updates it and
+    any other modification of the list causes it to be rebuilt on the next
+    lookup.
+    """
+    # Class attributes, so that creating a list doesn't need to run any Python code
+    _fields_by_type = None
+    _fields_by_ident = None
+
+    def findbytype(self, requestedtype):
+        if self._fields_by_type is None:
+            self._build_index()
+        return self._fields_by_type.get(requestedtype)
+
+    def get(self, ident):
+        if self._fields_by_ident is None:
+            self._build_index()
+        return self._fields_by_ident.get(ident)
+
+    def _build_index(self):
+        self._fields_by_type = {}
+        self._fields_by_ident = {}
+        for field in self:
+            self._add_to_index(field)
+
+    def _add_to_index(self, field):
+        self._fields_by_type.setdefault(type(field), field)
+        ident = getattr(field, 'ident', None)
+        if ident is not None:
+            self._fields_by_ident.setdefault(ident, field)
+
+    def _invalidate_index(self):
+        self._fields_by_type = None
+        self._fields_by_ident = None
+
+    def append(self, field):
+        super().append(field)
+        if self._fields_by_type is not None:
+            self._add_to_index(field)
+
+    def extend(self, fields):
+        fields = list(fields)
+        super().extend(fields)
+        if self._fields_by_type is not None:
+            for field in fields:
+                self._add_to_index(field)
+
+    def __iadd__(self, fields):
+        self.extend(fields)
+        return self
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._invalidate_index()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._invalidate_index()
+
+    def __imul__(self, count):
+        result = super().__imul__(count)
+        self._invalidate_index()
+        return result
+
+    def insert(self, index, field):
+        super().insert(index, field)
+        self._invalidate_index()
+
+    def remove(self, field):
+        super().remove(field)
+        self._invalidate_index()
+
+    def pop(self, *args):
+        field = super().pop(*args)
+        self._invalidate_index()
+        return field
+
+    def clear(self):
+        super().clear()
+        self._invalidate_index()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._invalidate_index()
+
+    def reverse(self):
+        super().reverse()
+        self._invalidate_index()
 
 
 def findbytype(arr, requestedtype):
+    if isinstance(arr, fieldlist):
+        return arr.findbytype(requestedtype)
     for item in arr:
         if type(item) == requestedtype:
             return item
@@ -208,7 +353,21 @@ def findbytype(arr, requestedtype):
 # base types
 # ------------------------------------------------------------
 
-class onebyte():
+class _fieldtype(type):
+    """
+    Metaclass of the base types below. Messages consist of hundreds of field
+    objects, so these don't get a __dict__. The base types list their
+    members in __slots__ and every class derived from them that doesn't
+    define __slots__ itself gets an empty one.
+    """
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class onebyte(metaclass=_fieldtype):
+    __slots__ = ('ident', 'value')
+
     def __init__(self, ident, value):
         self.ident = ident
         self.value = value
@@ -228,7 +387,9 @@ class onebyte():
         return self
 
 
-class twobytes():
+class twobytes(metaclass=_fieldtype):
+    __slots__ = ('ident', 'value')
+
     def __init__(self, ident, value):
         self.ident = ident
         self.value = value
@@ -244,7 +405,9 @@ class twobytes():
         return self
 
 
-class fourbytes():
+class fourbytes(metaclass=_fieldtype):
+    __slots__ = ('ident', 'value')
+
     def __init__(self, ident, value):
         self.ident = ident
         self.value = value
@@ -265,7 +428,9 @@ class fourbytes():
         return self
 
 
-class nbytes():
+class nbytes(metaclass=_fieldtype):
+    __slots__ = ('ident', 'value')
+
     def __init__(self, ident, valuebytes):
         self.ident = ident
         self.value = valuebytes
@@ -286,7 +451,9 @@ class nbytes():
         return self
 
 
-class stringenum():
+class stringenum(metaclass=_fieldtype):
+    __slots__ = ('ident', 'value')
+
     def __init__(self, ident, value):
         self.ident = ident
         self.value = value
@@ -308,25 +475,41 @@ class stringenum():
         return self
 
 
-class arrayofenumblockarrays():
+class arrayofenumblockarrays(metaclass=_fieldtype):
+    __slots__ = ('ident', '_arrays', 'original_bytes', 'received_bytes')
+
     def __init__(self, ident):
         self.ident = ident
         self.arrays = []
         self.original_bytes = None
 
+    @property
+    def arrays(self):
+        # Arrays of lazily decoded messages are only parsed once they are accessed
+        if self.received_bytes is not None:
+            self.read(_BufferReader(self.received_bytes))
+        return self._arrays
+
+    @arrays.setter
+    def arrays(self, arrays):
+        self.received_bytes = None
+        self._arrays = arrays
+
     def set(self, arrays):
         self.original_bytes = None
         self.arrays = arrays
         return self
 
     def set_original_bytes(self, start, end):
-        self.original_bytes = (start, end)
+        self.original_bytes = original_range(start, end)
         self.arrays = None
         return self
 
     def write(self, stream):
         if self.original_bytes:
             stream.write(_originalbytes(*self.original_bytes))
+        elif self.received_bytes is not None:
+            stream.write(self.received_bytes)
         else:
             stream.write(struct.pack('<HH', self.ident, len(self.arrays)))
             for arr in self.arrays:
@@ -340,32 +523,69 @@ class arrayofenumblockarrays():
             raise ParseError('self.ident(%02X) did not match parsed ident value (%02X)' % (self.ident, ident))
         self.arrays = []
         for _ in range(length1):
-            innerarray = []
             length2 = struct.unpack('<H', stream.read(2))[0]
-            for _ in range(length2):
-                enumid = struct.unpack('<H', stream.peek(2))[0]
-                classname = ('m%04X' % enumid).lower()
-                element = globals()[classname]().read(stream)
-                innerarray.append(element)
-            self.arrays.append(innerarray)
+            self.arrays.append(fieldlist([_decode_enumfield(stream) for _ in range(length2)]))
         return self
 
 
-class enumblockarray():
+class enumblockarray(metaclass=_fieldtype):
+    __slots__ = ('ident', '_content', 'received_bytes', 'received_state')
+
     def __init__(self, ident):
         self.ident = ident
         self.content = []
 
+    @property
+    def content(self):
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        # Content that is replaced is no longer what was received
+        self.received_bytes = None
+        self._content = content if type(content) is fieldlist else fieldlist(content)
+
     def findbytype(self, requestedtype):
-        for item in self.content:
-            if type(item) == requestedtype:
-                return item
-        return None
+        return self._content.findbytype(requestedtype)
+
+    def get(self, ident):
+        return self._content.get(ident)
 
     def set(self, content):
         self.content = content
         return self
 
+    def relay(self, *appended_fields):
+        """
+        Serialize this message with the given fields appended to its content
+
+        If the message was decoded lazily and its content has not been
+        modified since, the bytes it was received as are reused instead of
+        encoding its content again.
+
+        :return: an encodedmessage that can be sent like any other message
+        """
+        stream = io.BytesIO()
+        stream.write(struct.pack('<HH', self.ident, len(self.content) + len(appended_fields)))
+        if self._received_bytes_are_current():
+            stream.write(memoryview(self.received_bytes)[4:])
+        else:
+            for el in self.content:
+                el.write(stream)
+        for field in appended_fields:
+            field.write(stream)
+        return encodedmessage(stream.getvalue())
+
+    def _received_bytes_are_current(self):
+        """ Whether the content is still made up of the fields that were received, with their received values """
+        if self.received_bytes is None:
+            return False
+        content = self._content
+        received_state = self.received_state
+        return len(content) == len(received_state) and \
+            all(field is received_field and _received_field_state(field) == field_state
+                for field, (received_field, field_state) in zip(content, received_state))
+
     def write(self, stream):
         stream.write(struct.pack('<HH', self.ident, len(self.content)))
         for el in self.content:
@@ -375,16 +595,13 @@ class enumblockarray():
         ident, length = struct.unpack('<HH', stream.read(4))
         if ident != self.ident:
             raise ParseError('self.ident(%02X) did not match parsed ident value (%02X)' % (self.ident, ident))
-        self.content = []
-        for i in range(length):
-            enumid = struct.unpack('<H', stream.peek(2))[0]
-            classname = ('m%04X' % enumid).lower()
-            element = globals()[classname]().read(stream)
-            self.content.append(element)
+        self.content = fieldlist([_decode_enumfield(stream) for _ in range(length)])
         return self
 
 
-class variablelengthbytes():
+class variablelengthbytes(metaclass=_fieldtype):
+    __slots__ = ('ident', 'content')
+
     def __init__(self, ident, content):
         self.ident = ident
         self.content = content
@@ -2615,8 +2832,54 @@ class m0662(arrayofenumblockarrays):
         self.arrays.extend(self.physics_presets)
         return self
 
+    def set_loadouts(self, loadouts):
+        loadout_arrays = []
+        loadout_overall_idx = 0
+        for class_id, class_loadout in loadouts.get_data().items():
+            for loadout_index, loadout in class_loadout.items():
+                loadout_id = loadouts.loadout_key2id[(class_id, loadout_index)]
+
+                entry_array = []
+                for slot, equipment in loadout.items():
+                    if isinstance(equipment, str):
+                        equip_field = m0437().set(equipment)
+                    else:
+                        equip_field = m0261().set(str(equipment))
+                    entry_array.append([
+                        m0369().set(slot),
+                        equip_field
+                    ])
+                entry_array.append([
+                    m0369().set(0x00000442),
+                    m0261().set(str(8167))
+                ])
+                entry_array.append([
+                    m0369().set(0x00000443),
+                    m0261().set(str(8162))
+                ])
+                entry_array.append([
+                    m0369().set(0x00000447),
+                    m0261().set(str(class_id))
+                ])
+                if loadout_index:
+                    entry_array.append([
+                        m0369().set(0x0000053C),
+                        m0261().set(str(loadout_index))
+                    ])
+
+                loadout_arrays.append([
+                    m0661().set(loadout_id),
+                    m01e3().set(loadout_overall_idx),
+                    m065f().set(0x00000001),
+                    m02fe().set(""),
+                    m0144().set(entry_array)
+                ])
+                loadout_overall_idx += 1
+
+        return self.set(loadout_arrays)
+
     def setoriginalbytes(self, start, end):
-        self.original_bytes = (start, end)
+        self.original_bytes = original_range(start, end)
         return self
 
     def write(self, stream):
@@ -2769,19 +3032,27 @@ class a0035(enumblockarray):
         return self
 
     def setserverdata(self, server, player_address):
+        return self.setserverfields(server.server_id,
+                                    server.match_id,
+                                    server.address_pair.get_address_seen_from(player_address),
+                                    server.port,
+                                    server.pingport,
+                                    server.region)
+
+    def setserverfields(self, server_id, match_id, server_ip: IPv4Address, port, pingport, region):
         self.content.extend([
-            m02c7().set(server.server_id),
+            m02c7().set(server_id),
             m06ee(),
-            m02c4().set(server.match_id),
+            m02c4().set(match_id),
             m037c(),
             m0452(),
             m0225(),
             m0363(),
             m0615(),
             m06ef(),
-            m024f().set(server.address_pair.get_address_seen_from(player_address), server.port),
-            m0246().set(server.address_pair.get_address_seen_from(player_address), server.pingport),
-            m0448().set(server.region),
+            m024f().set(server_ip, port),
+            m0246().set(server_ip, pingport),
+            m0448().set(region),
             m02b5(),
             m03e0(),
             m0347().set(7),
@@ -2800,6 +3071,10 @@ class a003a(enumblockarray):
         ]
 
 
+_a003d_m0632_range = original_range(0x7371, 0x8515)
+_a003d_m0681_range = original_range(0x8822, 0x8898)
+
+
 class a003d(enumblockarray):
     def __init__(self):
         super().__init__(0x003d)
@@ -2872,8 +3147,8 @@ class a003d(enumblockarray):
             m02be().set(0x00000000),
             m0138().set(general_unlocks_arrays),
             m0662(),
-            m0632().set_original_bytes(0x7371, 0x8515),
-            m0681().set_original_bytes(0x8822, 0x8898),
+            m0632().set_original_bytes(*_a003d_m0632_range),
+            m0681().set_original_bytes(*_a003d_m0681_range),
             m00fe().set(skin_unlocks_arrays),
             m062d(),
             m008d(),
@@ -2886,7 +3161,7 @@ class a003d(enumblockarray):
             m0468(),
             m0663(),
             m068b(),
-            m0681().set_original_bytes(0x8822, 0x8898)]
+            m0681().set_original_bytes(*_a003d_m0681_range)]
 
         return self
 
@@ -2895,51 +3170,7 @@ class a003d(enumblockarray):
         self.findbytype(m034a).set(player.display_name)
         self.findbytype(m06de).set(player.player_settings.clan_tag)
         self.findbytype(m05dc).set(player.player_settings.progression.rank_xp)
-
-        loadout_arrays = []
-        loadout_overall_idx = 0
-        for class_id, class_loadout in player.get_unmodded_loadouts().get_data().items():
-            for loadout_index, loadout in class_loadout.items():
-                loadout_id = player.get_unmodded_loadouts().loadout_key2id[(class_id, loadout_index)]
-
-                entry_array = []
-                for slot, equipment in loadout.items():
-                    if isinstance(equipment, str):
-                        equip_field = m0437().set(equipment)
-                    else:
-                        equip_field = m0261().set(str(equipment))
-                    entry_array.append([
-                        m0369().set(slot),
-                        equip_field
-                    ])
-                entry_array.append([
-                    m0369().set(0x00000442),
-                    m0261().set(str(8167))
-                ])
-                entry_array.append([
-                    m0369().set(0x00000443),
-                    m0261().set(str(8162))
-                ])
-                entry_array.append([
-                    m0369().set(0x00000447),
-                    m0261().set(str(class_id))
-                ])
-                if loadout_index:
-                    entry_array.append([
-                        m0369().set(0x0000053C),
-                        m0261().set(str(loadout_index))
-                    ])
-
-                loadout_arrays.append([
-                    m0661().set(loadout_id),
-                    m01e3().set(loadout_overall_idx),
-                    m065f().set(0x00000001),
-                    m02fe().set(""),
-                    m0144().set(entry_array)
-                ])
-                loadout_overall_idx += 1
-
-        self.findbytype(m0662).set(loadout_arrays)
+        self.findbytype(m0662).set_loadouts(player.get_unmodded_loadouts())
 
         return self
 
@@ -3270,8 +3501,37 @@ class m0620(passwordlike):
         super().__init__(0x0620, b'0')
 
 
+class encodedmessage():
+    def __init__(self, data, ident=None):
+        self.data = data
+        # Ident of the (first) message that was serialized, so that it can still be told what it is
+        self.ident = ident
+
+    @classmethod
+    def frommessage(cls, message):
+        """
+        Serialize a message or a list of messages once, so that it can be sent
+        to many players. The ident of the (first) message is kept in ident.
+        """
+        if isinstance(message, cls):
+            return message
+        stream = io.BytesIO()
+        if isinstance(message, list):
+            for el in message:
+                el.write(stream)
+            first_message = message[0] if message else None
+        else:
+            message.write(stream)
+            first_message = message
+        return cls(stream.getvalue(), getattr(first_message, 'ident', None))
+
+    def write(self, stream):
+        stream.write(self.data)
+
+
 class originalfragment():
     def __init__(self, fromoffset, tooffset):
+        original_range(fromoffset, tooffset)
         self.fromoffset = fromoffset
         self.tooffset = tooffset
 
@@ -3279,12 +3539,566 @@ class originalfragment():
         stream.write(_originalbytes(self.fromoffset, self.tooffset))
 
 
+# ------------------------------------------------------------
+# schema registry
+# ------------------------------------------------------------
+
+# Decoding used to look up the class for every field by formatting its
+# ident into a class name and searching globals(), after which the generic
+# read method of the base type unpacked the field. Instead, all field
+# classes above are scanned once at import time. For each of them a schema
+# is recorded and, unless the class overrides read or write itself, read and
+# write functions are generated that have the ident and value layout of that
+# class baked into precompiled structs.
+
+_ident_struct = struct.Struct('<H')
+_short_header_struct = struct.Struct('<HH')
+_long_header_struct = struct.Struct('<HL')
+
+_scalar_value_formats = {
+    onebyte: 'B',
+    twobytes: 'H',
+    fourbytes: 'L',
+}
+
+# passwordlike must come before variablelengthbytes, because it is a subclass of it
+_field_kinds = (onebyte, twobytes, fourbytes, nbytes, stringenum, passwordlike,
+                variablelengthbytes, enumblockarray, arrayofenumblockarrays)
+
+
+class FieldSchema:
+    def __init__(self, ident, kind, width, default, cls):
+        self.ident = ident
+        self.kind = kind
+        self.width = width
+        self.default = default
+        self.cls = cls
+        self.specialized = False
+        self.decode = None
+
+
+def _ident_mismatch_error(ident_format, ident, parsed_ident):
+    return ParseError(('self.ident(%s) did not match parsed ident value (%s)' % (ident_format, ident_format)) %
+                      (ident, parsed_ident))
+
+
+def _generate_scalar_codec(ident, value_format):
+    ident_bytes = _ident_struct.pack(ident)
+    pack_value = struct.Struct('<' + value_format).pack
+    field_struct = struct.Struct('<H' + value_format)
+    unpack_field = field_struct.unpack
+    field_size = field_struct.size
+
+    def write(self, stream):
+        stream.write(ident_bytes + pack_value(self.value))
+
+    def read(self, stream):
+        parsed_ident, value = unpack_field(stream.read(field_size))
+        if parsed_ident != ident:
+            raise _ident_mismatch_error('%02X', ident, parsed_ident)
+        self.value = value
+        return self
+
+    return read, write
+
+
+def _generate_nbytes_codec(ident, width):
+    ident_bytes = _ident_struct.pack(ident)
+    unpack_ident = _ident_struct.unpack
+
+    def write(self, stream):
+        stream.write(ident_bytes + self.value)
+
+    def read(self, stream):
+        parsed_ident = unpack_ident(stream.read(2))[0]
+        if parsed_ident != ident:
+            raise _ident_mismatch_error('%02X', ident, parsed_ident)
+        self.value = stream.read(width)
+        return self
+
+    return read, write
+
+
+def _generate_stringenum_codec(ident):
+    pack_header = _short_header_struct.pack
+    unpack_header = _short_header_struct.unpack
+
+    def write(self, stream):
+        stream.write(pack_header(ident, len(self.value)) + self.value.encode('latin1'))
+
+    def read(self, stream):
+        parsed_ident, length = unpack_header(stream.read(4))
+        if parsed_ident != ident:
+            raise _ident_mismatch_error('%02X', ident, parsed_ident)
+        self.value = stream.read(length).decode('latin1')
+        return self
+
+    return read, write
+
+
+def _generate_variablelengthbytes_codec(ident):
+    pack_header = _long_header_struct.pack
+    unpack_header = _long_header_struct.unpack
+
+    def write(self, stream):
+        stream.write(pack_header(ident, len(self.content)) + self.content)
+
+    def read(self, stream):
+        parsed_ident, length = unpack_header(stream.read(6))
+        if parsed_ident != ident:
+            raise _ident_mismatch_error('%04X', ident, parsed_ident)
+        self.content = stream.read(length)
+        return self
+
+    return read, write
+
+
+def _generate_passwordlike_codec(ident):
+    pack_header = _short_header_struct.pack
+    unpack_header = _short_header_struct.unpack
+
+    def write(self, stream):
+        stream.write(pack_header(ident, len(self.content)) + self.content)
+
+    def read(self, stream):
+        parsed_ident, length = unpack_header(stream.read(4))
+        # Length is actually doubled due to server pass's interspersed bytes
+        length = (length & 0x7FFF) * 2
+        if parsed_ident != ident:
+            raise _ident_mismatch_error('%04X', ident, parsed_ident)
+        self.content = stream.read(length)
+        return self
+
+    return read, write
+
+
+def _generate_enumblockarray_codec(ident):
+    pack_header = _short_header_struct.pack
+    unpack_header = _short_header_struct.unpack
+
+    def write(self, stream):
+        stream.write(pack_header(ident, len(self.content)))
+        for el in self.content:
+            el.write(stream)
+
+    def read(self, stream):
+        parsed_ident, length = unpack_header(stream.read(4))
+        if parsed_ident != ident:
+            raise _ident_mismatch_error('%02X', ident, parsed_ident)
+        self.content = fieldlist([_decode_enumfield(stream) for _ in range(length)])
+        return self
+
+    return read, write
+
+
+def _generate_arrayofenumblockarrays_codec(ident):
+    pack_header = _short_header_struct.pack
+    unpack_header = _short_header_struct.unpack
+    pack_length = _ident_struct.pack
+    unpack_length = _ident_struct.unpack
+
+    def write(self, stream):
+        if self.original_bytes:
+            stream.write(_originalbytes(*self.original_bytes))
+        elif self.received_bytes is not None:
+            stream.write(self.received_bytes)
+        else:
+            stream.write(pack_header(ident, len(self.arrays)))
+            for arr in self.arrays:
+                stream.write(pack_length(len(arr)))
+                for enumfield in arr:
+                    enumfield.write(stream)
+
+    def read(self, stream):
+        parsed_ident, length1 = unpack_header(stream.read(4))
+        if parsed_ident != ident:
+            raise _ident_mismatch_error('%02X', ident, parsed_ident)
+        self.arrays = [fieldlist([_decode_enumfield(stream) for _ in range(unpack_length(stream.read(2))[0])])
+                       for _ in range(length1)]
+        return self
+
+    return read, write
+
+
+def _generate_codec(schema):
+    if schema.kind in _scalar_value_formats:
+        return _generate_scalar_codec(schema.ident, _scalar_value_formats[schema.kind])
+    elif schema.kind is nbytes:
+        return _generate_nbytes_codec(schema.ident, schema.width)
+    elif schema.kind is stringenum:
+        return _generate_stringenum_codec(schema.ident)
+    elif schema.kind is passwordlike:
+        return _generate_passwordlike_codec(schema.ident)
+    elif schema.kind is variablelengthbytes:
+        return _generate_variablelengthbytes_codec(schema.ident)
+    elif schema.kind is enumblockarray:
+        return _generate_enumblockarray_codec(schema.ident)
+    else:
+        return _generate_arrayofenumblockarrays_codec(schema.ident)
+
+
+def _generate_decoder(schema):
+    cls = schema.cls
+    ident = schema.ident
+
+    if not schema.specialized:
+        # Classes with their own read method may depend on anything their constructor sets up
+        def decode(stream):
+            return cls().read(stream)
+
+    elif schema.kind is arrayofenumblockarrays:
+        def decode(stream):
+            obj = object.__new__(cls)
+            obj.ident = ident
+            obj.original_bytes = None
+            return obj.read(stream)
+
+    elif schema.kind is enumblockarray:
+        def decode(stream):
+            obj = object.__new__(cls)
+            obj.ident = ident
+            obj.received_bytes = None
+            return obj.read(stream)
+
+    else:
+        # The generated read method sets everything but the ident, so there
+        # is no need to run the constructor and build a default value first
+        def decode(stream):
+            obj = object.__new__(cls)
+            obj.ident = ident
+            return obj.read(stream)
+
+    return decode
+
+
+def _create_schema(cls, kind):
+    instance = cls()
+    if kind in _scalar_value_formats:
+        width = struct.calcsize('<' + _scalar_value_formats[kind])
+        default = instance.value
+    elif kind in (nbytes, stringenum):
+        width = len(instance.value) if kind is nbytes else None
+        default = instance.value
+    elif kind in (passwordlike, variablelengthbytes):
+        width = None
+        default = instance.content
+    else:
+        width = None
+        default = None
+
+    schema = FieldSchema(instance.ident, kind, width, default, cls)
+
+    if cls.read is kind.read and cls.write is kind.write:
+        cls.read, cls.write = _generate_codec(schema)
+        schema.specialized = True
+
+    schema.decode = _generate_decoder(schema)
+    return schema
+
+
+def _build_schema_registry(namespace):
+    enumfields = {}
+    messages = {}
+    for name, cls in list(namespace.items()):
+        if not isinstance(cls, type) or len(name) != 5 or name[0] not in 'am':
+            continue
+        kind = next((k for k in _field_kinds if issubclass(cls, k)), None)
+        if kind is None:
+            continue
+
+        schema = _create_schema(cls, kind)
+        # Lookups used to go by class name, so the name determines which class handles an ident
+        (messages if name[0] == 'a' else enumfields)[int(name[1:], 16)] = schema
+
+    return enumfields, messages
+
+
+enumfield_schemas, message_schemas = _build_schema_registry(globals())
+
+_enumfield_decoders = {ident: schema.decode for ident, schema in enumfield_schemas.items()}
+_top_level_decoders = dict(_enumfield_decoders)
+_top_level_decoders.update((ident, schema.decode) for ident, schema in message_schemas.items())
+
+
+def _decode_enumfield(stream):
+    ident = _ident_struct.unpack(stream.peek(2))[0]
+    try:
+        decode = _enumfield_decoders[ident]
+    except KeyError:
+        raise ParseError('No enumfield class is known for ident %04X' % ident)
+    return decode(stream)
+
+
 def construct_top_level_enumfield(stream):
-    ident = struct.unpack('<H', stream.peek(2))[0]
-    classname = ('a%04X' % ident).lower()
+    ident = _ident_struct.unpack(stream.peek(2))[0]
+    try:
+        decode = _top_level_decoders[ident]
+    except KeyError:
+        raise ParseError('No enumfield or enumblockarray class is known for ident %04X' % ident)
+    return decode(stream)
+
+
+# ------------------------------------------------------------
+# lazy decoding
+# ------------------------------------------------------------
+
+# When decoding lazily, the fields of a message are first only read as
+# bytes, which only requires looking at their lengths. The message keeps the
+# bytes it was received as and only decodes its top level fields. Arrays of
+# enumblockarrays are kept as bytes until they are accessed.
+
+_top_level_schemas = dict(enumfield_schemas)
+_top_level_schemas.update(message_schemas)
+
+
+class _BufferReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, length):
+        requestedbytes = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return requestedbytes
+
+    def peek(self, length):
+        return self.data[self.pos:self.pos + length]
+
+
+def _read_enumfield_bytes(stream, chunks):
+    ident_bytes = stream.read(2)
+    ident = _ident_struct.unpack(ident_bytes)[0]
+    try:
+        schema = enumfield_schemas[ident]
+    except KeyError:
+        raise ParseError('No enumfield class is known for ident %04X' % ident)
+    chunks.append(ident_bytes)
+
+    kind = schema.kind
+    if schema.width is not None:
+        chunks.append(stream.read(schema.width))
+    elif kind is stringenum:
+        length_bytes = stream.read(2)
+        chunks.append(length_bytes)
+        chunks.append(stream.read(_ident_struct.unpack(length_bytes)[0]))
+    elif kind is passwordlike:
+        length_bytes = stream.read(2)
+        chunks.append(length_bytes)
+        chunks.append(stream.read((_ident_struct.unpack(length_bytes)[0] & 0x7FFF) * 2))
+    elif kind is variablelengthbytes:
+        length_bytes = stream.read(4)
+        chunks.append(length_bytes)
+        chunks.append(stream.read(struct.unpack('<L', length_bytes)[0]))
+    elif kind is enumblockarray:
+        length_bytes = stream.read(2)
+        chunks.append(length_bytes)
+        for _ in range(_ident_struct.unpack(length_bytes)[0]):
+            _read_enumfield_bytes(stream, chunks)
+    else:
+        length_bytes = stream.read(2)
+        chunks.append(length_bytes)
+        for _ in range(_ident_struct.unpack(length_bytes)[0]):
+            row_length_bytes = stream.read(2)
+            chunks.append(row_length_bytes)
+            for _ in range(_ident_struct.unpack(row_length_bytes)[0]):
+                _read_enumfield_bytes(stream, chunks)
+
+    return schema
+
+
+def _decode_received_field(schema, data):
+    if schema.kind is arrayofenumblockarrays:
+        obj = schema.cls()
+        obj.received_bytes = data
+        return obj
+    else:
+        return schema.decode(_BufferReader(data))
+
+
+def _received_field_state(field):
+    """ The part of a field of a lazily decoded message that is different once the field is modified """
+    if isinstance(field, arrayofenumblockarrays):
+        # Becomes None when the arrays are accessed, after which they can have been modified
+        return field.received_bytes
+    elif isinstance(field, enumblockarray):
+        # Its content can be modified in place, so it never compares equal to what was received
+        return object()
+    elif isinstance(field, variablelengthbytes):
+        return field.content
+    else:
+        return field.value
+
+
+def construct_top_level_enumfield_lazily(stream):
+    """
+    Decode a top level field like construct_top_level_enumfield does, except
+    that an enumblockarray keeps the bytes it was received as (in its
+    received_bytes member) and the arrays of enumblockarrays in its content
+    are only parsed when they are accessed.
+    """
+    ident = _ident_struct.unpack(stream.peek(2))[0]
+    try:
+        schema = _top_level_schemas[ident]
+    except KeyError:
+        raise ParseError('No enumfield or enumblockarray class is known for ident %04X' % ident)
+    if schema.kind is not enumblockarray:
+        return schema.decode(stream)
+
+    header = stream.read(4)
+    length = _short_header_struct.unpack(header)[1]
+    message_chunks = [header]
+    fields = []
+    for _ in range(length):
+        chunks = []
+        field_schema = _read_enumfield_bytes(stream, chunks)
+        field_bytes = b''.join(chunks)
+        message_chunks.append(field_bytes)
+        fields.append((field_schema, field_bytes))
+
+    if schema.specialized:
+        message = object.__new__(schema.cls)
+        message.ident = ident
+    else:
+        message = schema.cls()
+    message.content = fieldlist(_decode_received_field(field_schema, field_bytes)
+                                for field_schema, field_bytes in fields)
+    message.received_bytes = b''.join(message_chunks)
+    message.received_state = [(field, _received_field_state(field)) for field in message.content]
+    return message
 
-    if classname not in globals():
-        classname = ('m%04X' % ident).lower()
 
-    obj = globals()[classname]().read(stream)
-    return obj
+# ------------------------------------------------------------
+# message templates
+# ------------------------------------------------------------
+
+_fixed_width_kinds = (onebyte, twobytes, fourbytes, nbytes)
+
+
+class _TemplateSlot:
+    def __init__(self, name, field, start, end):
+        self.name = name
+        self.field = field
+        self.start = start
+        self.end = end
+        self.fixed_width = isinstance(field, _fixed_width_kinds)
+        value_format = next((fmt for kind, fmt in _scalar_value_formats.items() if isinstance(field, kind)), None)
+        self.value_struct = struct.Struct('<' + value_format) if value_format else None
+
+    def encode(self, value):
+        if hasattr(value, 'write'):
+            field = value
+        else:
+            field = copy.copy(self.field)
+            if isinstance(field, (enumblockarray, variablelengthbytes)):
+                field.content = value
+            elif isinstance(field, arrayofenumblockarrays):
+                field.original_bytes = None
+                field.arrays = value
+            else:
+                field.value = value
+
+        stream = io.BytesIO()
+        field.write(stream)
+        return stream.getvalue()
+
+    def patch(self, buffer, value):
+        if self.value_struct is not None and not hasattr(value, 'write'):
+            # Plain values of scalar fields can be packed right after the ident
+            self.value_struct.pack_into(buffer, self.start + _ident_struct.size, value)
+            return
+
+        encoded = self.encode(value)
+        if len(encoded) != self.end - self.start:
+            raise ValueError('Value for slot %s encodes to %d bytes instead of %d' %
+                             (self.name, len(encoded), self.end - self.start))
+        buffer[self.start:self.end] = encoded
+
+
+def _write_and_record_slots(obj, stream, slot_names, slot_offsets):
+    name = slot_names.get(id(obj))
+    if name is not None:
+        start = stream.tell()
+        obj.write(stream)
+        slot_offsets[name] = (start, stream.tell())
+    elif isinstance(obj, enumblockarray):
+        stream.write(_short_header_struct.pack(obj.ident, len(obj.content)))
+        for el in obj.content:
+            _write_and_record_slots(el, stream, slot_names, slot_offsets)
+    elif isinstance(obj, arrayofenumblockarrays) and not obj.original_bytes:
+        stream.write(_short_header_struct.pack(obj.ident, len(obj.arrays)))
+        for arr in obj.arrays:
+            stream.write(_ident_struct.pack(len(arr)))
+            for enumfield in arr:
+                _write_and_record_slots(enumfield, stream, slot_names, slot_offsets)
+    else:
+        obj.write(stream)
+
+
+class MessageTemplate:
+    """
+    A message that is serialized only once, after which variants of it are
+    produced by putting different values for some of its fields into the
+    serialized bytes.
+
+    The fields that can be changed are called slots. They are passed to the
+    constructor as keyword arguments, each referring to a field object that
+    is part of the message. Fixed-width slots are patched in place. If a
+    value is given for a slot of variable length (a string, variable length
+    bytes or an array), the bytes before and after it are spliced around the
+    newly encoded slot instead.
+
+    Example:
+
+        msg = a00b0().set_player(0)
+        template = MessageTemplate(msg, unique_id=msg.findbytype(m0348))
+        player.send(template.render(unique_id=player.unique_id))
+    """
+
+    def __init__(self, message, **slot_fields):
+        messages = message if isinstance(message, list) else [message]
+        slot_names = {id(field): name for name, field in slot_fields.items()}
+        slot_offsets = {}
+
+        stream = io.BytesIO()
+        for el in messages:
+            _write_and_record_slots(el, stream, slot_names, slot_offsets)
+
+        missing_slots = set(slot_fields.keys()) - set(slot_offsets.keys())
+        if missing_slots:
+            raise ValueError('The following slots are not part of the message: %s' % ', '.join(sorted(missing_slots)))
+
+        self.data = stream.getvalue()
+        self.slots = {name: _TemplateSlot(name, slot_fields[name], start, end)
+                      for name, (start, end) in slot_offsets.items()}
+        self.slots_in_order = sorted(self.slots.values(), key=lambda slot: slot.start)
+
+    def render(self, **values):
+        """
+        Produce the serialized message with the given values filled in
+
+        Slots for which no value is given keep the value they had when the
+        template was created. A value is either a plain value of the slot's
+        field (an int, str, bytes or a list of content/arrays) or a field
+        object of the slot's type.
+
+        :return: an encodedmessage that can be sent like any other message
+        """
+        unknown_slots = set(values.keys()) - set(self.slots.keys())
+        if unknown_slots:
+            raise ValueError('The following slots do not exist in this template: %s' % ', '.join(sorted(unknown_slots)))
+
+        if all(self.slots[name].fixed_width for name in values):
+            buffer = bytearray(self.data)
+            for name, value in values.items():
+                self.slots[name].patch(buffer, value)
+            return encodedmessage(bytes(buffer))
+
+        pieces = []
+        position = 0
+        for slot in self.slots_in_order:
+            if slot.name in values:
+                pieces.append(self.data[position:slot.start])
+                pieces.append(slot.encode(values[slot.name]))
+                position = slot.end
+        pieces.append(self.data[position:])
+        return encodedmessage(b''.join(pieces))
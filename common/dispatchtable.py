@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import inspect
+
+
+def build_dispatch_table(cls, marker):
+    """
+    Map each type that is handled by a method of cls to that method. Handler
+    methods are recognized by an attribute with the name in marker that holds
+    the type they handle. Inherited methods are included unless a subclass
+    overrides them by name.
+    :param cls: the class to build the table for
+    :param marker: the name of the attribute set by the handler decorator
+    :return: a dict from handled type to (unbound) method
+    """
+    table = {}
+    for name, func in inspect.getmembers(cls, inspect.isfunction):
+        handled_type = getattr(func, marker, None)
+        if handled_type is None:
+            continue
+
+        if handled_type in table:
+            raise ValueError('Duplicate handlers found in class %s for %s: %s and %s' %
+                             (cls.__name__, handled_type.__name__, table[handled_type].__name__, name))
+        table[handled_type] = func
+    return table
@@ -28,10 +28,22 @@ from .tcpmessage import TcpMessageWriter
 
 
 class FirewallClient:
-    def __init__(self, ports):
+    def __init__(self, ports, run_in_background=None):
+        """
+        :param run_in_background: function that runs a function without waiting
+                                  for it, to send the commands with. Without it
+                                  they are sent before the methods return.
+        """
         self.ports = ports
+        self.run_in_background = run_in_background
 
     def _send_command(self, command):
+        if self.run_in_background is None:
+            self._send_command_now(command)
+        else:
+            self.run_in_background(lambda: self._send_command_now(command))
+
+    def _send_command_now(self, command):
         server_address = ("127.0.0.1", self.ports['firewall'])
         proxy_addresses = (("127.0.0.1", self.ports['gameserver1firewall']),
                            ("127.0.0.1", self.ports['gameserver2firewall']))
@@ -22,7 +22,7 @@ import io
 import struct
 
 from common.connectionhandler import *
-from .datatypes import construct_top_level_enumfield, m034a
+from .datatypes import construct_top_level_enumfield, construct_top_level_enumfield_lazily, encodedmessage, m034a
 
 
 def peekshort(infile):
@@ -48,36 +48,67 @@ def parseseqack(infile):
 class PacketReader:
     def __init__(self, receive_func):
         self.buffer = bytes()
+        self.pos = 0
+        self.mark_pos = None
         self.receive_func = receive_func
 
+    def mark(self):
+        ''' Remember the current position, so that reading can be restarted from there '''
+        self.mark_pos = self.pos
+
+    def rewind(self):
+        ''' Go back to the position that was passed to mark '''
+        self.pos = self.mark_pos
+
+    def unmark(self):
+        self.mark_pos = None
+
     def prepare(self, length):
-        ''' Makes sure that at least length bytes are available in self.buffer '''
-        while len(self.buffer) < length:
-            message_data = self.receive_func()
-            self.buffer += message_data
+        ''' Makes sure that at least length bytes are available in self.buffer after self.pos '''
+        if self.pos + length > len(self.buffer):
+            # Only drop the bytes that have already been read when more data is needed,
+            # instead of every time something is read
+            keep_from = self.pos if self.mark_pos is None else self.mark_pos
+            parts = [self.buffer[keep_from:]]
+            available = len(self.buffer) - self.pos
+            try:
+                while available < length:
+                    message_data = self.receive_func()
+                    parts.append(message_data)
+                    available += len(message_data)
+            finally:
+                # Keep what was received even if receive_func raised an exception,
+                # so that nothing is lost when reading is restarted later
+                self.buffer = b''.join(parts)
+                self.pos -= keep_from
+                if self.mark_pos is not None:
+                    self.mark_pos -= keep_from
 
     def read(self, length):
         self.prepare(length)
-        requestedbytes = self.buffer[:length]
-        self.buffer = self.buffer[length:]
+        requestedbytes = self.buffer[self.pos:self.pos + length]
+        self.pos += length
         return requestedbytes
 
     def peek(self, length):
         self.prepare(length)
-        requestedbytes = self.buffer[:length]
-        return requestedbytes
+        return self.buffer[self.pos:self.pos + length]
 
     def tell(self):
         return 0
 
 
 class StreamParser:
-    def __init__(self, in_stream):
+    def __init__(self, in_stream, lazy=False):
         self.in_stream = in_stream
+        if lazy:
+            self.construct_top_level_enumfield = construct_top_level_enumfield_lazily
+        else:
+            self.construct_top_level_enumfield = construct_top_level_enumfield
 
     def parse(self):
         out_file = io.StringIO()
-        next_object = construct_top_level_enumfield(self.in_stream)
+        next_object = self.construct_top_level_enumfield(self.in_stream)
 
         # FIXME: That we have to look at the first object to see how
         # many items are in this packet probably indicates that we
@@ -93,7 +124,7 @@ class StreamParser:
 
         objs = [next_object]
         for i in range(additional_item_count):
-            objs.append(construct_top_level_enumfield(self.in_stream))
+            objs.append(self.construct_top_level_enumfield(self.in_stream))
         if has_seq_ack:
             seq, _ = parseseqack(self.in_stream)
         else:
@@ -111,26 +142,46 @@ class LoginProtocolMessage():
 class LoginProtocolReader(TcpMessageConnectionReader):
     def __init__(self, sock, dump_queue):
         super().__init__(sock, max_message_size = 1450, dump_queue = dump_queue)
-        packet_reader = PacketReader(super().receive)
-        self.stream_parser = StreamParser(packet_reader)
+        self.packet_reader = PacketReader(super().receive)
+        self.stream_parser = StreamParser(self.packet_reader, lazy=True)
 
     def receive(self):
         return None
 
     def decode(self, msg_bytes):
-        seq, msg = self.stream_parser.parse()
+        # A non-blocking socket raises BlockingIOError when a message has
+        # not been received completely yet. In that case parsing has to
+        # start over from the beginning of the message later.
+        self.packet_reader.mark()
+        try:
+            seq, msg = self.stream_parser.parse()
+        except BlockingIOError:
+            self.packet_reader.rewind()
+            raise
+        finally:
+            self.packet_reader.unmark()
         return LoginProtocolMessage(seq, msg)
 
 
 class LoginProtocolWriter(TcpMessageConnectionWriter):
     def __init__(self, sock, dump_queue):
-        super().__init__(sock, max_message_size = 1450, dump_queue = dump_queue)
+        super().__init__(sock, max_message_size = 1450, dump_queue = dump_queue, nodelay = True)
         self.seq = None
 
     def encode(self, msg_tuple):
-        stream = io.BytesIO()
         message, ack = msg_tuple
 
+        if isinstance(message, encodedmessage):
+            # The message may be shared with other writers, so it is sent as
+            # it is with only the seq/ack of this connection after it
+            if self.seq is None:
+                self.seq = 0
+                return message.data
+            trailer = struct.pack('<LL', self.seq, ack if ack is not None else 0)
+            self.seq += 1
+            return message.data, trailer
+
+        stream = io.BytesIO()
         if isinstance(message, list):
             for el in message:
                 el.write(stream)
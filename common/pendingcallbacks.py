@@ -18,41 +18,136 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from common.geventwrapper import gevent_spawn_later
-from common.utils import first_unused_number_above
+import heapq
+import itertools
+import time
+
+import gevent.event
+
+from common.geventwrapper import gevent_spawn
 
 
 class ExecuteCallbackMessage():
-    def __init__(self, callback_id):
-        self.callback_id = callback_id
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+
+
+class _PendingCallback:
+    __slots__ = ('deadline', 'sequence', 'receiver_id', 'callback_func', 'posted')
+
+    def __init__(self, deadline, sequence, receiver_id, callback_func):
+        self.deadline = deadline
+        self.sequence = sequence
+        self.receiver_id = receiver_id
+        self.callback_func = callback_func
+        self.posted = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
 
 
 class PendingCallbacks:
-    def __init__(self, server_queue):
+    """
+    Calls functions after a delay in the task that handles the server queue.
+
+    The callbacks are kept in a heap ordered by their deadline. A single
+    greenlet (or with call_later, a single timer) waits for the earliest
+    deadline and then posts all callbacks that are due in one
+    ExecuteCallbackMessage. The task that handles that message must pass
+    its callbacks to execute.
+    """
+
+    # Cancelled callbacks stay in the heap until they are due, unless they
+    # make up more than half of a heap of at least this size
+    min_heap_size_to_compact = 64
+
+    def __init__(self, server_queue, call_later=None):
         self.server_queue = server_queue
-        self.callbacks = {}
+        # Function with the signature of asyncio's loop.call_later, used to
+        # schedule the callbacks instead of running a greenlet
+        self.call_later = call_later
+        self.heap = []
+        self.sequence = itertools.count()
+        self.callbacks_by_receiver = {}
+        self.cancelled_count = 0
+
+        self.task = None
+        self.wakeup = None
+        self.timer = None
+        self.timer_deadline = None
 
     def add(self, receiver, seconds_from_now, callback_func):
-        callback_id = first_unused_number_above(self.callbacks.keys(), 0)
+        callback = _PendingCallback(time.monotonic() + seconds_from_now, next(self.sequence),
+                                    id(receiver), callback_func)
+        heapq.heappush(self.heap, callback)
+        self.callbacks_by_receiver.setdefault(callback.receiver_id, {})[callback] = None
 
-        self.callbacks[callback_id] = {'receiver_id': id(receiver),
-                                       'callback_func': callback_func }
-        gevent_spawn_later('pending callback for %s' % receiver, seconds_from_now, self._post_callback, callback_id)
+        if self.heap[0] is callback:
+            self._deadline_moved_forward()
 
     def remove_receiver(self, receiver):
-        for callback_id, callback in self.callbacks.items():
-            if callback['receiver_id'] == id(receiver):
-                # Only disable callbacks here, removal is done when the callback is fired
-                callback['callback_func'] = None
+        for callback in self.callbacks_by_receiver.pop(id(receiver), ()):
+            # The callback may already have been posted, so it is only disabled here
+            callback.callback_func = None
+            if not callback.posted:
+                self.cancelled_count += 1
+
+        if self.cancelled_count > len(self.heap) // 2 and len(self.heap) >= self.min_heap_size_to_compact:
+            self.heap = [callback for callback in self.heap if callback.callback_func is not None]
+            heapq.heapify(self.heap)
+            self.cancelled_count = 0
+
+    def execute(self, callbacks):
+        for callback in callbacks:
+            if callback.callback_func is not None:
+                receiver_callbacks = self.callbacks_by_receiver[callback.receiver_id]
+                del receiver_callbacks[callback]
+                if not receiver_callbacks:
+                    del self.callbacks_by_receiver[callback.receiver_id]
+                callback.callback_func()
+
+    def _deadline_moved_forward(self):
+        if self.call_later is None:
+            if self.task is None:
+                self.wakeup = gevent.event.Event()
+                self.task = gevent_spawn('pending callbacks', self._run)
+            else:
+                self.wakeup.set()
+        elif self.timer_deadline is None or self.heap[0].deadline < self.timer_deadline:
+            if self.timer is not None:
+                self.timer.cancel()
+            self._schedule_timer()
+
+    def _run(self):
+        while True:
+            if self.heap:
+                self.wakeup.wait(max(self.heap[0].deadline - time.monotonic(), 0))
+            else:
+                self.wakeup.wait()
+            self.wakeup.clear()
+            self._post_due_callbacks()
 
-    def _post_callback(self, callback_id):
-        self.server_queue.put(ExecuteCallbackMessage(callback_id))
+    def _on_timer(self):
+        self.timer = None
+        self.timer_deadline = None
+        self._post_due_callbacks()
+        if self.heap:
+            self._schedule_timer()
 
-    def execute(self, callback_id):
-        assert callback_id in self.callbacks, "Callback not found. A callback should only be removed by " \
-                                              "its trigger to avoid problems with reused callback IDs."
+    def _schedule_timer(self):
+        self.timer_deadline = self.heap[0].deadline
+        self.timer = self.call_later(max(self.timer_deadline - time.monotonic(), 0), self._on_timer)
 
-        if self.callbacks[callback_id]['callback_func'] is not None:
-            self.callbacks[callback_id]['callback_func']()
-        del self.callbacks[callback_id]
+    def _post_due_callbacks(self):
+        now = time.monotonic()
+        due_callbacks = []
+        while self.heap and self.heap[0].deadline <= now:
+            callback = heapq.heappop(self.heap)
+            if callback.callback_func is not None:
+                callback.posted = True
+                due_callbacks.append(callback)
+            else:
+                self.cancelled_count -= 1
 
+        if due_callbacks:
+            self.server_queue.put(ExecuteCallbackMessage(due_callbacks))
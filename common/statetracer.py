@@ -41,6 +41,15 @@ class StateTracer:
         self.enabled = False
         self.members_to_trace = [str(name) for name in members_to_trace]
         self.refonly_members = set(str(name) for name in members_to_trace if isinstance(name, RefOnly))
+        # Functions that are called on every change of a traced member, also when tracing is disabled
+        self.observers = []
+
+    def add_observer(self, observer):
+        ''' observer is called with the object, the member name, the old value and the new value '''
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
 
     def add_to_trace(self, member_name):
         #print('add_to_trace: %s' % member_name)
@@ -56,6 +65,8 @@ class StateTracer:
     def member_changed(self, member_name, old_value, new_value):
         #print('member_changed: %s from %s to %s (trace is %s, members to trace: %s)' % (member_name, old_value, new_value, self.enabled, self.members_to_trace))
         assert member_name in self.members_to_trace
+        for observer in self.observers:
+            observer(self.obj, member_name, old_value, new_value)
         if self.enabled:
             if member_name not in self.refonly_members:
                 if hasattr(old_value, '_state_tracer'):
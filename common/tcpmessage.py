@@ -18,7 +18,7 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import io
+from socket import IPPROTO_TCP, TCP_NODELAY
 import struct
 
 
@@ -30,56 +30,125 @@ class TcpMessageReader:
         if self.max_message_size > 0xFFFF:
             raise ValueError('max_message_size is not allowed to be greater than 0xFFFF')
 
+        # Data is received directly into this buffer. It has room for two
+        # messages of the maximum size, so that a single recv can pick up
+        # more than one message if they have already arrived.
+        self.buffer = bytearray(2 * (self.max_message_size + 2))
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
     def _recvall(self, size):
-        remaining_size = size
-        msg = bytes()
-        while remaining_size > 0:
-            chunk = self.socket.recv(remaining_size)
-            if not chunk:
+        """ Makes sure that at least size bytes are available in the buffer """
+        if self.start + size > len(self.buffer):
+            # Move what is left of the received data to the start of the buffer to make room
+            remaining_size = self.end - self.start
+            self.view[:remaining_size] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining_size
+
+        while self.end - self.start < size:
+            received_size = self.socket.recv_into(self.view[self.end:])
+            if received_size == 0:
                 raise ConnectionResetError()
-            remaining_size -= len(chunk)
-            msg += chunk
-        return msg
+            self.end += received_size
 
     def receive(self):
-        packet_size_bytes = self._recvall(2)
-        packet_size = struct.unpack('<H', packet_size_bytes)[0]
+        self._recvall(2)
+        packet_size = struct.unpack_from('<H', self.buffer, self.start)[0]
         if packet_size == 0:
             packet_size = self.max_message_size
         elif packet_size > self.max_message_size:
             raise RuntimeError('Received a packet size that is larger than the TcpMessageReader was created for')
 
-        packet_body_bytes = self._recvall(packet_size)
+        self._recvall(2 + packet_size)
+        body_start = self.start + 2
+        self.start = body_start + packet_size
+
         if self.dump_queue:
-            self.dump_queue.put(('tcpreader', packet_size_bytes + packet_body_bytes))
-        if len(packet_body_bytes) != packet_size:
-            raise RuntimeError('Received %d bytes, but expected %d. What happened?' %
-                               (len(packet_body_bytes), packet_size))
-        return packet_body_bytes
+            self.dump_queue.put(('tcpreader', bytes(self.view[body_start - 2:self.start])))
+        return bytes(self.view[body_start:self.start])
+
+
+# Maximum number of buffers passed to a single sendmsg call; POSIX
+# guarantees that at least this many are allowed (IOV_MAX)
+_MAX_BUFFERS_PER_SENDMSG = 1024
 
 
 class TcpMessageWriter:
-    def __init__(self, socket, max_message_size = 0xFFFF, dump_queue = None):
+    def __init__(self, socket, max_message_size = 0xFFFF, dump_queue = None, nodelay = False):
         self.socket = socket
         self.max_message_size = max_message_size
         self.dump_queue = dump_queue
         if self.max_message_size > 0xFFFF:
             raise ValueError('max_message_size is not allowed to be greater than 0xFFFF')
 
-    def send(self, data):
+        if nodelay:
+            # Messages are already combined into as few sends as possible,
+            # so there is no point in letting the OS delay them further
+            self.socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+        # Statistics about how well messages are combined into sends
+        self.message_count = 0
+        self.send_count = 0
+        self.max_messages_per_send = 0
+
+    def _add_frames(self, data, buffers):
+        if isinstance(data, tuple):
+            # A message that consists of several parts, which are sent as they are
+            # if they fit in a single frame, so that shared parts are not copied
+            size = sum(len(part) for part in data)
+            if 0 < size < self.max_message_size:
+                buffers.append(struct.pack('<H', size))
+                buffers.extend(data)
+                return
+            data = b''.join(data)
+
         size = len(data)
         if size == 0:
             raise ValueError('TcpMessageWriter: Sending empty messages is not allowed')
-        output_buffer = io.BytesIO()
-        while size > 0:
-            output_buffer.write(struct.pack('<H', size if size < self.max_message_size else 0))
-            output_buffer.write(data[:self.max_message_size])
-            data = data[self.max_message_size:]
-            size = len(data)
+        view = memoryview(data)
+        for offset in range(0, size, self.max_message_size):
+            frame = view[offset:offset + self.max_message_size]
+            buffers.append(struct.pack('<H', len(frame) if len(frame) < self.max_message_size else 0))
+            buffers.append(frame)
+
+    def _sendall(self, buffers):
+        if not hasattr(self.socket, 'sendmsg'):
+            # No vectored I/O on this platform (e.g. Windows), so join the buffers instead
+            self.socket.sendall(b''.join(buffers))
+            return
+
+        while buffers:
+            sent_size = self.socket.sendmsg(buffers[:_MAX_BUFFERS_PER_SENDMSG])
+            # Remove what was sent, which may end halfway through a buffer
+            sent_buffers = 0
+            while sent_buffers < len(buffers) and sent_size >= len(buffers[sent_buffers]):
+                sent_size -= len(buffers[sent_buffers])
+                sent_buffers += 1
+            buffers = buffers[sent_buffers:]
+            if sent_size:
+                buffers[0] = memoryview(buffers[0])[sent_size:]
+
+    def send(self, data):
+        self.send_many([data])
+
+    def send_many(self, messages):
+        """
+        Send several messages with as few system calls as possible. Each
+        message is either bytes or a tuple of bytes that make up the message.
+        """
+        buffers = []
+        for data in messages:
+            self._add_frames(data, buffers)
 
         if self.dump_queue:
-            self.dump_queue.put(('tcpwriter', output_buffer.getvalue()))
-        self.socket.sendall(output_buffer.getvalue())
+            self.dump_queue.put(('tcpwriter', b''.join(buffers)))
+        self._sendall(buffers)
+
+        self.message_count += len(messages)
+        self.send_count += 1
+        self.max_messages_per_send = max(self.max_messages_per_send, len(messages))
 
     def close(self):
         self.socket.close()
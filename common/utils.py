@@ -18,15 +18,57 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import heapq
 import os
 
 SHARED_INI_PATH = os.path.join('data', 'shared.ini')
 
 
-def first_unused_number_above(numbers, minimum):
-    used_numbers = (n for n in numbers if n >= minimum)
-    first_number_above = next(i for i, e in enumerate(sorted(used_numbers) + [None], start=minimum) if i != e)
-    return first_number_above
+class IdAllocator:
+    """
+    Hands out the lowest number that is not in use and not below a minimum.
+
+    Numbers from next_id upwards are free unless they have been reserved.
+    Numbers below next_id that are released are kept in a heap, so that the
+    lowest one is found without looking at the numbers in use.
+    """
+    def __init__(self, minimum, used_ids=()):
+        self.minimum = minimum
+        self.next_id = minimum
+        self.used_ids = set()
+        self.released_ids = []
+        for used_id in used_ids:
+            self.reserve(used_id)
+
+    def allocate(self):
+        while self.released_ids:
+            released_id = heapq.heappop(self.released_ids)
+            # A released number can have been reserved again in the meantime
+            if released_id not in self.used_ids:
+                self.used_ids.add(released_id)
+                return released_id
+
+        while self.next_id in self.used_ids:
+            self.next_id += 1
+        allocated_id = self.next_id
+        self.next_id += 1
+        self.used_ids.add(allocated_id)
+        return allocated_id
+
+    def reserve(self, used_id):
+        """ Mark a number that was not handed out by this allocator as in use """
+        if used_id >= self.minimum:
+            self.used_ids.add(used_id)
+
+    def release(self, used_id):
+        """ Make a number available again; numbers that are not in use are ignored """
+        if used_id in self.used_ids:
+            self.used_ids.remove(used_id)
+            if used_id < self.next_id:
+                heapq.heappush(self.released_ids, used_id)
+
+    def __contains__(self, used_id):
+        return used_id in self.used_ids
 
 
 def is_valid_ascii_for_name(ascii_bytes):
@@ -234,8 +234,7 @@ class Launcher:
             assert False, "Invalid disconnection message received"
 
     def handle_execute_callback_message(self, msg):
-        callback_id = msg.callback_id
-        self.pending_callbacks.execute(callback_id)
+        self.pending_callbacks.execute(msg.callbacks)
 
     def handle_login_server_protocol_version_message(self, msg):
         # The only time we get a message with the login server's protocol version
@@ -18,71 +18,232 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+
 import base64
+import concurrent.futures
 import json
+import logging
+import os
 
-from common.utils import first_unused_number_above
+from common.utils import IdAllocator
+from .persistence import write_file_atomically
 
 
 class AccountInfo():
+    """ An account record. Records are replaced instead of modified, so that they can be shared with a snapshot. """
     def __init__(self, unique_id, login_name, authcode=None, password_hash=None):
         self.unique_id = unique_id
         self.login_name = login_name
         self.authcode = authcode
         self.password_hash = password_hash
 
+    @classmethod
+    def from_dict(cls, d):
+        password_hash = d['password_hash']
+        if password_hash is not None:
+            password_hash = base64.b64decode(password_hash)
+        return cls(d['unique_id'], d['login_name'].lower(), d['authcode'], password_hash)
+
+    def to_dict(self):
+        password_hash = self.password_hash
+        if password_hash is not None:
+            password_hash = base64.b64encode(password_hash).decode('utf-8')
+        return {
+            'unique_id' : self.unique_id,
+            'login_name' : self.login_name.lower(),
+            'authcode' : self.authcode,
+            'password_hash' : password_hash
+        }
+
+
 class Accounts():
-    def __init__(self, filename):
+    """
+    The account database, which consists of a snapshot in the JSON format
+    that was always used for it and a journal of the account records that
+    were added or changed since the snapshot was written.
+
+    Every change is appended to the journal as a single line. Once the
+    journal has grown to compaction_threshold records, it is set aside and
+    a new snapshot is written in a worker thread, after which the old
+    journal is removed. On startup the snapshot is loaded, any journals are
+    replayed on top of it and the result is compacted into a new snapshot.
+    """
+
+    compaction_threshold = 1000
+
+    def __init__(self, filename, executor_class=concurrent.futures.ThreadPoolExecutor):
+        """
+        :param filename: the JSON file with the snapshot of the accounts
+        :param executor_class: the concurrent.futures.Executor to compact
+                               in. Under gevent this must be one that uses
+                               real threads.
+        """
+        self.logger = logging.getLogger(__name__)
         self.filename = filename
+        self.journal_filename = os.path.splitext(filename)[0] + '.journal'
+        # The journal that is being compacted into the snapshot
+        self.compacting_journal_filename = self.journal_filename + '.compacting'
+        self.executor = executor_class(max_workers=1)
+        self.compaction = None
+
         self.accounts = {}
-        self.load()
+        self.accounts_by_unique_id = {}
+        self.unique_ids = IdAllocator(1)
+        if self.load():
+            # Start with an empty journal
+            self._write_snapshot(list(self.accounts.values()))
+            for journal_filename in (self.compacting_journal_filename, self.journal_filename):
+                if os.path.exists(journal_filename):
+                    os.remove(journal_filename)
+
+        self.journal = open(self.journal_filename, 'at')
+        self.journal_record_count = 0
 
     def load(self):
+        """ Load the snapshot and replay the journals. Returns whether there were any journal records. """
         try:
             with open(self.filename, 'rt') as f:
                 data = f.read()
             if data:
-                accountlist = json.loads(data)
-                for accountentry in accountlist:
-                    unique_id = accountentry['unique_id']
-                    login_name = accountentry['login_name'].lower()
-                    authcode = accountentry['authcode']
-                    password_hash = accountentry['password_hash']
-                    if password_hash is not None:
-                        password_hash = base64.b64decode(password_hash)
-                    self.accounts[login_name] = AccountInfo(unique_id,
-                                                            login_name,
-                                                            authcode,
-                                                            password_hash)
+                for accountentry in json.loads(data):
+                    self._put(AccountInfo.from_dict(accountentry))
+        except FileNotFoundError:
+            pass
+
+        replayed_records = 0
+        for journal_filename in (self.compacting_journal_filename, self.journal_filename):
+            replayed_records += self._replay_journal(journal_filename)
+        return replayed_records > 0
+
+    def _replay_journal(self, journal_filename):
+        line_number = 0
+        try:
+            with open(journal_filename, 'rt') as f:
+                for line_number, line in enumerate(f, start=1):
+                    try:
+                        self._put(AccountInfo.from_dict(json.loads(line)))
+                    except (ValueError, KeyError) as e:
+                        # Most likely the last record of a journal that was being written when the server stopped
+                        self.logger.warning('Ignoring invalid record on line %d of %s: %s' %
+                                            (line_number, journal_filename, e))
         except FileNotFoundError:
             pass
+        return line_number
+
+    def import_json(self, filename):
+        """
+        Add or replace the accounts in a JSON file in the format of the snapshot.
+        Raises ValueError and imports nothing if an account in the file has a
+        unique_id that belongs to another account.
+        """
+        with open(filename, 'rt') as f:
+            accountlist = [AccountInfo.from_dict(accountentry) for accountentry in json.load(f)]
+
+        # Check the accounts in the order in which they will be added
+        unique_ids_by_login_name = {login_name: accountinfo.unique_id
+                                    for login_name, accountinfo in self.accounts.items()}
+        login_names_by_unique_id = {unique_id: accountinfo.login_name
+                                    for unique_id, accountinfo in self.accounts_by_unique_id.items()}
+        for accountinfo in accountlist:
+            owner = login_names_by_unique_id.get(accountinfo.unique_id)
+            if owner is not None and owner != accountinfo.login_name:
+                raise ValueError('Account %s in %s has unique_id %d, which belongs to account %s' %
+                                 (accountinfo.login_name, filename, accountinfo.unique_id, owner))
+            old_unique_id = unique_ids_by_login_name.get(accountinfo.login_name)
+            if old_unique_id is not None:
+                del login_names_by_unique_id[old_unique_id]
+            unique_ids_by_login_name[accountinfo.login_name] = accountinfo.unique_id
+            login_names_by_unique_id[accountinfo.unique_id] = accountinfo.login_name
 
-    def save(self):
-        with open(self.filename, 'wt') as f:
-            accountlist = []
-            for accountinfo in self.accounts.values():
-                password_hash = accountinfo.password_hash
-                if password_hash is not None:
-                    password_hash = base64.b64encode(password_hash).decode('utf-8')
-                accountlist.append({
-                    'unique_id' : accountinfo.unique_id,
-                    'login_name' : accountinfo.login_name.lower(),
-                    'authcode' : accountinfo.authcode,
-                    'password_hash' : password_hash
-                })
-            json.dump(accountlist, f, indent = 4)
+        for accountinfo in accountlist:
+            self._update(accountinfo)
+
+    def export_json(self, filename):
+        """ Write all accounts to a JSON file in the format of the snapshot """
+        self._write_snapshot(list(self.accounts.values()), filename)
+
+    def close(self):
+        """ Write everything to the snapshot and stop the compaction worker """
+        self.executor.shutdown(wait=True)
+        self.journal.close()
+        self._write_snapshot(list(self.accounts.values()))
+        os.remove(self.journal_filename)
+        if os.path.exists(self.compacting_journal_filename):
+            os.remove(self.compacting_journal_filename)
+
+    def get_statistics(self):
+        return {
+            'accounts': len(self.accounts),
+            'journal_records': self.journal_record_count,
+            'compacting': self.compaction is not None and not self.compaction.done()
+        }
 
     def __getitem__(self, key):
         return self.accounts[key.lower()]
 
     def __contains__(self, key):
         return key.lower() in self.accounts
-    
+
+    def find_by_unique_id(self, unique_id):
+        return self.accounts_by_unique_id.get(unique_id)
+
     def add_account(self, login_name, authcode):
         login_name = login_name.lower()
         if login_name in self.accounts:
             unique_id = self.accounts[login_name].unique_id
         else:
-            used_ids = {account.unique_id for account in self.accounts.values()}
-            unique_id = first_unused_number_above(used_ids, 1)
-        self.accounts[login_name] = AccountInfo(unique_id, login_name, authcode)
+            unique_id = self.unique_ids.allocate()
+        self._update(AccountInfo(unique_id, login_name, authcode))
+
+    def set_password_hash(self, login_name, password_hash):
+        """ Complete the verification of an account by setting its password hash and clearing its authcode """
+        accountinfo = self[login_name]
+        self._update(AccountInfo(accountinfo.unique_id, accountinfo.login_name, None, password_hash))
+
+    def _put(self, accountinfo):
+        old_accountinfo = self.accounts.get(accountinfo.login_name)
+        if old_accountinfo is not None and old_accountinfo.unique_id != accountinfo.unique_id:
+            del self.accounts_by_unique_id[old_accountinfo.unique_id]
+            self.unique_ids.release(old_accountinfo.unique_id)
+        self.accounts[accountinfo.login_name] = accountinfo
+        self.accounts_by_unique_id[accountinfo.unique_id] = accountinfo
+        self.unique_ids.reserve(accountinfo.unique_id)
+
+    def _update(self, accountinfo):
+        self._put(accountinfo)
+        self._append_to_journal(accountinfo)
+
+    def _append_to_journal(self, accountinfo):
+        self.journal.write(json.dumps(accountinfo.to_dict()) + '\n')
+        self.journal.flush()
+        self.journal_record_count += 1
+
+        # A journal that is still set aside after a compaction failed is left
+        # alone, so that it is replayed on the next startup
+        if self.journal_record_count >= self.compaction_threshold and \
+                (self.compaction is None or self.compaction.done()) and \
+                not os.path.exists(self.compacting_journal_filename):
+            self._start_compaction()
+
+    def _start_compaction(self):
+        # Set the journal aside, so that the changes made during the compaction go to a new one
+        self.journal.close()
+        os.replace(self.journal_filename, self.compacting_journal_filename)
+        self.journal = open(self.journal_filename, 'at')
+        self.journal_record_count = 0
+
+        # The records themselves are never modified, so a copy of the list is a consistent snapshot
+        self.compaction = self.executor.submit(self._compact, list(self.accounts.values()))
+
+    def _compact(self, snapshot):
+        # Runs in a worker thread
+        try:
+            self._write_snapshot(snapshot)
+            os.remove(self.compacting_journal_filename)
+        except OSError as e:
+            # The journal that was set aside is replayed on the next startup
+            self.logger.error('Failed to compact the account database: %s' % e)
+
+    def _write_snapshot(self, snapshot, filename=None):
+        write_file_atomically(filename or self.filename,
+                              json.dumps([accountinfo.to_dict() for accountinfo in snapshot], indent=4))
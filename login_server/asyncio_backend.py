@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import logging
+import queue
+import sys
+import threading
+
+from common.asyncioconnectionhandler import AsyncioQueue, AsyncioIncomingConnectionHandler
+from .authcodehandler import AuthCodeHandler
+from .gameclienthandler import GameClientHandler
+from .gameserverlauncherhandler import GameServerLauncherHandler
+from .httphandler import AsyncioHttpHandler
+from .loginserver import LoginServer
+from .startup import prepare_login_server, get_login_server_options, create_player_data_writer
+from .trafficdumper import TrafficDumper
+from .webhookhandler import handle_webhook
+
+
+async def handle_server(login_server, server_queue):
+    login_server.start()
+    while True:
+        if not login_server.dispatcher.has_pending():
+            login_server.dispatcher.add(await server_queue.get())
+        login_server.dispatch_queued_messages()
+        await asyncio.sleep(0)
+
+
+async def run_login_server(args, accounts, config, ports):
+    logger = logging.getLogger(__name__)
+    loop = asyncio.get_running_loop()
+
+    def run_in_executor(func, callback=None):
+        # Blocking calls in func must not run on the event loop itself
+        def done(future):
+            if not future.cancelled():
+                # An exception raised by func ends up in the loop's exception handler from here
+                result = future.result()
+                if callback is not None:
+                    callback(result)
+
+        loop.run_in_executor(None, func).add_done_callback(done)
+
+    server_queue = AsyncioQueue()
+    # The webhook and the traffic dumper block while doing their work, so
+    # they get threads of their own and are fed through thread-safe queues
+    server_stats_queue = queue.Queue()
+    dump_queue = queue.Queue() if args.dump else None
+
+    threading.Thread(target=handle_webhook, args=(server_stats_queue, config['loginserver']),
+                     name="login server's handle_webhook", daemon=True).start()
+    if dump_queue:
+        threading.Thread(target=TrafficDumper(dump_queue).run,
+                         name="login server's handle_dump", daemon=True).start()
+
+    login_server = LoginServer(server_queue, {}, server_stats_queue, ports, accounts, call_later=loop.call_later,
+                               run_in_background=run_in_executor, data_writer=create_player_data_writer(config),
+                               **get_login_server_options(config))
+
+    tasks = [
+        asyncio.create_task(handle_server(login_server, server_queue),
+                            name="login server's handle_server"),
+        asyncio.create_task(AsyncioIncomingConnectionHandler(AuthCodeHandler(server_queue)).run(),
+                            name="login server's handle_authcodes"),
+        asyncio.create_task(AsyncioHttpHandler(server_queue, ports).run(),
+                            name="login server's handle_http"),
+        asyncio.create_task(AsyncioIncomingConnectionHandler(GameClientHandler(server_queue, dump_queue)).run(),
+                            name="login server's handle_game_client"),
+        asyncio.create_task(AsyncioIncomingConnectionHandler(GameServerLauncherHandler(server_queue, ports)).run(),
+                            name="login server's handle_game_server_launcher")
+    ]
+
+    try:
+        # Wait for any of the tasks to terminate
+        finished_tasks, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+        logger.error('The following tasks terminated: %s' % ','.join([t.get_name() for t in finished_tasks]))
+
+        exceptions = ['  %s' % t.exception() for t in finished_tasks
+                      if not t.cancelled() and isinstance(t.exception(), Exception)]
+        if exceptions:
+            logger.critical('\n' +
+                            '\n-------------------------------------------\n' +
+                            'The following exceptions occurred:\n' +
+                            '\n'.join(exceptions) +
+                            '\n-------------------------------------------\n'
+                            )
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Also reached when the login server is interrupted
+        logger.info('Writing the data of the players that are online...')
+        login_server.save_all_players()
+
+
+def run(args):
+    if args.backend == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            print('The uvloop backend requires the uvloop package to be installed', file=sys.stderr)
+            sys.exit(2)
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    accounts, config, ports = prepare_login_server()
+    logger = logging.getLogger(__name__)
+
+    try:
+        asyncio.run(run_login_server(args, accounts, config, ports))
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt received. Exiting...')
+    except Exception:
+        logger.exception('Main login server thread exited with an exception')
+    finally:
+        # Also when the login server stopped because of an error, the journal is compacted into the snapshot
+        accounts.close()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import logging
+import time
+
+# Priority classes of messages, from most to least urgent
+PRIORITY_CONTROL = 0
+PRIORITY_LOGIN = 1
+PRIORITY_CHAT = 2
+PRIORITY_BACKGROUND = 3
+PRIORITIES = (PRIORITY_CONTROL, PRIORITY_LOGIN, PRIORITY_CHAT, PRIORITY_BACKGROUND)
+
+
+class _PendingMessage:
+    __slots__ = ('received_time', 'message', 'peer', 'coalescing_key', 'dropped')
+
+    def __init__(self, received_time, message, peer, coalescing_key):
+        self.received_time = received_time
+        self.message = message
+        self.peer = peer
+        self.coalescing_key = coalescing_key
+        self.dropped = False
+
+
+class PriorityDispatcher:
+    """
+    Holds the messages that the login server still has to handle and hands
+    them out in batches, most urgent priority class first.
+
+    Messages from the same peer are always handled in the order in which
+    they were received. A message that would overtake an earlier message
+    of its peer gets the lower priority of that earlier message instead.
+
+    When the oldest pending message has waited longer than overload_age
+    seconds, the dispatcher goes into overload mode until the age drops
+    below half of that. In overload mode a message with a coalescing key
+    replaces a pending message of the same peer with the same key.
+    """
+
+    overload_age = 0.5
+    batch_size = 100
+
+    def __init__(self, handle_func, get_priority_func, get_coalescing_key_func):
+        self.logger = logging.getLogger(__name__)
+        self.handle_func = handle_func
+        self.get_priority_func = get_priority_func
+        self.get_coalescing_key_func = get_coalescing_key_func
+        self.queues = [collections.deque() for _ in PRIORITIES]
+        self.pending_count = 0
+        # Lowest priority class and number of pending messages per peer
+        self.pending_per_peer = {}
+        self.coalescable_messages = {}
+        self.overloaded = False
+
+        self.queue_age = 0.0
+        self.peak_queue_age = 0.0
+        self.overload_periods = 0
+        self.shed_counts = collections.Counter()
+
+    def has_pending(self):
+        return self.pending_count > 0
+
+    def add(self, message):
+        peer = getattr(message, 'peer', None)
+        priority = self.get_priority_func(message)
+        coalescing_key = self.get_coalescing_key_func(message) if peer is not None else None
+
+        if peer is not None:
+            peer_priority, peer_count = self.pending_per_peer.get(peer, (priority, 0))
+            priority = max(priority, peer_priority)
+            self.pending_per_peer[peer] = (priority, peer_count + 1)
+
+        pending_message = _PendingMessage(time.monotonic(), message, peer, coalescing_key)
+        if coalescing_key is not None:
+            key = (peer, coalescing_key)
+            if self.overloaded and key in self.coalescable_messages:
+                self._drop(self.coalescable_messages[key])
+            self.coalescable_messages[key] = pending_message
+
+        self.queues[priority].append(pending_message)
+        self.pending_count += 1
+
+    def dispatch_batch(self):
+        """ Handle at most batch_size of the pending messages """
+        self._update_overload_mode()
+        for _ in range(self.batch_size):
+            pending_message = self._take_next()
+            if pending_message is None:
+                break
+            self.handle_func(pending_message.message)
+
+    def get_statistics(self):
+        return {
+            'pending_messages': self.pending_count,
+            'queue_age': self.queue_age,
+            'peak_queue_age': self.peak_queue_age,
+            'overloaded': self.overloaded,
+            'overload_periods': self.overload_periods,
+            'shed_messages': dict(self.shed_counts)
+        }
+
+    def _drop(self, pending_message):
+        pending_message.dropped = True
+        key = pending_message.coalescing_key
+        self.shed_counts[key[0] if isinstance(key, tuple) else key] += 1
+
+    def _take_next(self):
+        for queue in self.queues:
+            while queue:
+                pending_message = queue.popleft()
+                self.pending_count -= 1
+                self._forget(pending_message)
+                if not pending_message.dropped:
+                    return pending_message
+        return None
+
+    def _forget(self, pending_message):
+        peer = pending_message.peer
+        if peer is None:
+            return
+
+        peer_priority, peer_count = self.pending_per_peer[peer]
+        if peer_count == 1:
+            del self.pending_per_peer[peer]
+        else:
+            self.pending_per_peer[peer] = (peer_priority, peer_count - 1)
+
+        if pending_message.coalescing_key is not None:
+            key = (peer, pending_message.coalescing_key)
+            if self.coalescable_messages.get(key) is pending_message:
+                del self.coalescable_messages[key]
+
+    def _update_overload_mode(self):
+        oldest_received_time = min((queue[0].received_time for queue in self.queues if queue), default=None)
+        self.queue_age = time.monotonic() - oldest_received_time if oldest_received_time is not None else 0.0
+        self.peak_queue_age = max(self.peak_queue_age, self.queue_age)
+
+        if not self.overloaded and self.queue_age > self.overload_age:
+            self.overloaded = True
+            self.overload_periods += 1
+            self.logger.warning('server: messages have been waiting for %.2f seconds; '
+                                'coalescing repeated requests until the backlog is gone' % self.queue_age)
+        elif self.overloaded and self.queue_age < self.overload_age / 2:
+            self.overloaded = False
+            self.logger.info('server: backlog is gone after shedding %d messages in total' %
+                             sum(self.shed_counts.values()))
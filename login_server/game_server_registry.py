@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+
+from common.statetracer import TracingDict
+
+
+class GameServerRegistry(TracingDict):
+    """
+    The game servers that are connected to the login server by server ID,
+    with indexes on match ID, game setting mode and region and a list of
+    the joinable servers sorted by server ID.
+
+    The version is increased on every change to the registry or to one of
+    the servers in it, so that anything that is derived from the game
+    servers only needs to be recalculated when the version has changed.
+    Changes that are not made to traced members of a game server must be
+    reported by calling changed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+        self.servers_by_match_id = {}
+        self.servers_by_game_setting_mode = {}
+        self.servers_by_region = {}
+        self.joinable_servers = []
+        self.joinable_server_ids = []
+        # The match ID, mode and region under which each server is currently indexed
+        self.server_keys = {}
+
+    def __setitem__(self, server_id, game_server):
+        assert server_id == game_server.server_id
+        if server_id in self:
+            self._remove_from_indexes(self[server_id])
+        super().__setitem__(server_id, game_server)
+        self._add_to_indexes(game_server)
+        self.changed()
+
+    def __delitem__(self, server_id):
+        self._remove_from_indexes(self[server_id])
+        super().__delitem__(server_id)
+        self.changed()
+
+    def pop(self, server_id, *args):
+        if server_id in self:
+            self._remove_from_indexes(self[server_id])
+            self.changed()
+        return super().pop(server_id, *args)
+
+    def changed(self):
+        self.version += 1
+
+    def find_by_match_id(self, match_id):
+        return self.servers_by_match_id.get(match_id)
+
+    def find_by_game_setting_mode(self, game_setting_mode):
+        return list(self.servers_by_game_setting_mode.get(game_setting_mode, ()))
+
+    def find_by_region(self, region):
+        return list(self.servers_by_region.get(region, ()))
+
+    def _add_to_indexes(self, game_server):
+        self._index(game_server)
+        game_server._state_tracer.add_observer(self._server_changed)
+
+    def _remove_from_indexes(self, game_server):
+        game_server._state_tracer.remove_observer(self._server_changed)
+        self._unindex(game_server)
+
+    def _index(self, game_server):
+        keys = (game_server.match_id, game_server.game_setting_mode, game_server.region)
+        self.server_keys[game_server] = keys
+        self.servers_by_match_id[keys[0]] = game_server
+        self.servers_by_game_setting_mode.setdefault(keys[1], {})[game_server] = None
+        self.servers_by_region.setdefault(keys[2], {})[game_server] = None
+        if game_server.joinable:
+            self._add_joinable(game_server)
+
+    def _unindex(self, game_server):
+        match_id, game_setting_mode, region = self.server_keys.pop(game_server)
+        del self.servers_by_match_id[match_id]
+        self._remove_from_index(self.servers_by_game_setting_mode, game_setting_mode, game_server)
+        self._remove_from_index(self.servers_by_region, region, game_server)
+        self._remove_joinable(game_server)
+
+    @staticmethod
+    def _remove_from_index(index, key, game_server):
+        servers = index[key]
+        del servers[game_server]
+        if not servers:
+            del index[key]
+
+    def _add_joinable(self, game_server):
+        position = bisect.bisect_left(self.joinable_server_ids, game_server.server_id)
+        self.joinable_server_ids.insert(position, game_server.server_id)
+        self.joinable_servers.insert(position, game_server)
+
+    def _remove_joinable(self, game_server):
+        position = bisect.bisect_left(self.joinable_server_ids, game_server.server_id)
+        if position < len(self.joinable_servers) and self.joinable_servers[position] is game_server:
+            del self.joinable_server_ids[position]
+            del self.joinable_servers[position]
+
+    def _server_changed(self, game_server, member_name, old_value, new_value):
+        if member_name in ('match_id', 'game_setting_mode', 'region'):
+            self._unindex(game_server)
+            self._index(game_server)
+        elif member_name == 'joinable':
+            self._remove_joinable(game_server)
+            if new_value:
+                self._add_joinable(game_server)
+        self.changed()
@@ -24,11 +24,12 @@ from .player.player import Player
 
 
 class GameClientHandler(IncomingConnectionHandler):
-    def __init__(self, incoming_queue, dump_queue):
+    def __init__(self, incoming_queue, dump_queue, single_greenlet = False):
         super().__init__('gameclient',
                          '0.0.0.0',
                          9000,
-                         incoming_queue)
+                         incoming_queue,
+                         single_greenlet = single_greenlet)
         self.dump_queue = dump_queue
 
     def create_connection_instances(self, sock, address):
@@ -38,6 +39,6 @@ class GameClientHandler(IncomingConnectionHandler):
         return reader, writer, peer
 
 
-def handle_game_client(incoming_queue, dump_queue):
-    game_client_handler = GameClientHandler(incoming_queue, dump_queue)
+def handle_game_client(incoming_queue, dump_queue, single_greenlet = False):
+    game_client_handler = GameClientHandler(incoming_queue, dump_queue, single_greenlet)
     game_client_handler.run()
@@ -18,9 +18,6 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import gevent.monkey
-gevent.monkey.patch_all()
-
 import datetime
 import json
 import logging
@@ -28,9 +25,8 @@ import time
 import urllib.request
 
 
-from common.connectionhandler import Peer
+from common.connectionhandler import Peer, OutgoingQueueLimits, OVERFLOW_POLICY_DROP
 from common.datatypes import *
-from common.firewall import FirewallClient
 from common.messages import Login2LauncherNextMapMessage, \
                             Login2LauncherSetPlayerLoadoutsMessage, \
                             Login2LauncherRemovePlayerLoadoutsMessage, \
@@ -38,21 +34,75 @@ from common.messages import Login2LauncherNextMapMessage, \
                             Login2LauncherRemovePlayer, \
                             Login2LauncherPings
 from common.statetracer import statetracer, TracingDict
+from .player.player import send_to_players
 from .player.state.unauthenticated_state import UnauthenticatedState
 from .player.state.authenticated_state import AuthenticatedState
 
 PING_UPDATE_TIME = 3
-
-
-@statetracer('server_id', 'detected_ip', 'address_pair', 'port', 'game_setting_mode', 'joinable',
+REGION_LOOKUP_TIMEOUT = 5
+
+
+class GameServerRegionMessage():
+    def __init__(self, game_server, region):
+        self.game_server = game_server
+        self.region = region
+
+
+def lookup_region(ip: IPv4Address):
+    """
+    Look up on which continent a game server is and return its region, or
+    REGION_EUROPE if that cannot be determined. This waits for a web service
+    for up to REGION_LOOKUP_TIMEOUT seconds, so it must not be called in the
+    task that handles the server queue.
+    """
+    if not ip.is_global:
+        return REGION_EUROPE
+
+    continent_code_to_region = {
+        'NA': REGION_NORTH_AMERICA,
+        'EU': REGION_EUROPE,
+        'OC': REGION_OCEANIA_AUSTRALIA
+    }
+    try:
+        response = urllib.request.urlopen('http://tools.keycdn.com/geo.json?host=%s' % ip,
+                                          timeout=REGION_LOOKUP_TIMEOUT)
+        json_result = json.loads(response.read())
+    except (OSError, ValueError) as e:
+        logging.getLogger(__name__).warning('Unable to look up the region of game server %s: %s' % (ip, e))
+        return REGION_EUROPE
+
+    try:
+        return continent_code_to_region[json_result['data']['geo']['continent_code']]
+    except (KeyError, TypeError):
+        return REGION_EUROPE
+
+
+def _create_map_started_template():
+    message = a00b4()
+    message.findbytype(m042a).set(3)
+    message.content.append(m02ff())
+    return MessageTemplate(message,
+                           server_id=message.findbytype(m02c7),
+                           match_id=message.findbytype(m02c4),
+                           unique_id=message.findbytype(m0348))
+
+
+_map_started_template = _create_map_started_template()
+
+
+@statetracer('server_id', 'match_id', 'detected_ip', 'address_pair', 'port', 'region', 'game_setting_mode', 'joinable',
              'players', 'player_being_kicked', 'match_end_time_rel_or_abs', 'match_time_counting',
              'be_score', 'ds_score', 'map_id', )
 class GameServer(Peer):
-    def __init__(self, detected_ip: IPv4Address, ports):
+    # Pings are sent periodically, so a newer one will replace any that is dropped
+    outgoing_queue_limits = OutgoingQueueLimits(max_messages=1000,
+                                                policy=OVERFLOW_POLICY_DROP,
+                                                is_droppable=lambda msg: isinstance(msg, Login2LauncherPings))
+
+    def __init__(self, detected_ip: IPv4Address):
         super().__init__()
 
         self.logger = logging.getLogger(__name__)
-        self.firewall = FirewallClient(ports)
         self.login_server = None
         self.server_id = None
         self.match_id = None
@@ -63,7 +113,8 @@ class GameServer(Peer):
         self.description = None
         self.motd = None
         self.password_hash = None
-        self.region = None
+        # Until the lookup of the real region is done
+        self.region = REGION_EUROPE
 
         self.game_setting_mode = 'ootb'
 
@@ -78,23 +129,6 @@ class GameServer(Peer):
 
         self.start_time = None
 
-        if self.detected_ip.is_global:
-            response = urllib.request.urlopen('http://tools.keycdn.com/geo.json?host=%s' % self.detected_ip)
-            result = response.read()
-            json_result = json.loads(result)
-
-            continent_code_to_region = {
-                'NA': REGION_NORTH_AMERICA,
-                'EU': REGION_EUROPE,
-                'OC': REGION_OCEANIA_AUSTRALIA
-            }
-            try:
-                self.region = continent_code_to_region[json_result['data']['geo']['continent_code']]
-            except KeyError:
-                self.region = REGION_EUROPE
-        else:
-            self.region = REGION_EUROPE
-
     def __str__(self):
         return 'GameServer(%d)' % self.server_id
 
@@ -105,6 +139,7 @@ class GameServer(Peer):
 
     def set_address_info(self, address_pair):
         self.address_pair = address_pair
+        self._server_list_info_changed()
         self.send_pings()
 
     def set_info(self, description: str, motd: str, game_setting_mode: str, password_hash: bytes):
@@ -112,6 +147,20 @@ class GameServer(Peer):
         self.motd = motd
         self.game_setting_mode = game_setting_mode
         self.password_hash = password_hash
+        self._server_list_info_changed()
+
+    def set_region(self, region):
+        self.region = region
+        self._server_list_info_changed()
+
+    def set_map_id(self, map_id):
+        self.map_id = map_id
+        self._server_list_info_changed()
+
+    def set_scores(self, be_score, ds_score):
+        self.be_score = be_score
+        self.ds_score = ds_score
+        self._server_list_info_changed()
 
     def set_match_time(self, seconds_remaining, counting):
         self.match_time_counting = counting
@@ -130,14 +179,14 @@ class GameServer(Peer):
             self.start_time = datetime.datetime.utcnow()
 
             for unique_id, player in self.players.items():
-                b4msg = a00b4().set_server(self).set_player(unique_id)
-                b4msg.findbytype(m042a).set(3)
-                b4msg.content.append(m02ff())
-                player.send(b4msg)
+                player.send(_map_started_template.render(server_id=self.server_id,
+                                                         match_id=self.match_id,
+                                                         unique_id=unique_id))
 
             self.send(Login2LauncherNextMapMessage())
         else:
             self.joinable = False
+        self._server_list_info_changed()
 
     def get_time_remaining(self):
         if self.match_end_time_rel_or_abs is not None:
@@ -156,6 +205,7 @@ class GameServer(Peer):
     def add_player(self, player):
         assert player.unique_id not in self.players
         self.players[player.unique_id] = player
+        self._server_list_info_changed()
         player.vote = None
         player_ip = player.address_pair.get_address_seen_from(self.address_pair)
         msg = Login2LauncherAddPlayer(player.unique_id,
@@ -167,19 +217,23 @@ class GameServer(Peer):
     def remove_player(self, player):
         assert player.unique_id in self.players
         del self.players[player.unique_id]
+        self._server_list_info_changed()
         player_ip = player.address_pair.get_address_seen_from(self.address_pair)
         msg = Login2LauncherRemovePlayer(player.unique_id,
                                          str(player_ip) if player_ip is not None else '')
         self.send(msg)
 
+    def _server_list_info_changed(self):
+        # Match time is not included, because the time remaining is
+        # filled in every time the server list is sent
+        self.login_server.server_list_cache.invalidate(self)
+        self.login_server.game_servers.changed()
+
     def send_all_players(self, data):
-        for player in self.players.values():
-            player.send(data)
+        send_to_players(self.players.values(), data)
 
     def send_all_players_on_team(self, data, team):
-        for player in self.players.values():
-            if player.team == team:
-                player.send(data)
+        send_to_players(self.login_server.players.find_by_team(self, team), data)
 
     def set_player_loadouts(self, player):
         assert player.unique_id in self.players
@@ -291,10 +345,11 @@ class GameServer(Peer):
             player_to_kick.set_state(UnauthenticatedState)
 
             ip_to_ban_on_login_server = player_to_kick.address_pair.get_address_seen_from(self.login_server.address_pair)
-            self.firewall.modify_firewall('blacklist', 'add', player_to_kick.unique_id, ip_to_ban_on_login_server)
+            firewall = self.login_server.firewall
+            firewall.modify_firewall('blacklist', 'add', player_to_kick.unique_id, ip_to_ban_on_login_server)
 
             def remove_blacklist_rule():
-                self.firewall.modify_firewall('blacklist', 'remove', player_to_kick.unique_id, ip_to_ban_on_login_server)
+                firewall.modify_firewall('blacklist', 'remove', player_to_kick.unique_id, ip_to_ban_on_login_server)
 
             self.login_server.pending_callbacks.add(self.login_server, 8 * 3600, remove_blacklist_rule)
 
@@ -42,12 +42,11 @@ class GameServerLauncherHandler(IncomingConnectionHandler):
                          '0.0.0.0',
                          ports['launcher2login'],
                          incoming_queue)
-        self.ports = ports
 
     def create_connection_instances(self, sock, address):
         reader = GameServerLauncherReader(sock)
         writer = GameServerLauncherWriter(sock)
-        peer = GameServer(IPv4Address(address[0]), self.ports)
+        peer = GameServer(IPv4Address(address[0]))
         return reader, writer, peer
 
 
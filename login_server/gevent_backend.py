@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2018  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+# 
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Only import this module after gevent's monkey patching has been applied
+
+import gevent
+import gevent.queue
+import gevent.threadpool
+import logging
+
+from common.geventwrapper import gevent_spawn
+from .authcodehandler import handle_authcodes
+from .gameserverlauncherhandler import handle_game_server_launcher
+from .gameclienthandler import handle_game_client
+from .httphandler import handle_http
+from .trafficdumper import TrafficDumper
+from .loginserver import LoginServer
+from .startup import prepare_login_server, get_login_server_options, create_player_data_writer
+from .webhookhandler import handle_webhook
+
+
+def handle_dump(dumpqueue):
+    gevent.getcurrent().name = 'trafficdumper'
+    if dumpqueue:
+        traffic_dumper = TrafficDumper(dumpqueue)
+        traffic_dumper.run()
+
+
+def handle_server(server, server_queue):
+    # server.trace_as('loginserver')
+    gevent.getcurrent().name = 'loginserver'
+    server.start()
+    while True:
+        if not server.dispatcher.has_pending():
+            server.dispatcher.add(server_queue.get())
+        server.dispatch_queued_messages()
+        # Let the connections send and receive before the next batch
+        gevent.sleep(0)
+
+
+def run_in_greenlet(func, callback=None):
+    # With the monkey patching, blocking calls in func only block its own greenlet
+    def run():
+        result = func()
+        if callback is not None:
+            callback(result)
+
+    gevent_spawn('login server background work', run)
+
+
+def run(args):
+    logger = logging.getLogger(__name__)
+    accounts, config, ports = prepare_login_server(gevent.threadpool.ThreadPoolExecutor)
+
+    client_queues = {}
+    server_queue = gevent.queue.Queue()
+    server_stats_queue = gevent.queue.Queue()
+    dump_queue = gevent.queue.Queue() if args.dump else None
+
+    # Player data is written (and the accounts are compacted) from gevent's native
+    # threads, because the monkey patched threads of concurrent.futures would block
+    # the other greenlets
+    data_writer = create_player_data_writer(config, gevent.threadpool.ThreadPoolExecutor)
+    server = LoginServer(server_queue, client_queues, server_stats_queue, ports, accounts,
+                         run_in_background=run_in_greenlet, data_writer=data_writer,
+                         **get_login_server_options(config))
+
+    tasks = [
+        gevent_spawn("login server's handle_server",
+                     handle_server,
+                     server,
+                     server_queue),
+        gevent_spawn("login server's handle_authcodes",
+                     handle_authcodes,
+                     server_queue),
+        gevent_spawn("login server's handle_webhook",
+                     handle_webhook,
+                     server_stats_queue,
+                     config['loginserver']),
+        gevent_spawn("login server's handle_http",
+                     handle_http,
+                     server_queue,
+                     ports),
+        gevent_spawn("login server's handle_game_client",
+                     handle_game_client,
+                     server_queue, dump_queue, args.single_greenlet_connections),
+        gevent_spawn("login server's handle_game_server_launcher",
+                     handle_game_server_launcher,
+                     server_queue,
+                     ports)
+    ]
+    # Give the greenlets enough time to start up, otherwise killall can block
+    gevent.sleep(1)
+
+    if dump_queue:
+        tasks.append(gevent_spawn("login server's handle_dump", handle_dump, dump_queue))
+
+    try:
+        # Wait for any of the tasks to terminate
+        finished_greenlets = gevent.joinall(tasks, count=1)
+
+        logger.error('The following greenlets terminated: %s' % ','.join([g.name for g in finished_greenlets]))
+
+        exceptions = ['  %s' % g.exception for g in finished_greenlets
+                                if isinstance(g.exception, Exception)]
+        if exceptions:
+            logger.critical('\n' +
+                            '\n-------------------------------------------\n' +
+                            'The following exceptions occurred:\n' +
+                            '\n'.join(exceptions) +
+                            '\n-------------------------------------------\n'
+                            )
+
+        if dump_queue:
+            logger.info('Giving the dump greenlet some time to finish writing to disk...')
+            gevent.sleep(2)
+
+        logger.info('Killing everything and waiting 10 seconds before exiting...')
+        gevent.killall(tasks)
+        server.save_all_players()
+        gevent.sleep(5)
+
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt received. Exiting...')
+        gevent.killall(tasks)
+        server.save_all_players()
+    except Exception:
+        logger.exception('Main login server thread exited with an exception')
+    finally:
+        # Also when the login server stopped because of an error, the journal is compacted into the snapshot
+        accounts.close()
@@ -18,13 +18,27 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import gevent.queue
 from gevent import pywsgi
 import logging
+import urllib.parse
 
 from common.datatypes import HttpRequestMessage
 
 
+def _create_response(response):
+    """ Return the status and the body to reply with for a response from the login server """
+    if isinstance(response, Exception):
+        logger = logging.getLogger(__name__)
+        logger.exception('an exception was encountered while processing a http request:', exc_info=response)
+        raise response
+    elif response:
+        return '200 OK', response.encode()
+    else:
+        return '404 Not Found', b'<h1>Not Found</h1>'
+
+
 class HttpHandler:
     def __init__(self, incoming_queue, ports):
         self.ports = ports
@@ -35,16 +49,9 @@ class HttpHandler:
         self.incoming_queue.put(HttpRequestMessage(self, env))
         response = self.response_queue.get()
 
-        if isinstance(response, Exception):
-            logger = logging.getLogger(__name__)
-            logger.exception('an exception was encountered while processing a http request:', exc_info=response)
-            raise response
-        elif response:
-            start_response('200 OK', [('Content-Type', 'text/html')])
-            return [response.encode()]
-        else:
-            start_response('404 Not Found', [('Content-Type', 'text/html')])
-            return [b'<h1>Not Found</h1>']
+        status, body = _create_response(response)
+        start_response(status, [('Content-Type', 'text/html')])
+        return [body]
 
     def send_response(self, response):
         self.response_queue.put(response)
@@ -58,6 +65,66 @@ class HttpHandler:
         server.serve_forever()
 
 
+class _AsyncioHttpRequest:
+    """ The peer of a request to the AsyncioHttpHandler, which receives the response of the login server """
+    def __init__(self):
+        self.response = asyncio.get_running_loop().create_future()
+
+    def send_response(self, response):
+        if not self.response.done():
+            self.response.set_result(response)
+
+    def disconnect(self, e):
+        self.send_response(e)
+
+
+class AsyncioHttpHandler:
+    """
+    Serves the same requests as the HttpHandler, but on an asyncio event loop.
+    Only the request line of a request is used, like the login server does.
+    """
+    def __init__(self, incoming_queue, ports):
+        self.ports = ports
+        self.incoming_queue = incoming_queue
+
+    async def handle_connection(self, stream_reader, stream_writer):
+        try:
+            request_line = await stream_reader.readline()
+            while (await stream_reader.readline()).strip():
+                pass
+
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            path, _, query = target.partition('?')
+            env = {
+                'REQUEST_METHOD': method,
+                'PATH_INFO': urllib.parse.unquote(path),
+                'QUERY_STRING': query
+            }
+
+            request = _AsyncioHttpRequest()
+            self.incoming_queue.put(HttpRequestMessage(request, env))
+            try:
+                status, body = _create_response(await request.response)
+            except Exception:
+                status, body = '500 Internal Server Error', b'<h1>Internal Server Error</h1>'
+
+            stream_writer.write(('HTTP/1.1 %s\r\n'
+                                 'Content-Type: text/html\r\n'
+                                 'Content-Length: %d\r\n'
+                                 'Connection: close\r\n'
+                                 '\r\n' % (status, len(body))).encode('latin-1') + body)
+            await stream_writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            stream_writer.close()
+
+    async def run(self):
+        server = await asyncio.start_server(self.handle_connection, '0.0.0.0', self.ports['restapi'])
+        async with server:
+            await server.serve_forever()
+
+
 def handle_http(incoming_queue, ports):
     http_handler = HttpHandler(incoming_queue, ports)
     http_handler.run()
@@ -19,44 +19,77 @@
 #
 
 from distutils.version import StrictVersion
-import gevent
 import logging
 import random
 import string
 
-from common.connectionhandler import PeerConnectedMessage, PeerDisconnectedMessage
+from common.connectionhandler import PeerConnectedMessage, PeerDisconnectedMessage, outgoing_queue_statistics
 from common.datatypes import *
 from common.firewall import FirewallClient
 from common.ipaddresspair import IPAddressPair
 from common.loginprotocol import LoginProtocolMessage
 from common.messages import *
-from common.statetracer import statetracer, TracingDict
+from common.statetracer import statetracer
 from common.versions import launcher2loginserver_protocol_version
 from .authcodehandler import AuthCodeRequester
-from .gameserver import GameServer
+from .dispatcher import PriorityDispatcher, PRIORITY_CONTROL, PRIORITY_LOGIN, PRIORITY_CHAT, PRIORITY_BACKGROUND
+from .gameserver import GameServer, GameServerRegionMessage, lookup_region
+from .game_server_registry import GameServerRegistry
+from .persistence import JsonFilePlayerStore, WriteBehindWriter
 from common.pendingcallbacks import PendingCallbacks, ExecuteCallbackMessage
 from .player.player import Player
+from .player_registry import PlayerRegistry
 from .player.state.offline_state import OfflineState
 from .player.state.unauthenticated_state import UnauthenticatedState
 from .protocol_errors import ProtocolViolationError
+from .server_list_cache import ServerListCache
 from .social_network import SocialNetwork
 from common import utils
 
 
+def _run_directly(func, callback=None):
+    result = func()
+    if callback is not None:
+        callback(result)
+
+
 @statetracer('address_pair', 'game_servers', 'players')
 class LoginServer:
-    def __init__(self, server_queue, client_queues, server_stats_queue, ports, accounts):
+    def __init__(self, server_queue, client_queues, server_stats_queue, ports, accounts, call_later=None,
+                 run_in_background=None, data_writer=None, presence_coalescing_window=0,
+                 player_checkpoint_interval=0):
+        """
+        The task that handles the server queue is run by the backend, which
+        passes every message it takes from the queue to the dispatcher and then
+        calls dispatch_queued_messages.
+
+        :param call_later: function with the signature of asyncio's
+                           loop.call_later to schedule callbacks with, instead
+                           of running a greenlet for them
+        :param run_in_background: function that takes a function that may block
+                                  and an optional callback. It runs the function
+                                  without blocking the task that handles the server
+                                  queue and passes the result to the callback in
+                                  that task. Without it the function is run directly.
+        """
         self.logger = logging.getLogger(__name__)
         self.server_queue = server_queue
         self.client_queues = client_queues
         self.server_stats_queue = server_stats_queue
 
-        self.game_servers = TracingDict()
+        self.game_servers = GameServerRegistry()
+        self.server_ids = utils.IdAllocator(1)
+        self.server_stats_version = None
+        self.server_list_cache = ServerListCache()
 
-        self.players = TracingDict()
-        self.social_network = SocialNetwork()
-        self.firewall = FirewallClient(ports)
+        self.players = PlayerRegistry()
+        # Players get a temporary ID until they have logged in to an account
+        self.player_ids = utils.IdAllocator(10000000)
+        self.run_in_background = run_in_background if run_in_background is not None else _run_directly
+        self.firewall = FirewallClient(ports, self.run_in_background)
         self.accounts = accounts
+        self.data_writer = data_writer if data_writer is not None else WriteBehindWriter(JsonFilePlayerStore())
+        self.player_checkpoint_interval = player_checkpoint_interval
         self.message_handlers = {
             AuthCodeRequestMessage: self.handle_authcode_request_message,
             ExecuteCallbackMessage: self.handle_execute_callback_message,
@@ -73,8 +106,12 @@ class LoginServer:
             Launcher2LoginMatchTimeMessage: self.handle_match_time_message,
             Launcher2LoginServerReadyMessage: self.handle_server_ready_message,
             Launcher2LoginMatchEndMessage: self.handle_match_end_message,
+            GameServerRegionMessage: self.handle_game_server_region_message,
         }
-        self.pending_callbacks = PendingCallbacks(server_queue)
+        self.pending_callbacks = PendingCallbacks(server_queue, call_later)
+        self.social_network = SocialNetwork(self.pending_callbacks, presence_coalescing_window)
+        self.dispatcher = PriorityDispatcher(self.handle_message, self.get_message_priority,
+                                             self.get_message_coalescing_key)
 
         self.address_pair, errormsg = IPAddressPair.detect()
         if not self.address_pair.external_ip:
@@ -85,36 +122,80 @@ class LoginServer:
         else:
             self.logger.info('server: detected external IP: %s' % self.address_pair.external_ip)
 
-    def run(self):
-        gevent.getcurrent().name = 'loginserver'
+    def start(self):
         self.logger.info('server: login server started')
         self.firewall.reset_firewall('blacklist')
-        while True:
-            for message in self.server_queue:
-                handler = self.message_handlers[type(message)]
-                try:
-                    handler(message)
-                except Exception as e:
-                    if hasattr(message, 'peer'):
-                        self.logger.error('server: an exception occurred while handling a message; passing it on to the peer...')
-                        message.peer.disconnect(e)
-                    else:
-                        raise
+
+    def save_all_players(self):
+        """ Save the players that are online and wait until all their data has been written """
+        for player in self.players.values():
+            player.save()
+        self.data_writer.close()
+
+    def dispatch_queued_messages(self):
+        """ Take everything out of the server queue and handle the most urgent batch of it """
+        while not self.server_queue.empty():
+            self.dispatcher.add(self.server_queue.get_nowait())
+        self.dispatcher.dispatch_batch()
+
+    def get_message_priority(self, message):
+        if isinstance(message, LoginProtocolMessage):
+            if all(isinstance(request, (a01c8, a00d5)) for request in message.requests):
+                return PRIORITY_BACKGROUND
+            elif all(isinstance(request, a0070) for request in message.requests):
+                return PRIORITY_CHAT
+            else:
+                return PRIORITY_LOGIN
+        elif isinstance(message, HttpRequestMessage):
+            # Status requests are how a login server under load is monitored, so they must not wait behind it
+            return PRIORITY_CONTROL
+        elif isinstance(message, (PeerConnectedMessage, PeerDisconnectedMessage)):
+            return PRIORITY_CONTROL if isinstance(message.peer, GameServer) else PRIORITY_LOGIN
+        elif isinstance(message, (AuthCodeRequestMessage, ExecuteCallbackMessage)):
+            return PRIORITY_LOGIN
+        else:
+            # Messages from game server launchers and about game servers
+            return PRIORITY_CONTROL
+
+    def get_message_coalescing_key(self, message):
+        """ Pings and server list requests only need to be answered once when several are waiting """
+        if isinstance(message, LoginProtocolMessage) and len(message.requests) == 1:
+            request = message.requests[0]
+            if isinstance(request, a01c8):
+                return 'a01c8'
+            elif isinstance(request, a00d5):
+                list_type = request.findbytype(m0228)
+                return 'a00d5', list_type.value if list_type is not None else None
+        return None
+
+    def handle_message(self, message):
+        handler = self.message_handlers[type(message)]
+        try:
+            handler(message)
+        except Exception as e:
+            if hasattr(message, 'peer'):
+                self.logger.error('server: an exception occurred while handling a message; passing it on to the peer...')
+                message.peer.disconnect(e)
+            else:
+                raise
 
     def all_game_servers(self):
         return self.game_servers
 
+    def joinable_game_servers(self):
+        return self.game_servers.joinable_servers
+
     def find_server_by_id(self, server_id):
-        for game_server in self.all_game_servers().values():
-            if game_server.server_id == server_id:
-                return game_server
-        raise ProtocolViolationError('No server found with specified server ID')
+        game_server = self.game_servers.get(server_id)
+        if game_server is None:
+            raise ProtocolViolationError('No server found with specified server ID')
+        return game_server
 
     def find_server_by_match_id(self, match_id):
-        for game_server in self.all_game_servers().values():
-            if game_server.match_id == match_id:
-                return game_server
-        raise ProtocolViolationError('No server found with specified match ID')
+        game_server = self.game_servers.find_by_match_id(match_id)
+        if game_server is None:
+            raise ProtocolViolationError('No server found with specified match ID')
+        return game_server
 
     def find_player_by(self, **kwargs):
         matching_players = self.find_players_by(**kwargs)
@@ -125,19 +206,10 @@ class LoginServer:
         return matching_players[0] if matching_players else None
 
     def find_players_by(self, **kwargs):
-        matching_players = self.players.values()
-        for key, val in kwargs.items():
-            matching_players = [player for player in matching_players if getattr(player, key) == val]
-
-        return matching_players
+        return self.players.find_players_by(**kwargs)
 
     def find_player_by_display_name(self, display_name):
-        matching_players = [p for p in self.players.values()
-                            if p.display_name is not None and p.display_name.lower() == display_name.lower()]
-        if matching_players:
-            return matching_players[0]
-        else:
-            return None
+        return self.players.find_by_display_name(display_name)
 
     def change_player_unique_id(self, old_id, new_id):
         if new_id in self.players:
@@ -147,9 +219,16 @@ class LoginServer:
         assert new_id not in self.players
 
         player = self.players.pop(old_id)
+        self.player_ids.release(old_id)
+        self.player_ids.reserve(new_id)
         player.unique_id = new_id
         self.players[new_id] = player
 
+    def start_region_lookup(self, game_server):
+        """ Look up the region of a game server in the background and post it to the server queue """
+        self.run_in_background(lambda: lookup_region(game_server.detected_ip),
+                               lambda region: self.server_queue.put(GameServerRegionMessage(game_server, region)))
+
     def validate_username(self, username):
         if len(username) < Player.min_name_length:
             return 'User name is too short, min length is %d characters.' % Player.min_name_length
@@ -168,11 +247,15 @@ class LoginServer:
         return None
 
     def send_server_stats(self):
+        if self.server_stats_version == self.game_servers.version:
+            return
+        self.server_stats_version = self.game_servers.version
+
         stats = [
             {'locked':      gs.password_hash is not None,
              'mode':        gs.game_setting_mode,
              'description': gs.description,
-             'nplayers':    len(gs.players)} for gs in self.game_servers.values() if gs.joinable
+             'nplayers':    len(gs.players)} for gs in self.joinable_game_servers()
         ]
         self.server_stats_queue.put(stats)
 
@@ -189,16 +272,14 @@ class LoginServer:
             authcode = ''.join([random.choice(availablechars) for i in range(8)])
             self.logger.info('server: authcode requested for %s, returned %s' % (msg.login_name, authcode))
             self.accounts.add_account(msg.login_name, authcode)
-            self.accounts.save()
             authcode_requester.send(authcode)
 
     def handle_execute_callback_message(self, msg):
-        callback_id = msg.callback_id
-        self.pending_callbacks.execute(callback_id)
+        self.pending_callbacks.execute(msg.callbacks)
 
     def handle_client_connected_message(self, msg):
         if isinstance(msg.peer, Player):
-            unique_id = utils.first_unused_number_above(self.players.keys(), 10000000)
+            unique_id = self.player_ids.allocate()
 
             player = msg.peer
             player.friends.connect_to_social_network(self.social_network)
@@ -208,7 +289,7 @@ class LoginServer:
             player.set_state(UnauthenticatedState)
             self.players[unique_id] = player
         elif isinstance(msg.peer, GameServer):
-            server_id = utils.first_unused_number_above(self.all_game_servers().keys(), 1)
+            server_id = self.server_ids.allocate()
 
             game_server = msg.peer
             game_server.server_id = server_id
@@ -217,6 +298,8 @@ class LoginServer:
             game_server.login_server = self
 
             self.game_servers[server_id] = game_server
+            self.server_list_cache.invalidate(game_server)
+            self.start_region_lookup(game_server)
 
             self.logger.info('server: added game server %s (%s)' % (server_id, game_server.detected_ip))
         elif isinstance(msg.peer, AuthCodeRequester):
@@ -231,6 +314,7 @@ class LoginServer:
             self.pending_callbacks.remove_receiver(player)
             player.set_state(OfflineState)
             del(self.players[player.unique_id])
+            self.player_ids.release(player.unique_id)
 
         elif isinstance(msg.peer, GameServer):
             game_server = msg.peer
@@ -240,6 +324,8 @@ class LoginServer:
             game_server.disconnect()
             self.pending_callbacks.remove_receiver(game_server)
             del (self.game_servers[game_server.server_id])
+            self.server_ids.release(game_server.server_id)
+            self.server_list_cache.invalidate(game_server)
 
         elif isinstance(msg.peer, AuthCodeRequester):
             msg.peer.disconnect()
@@ -261,11 +347,25 @@ class LoginServer:
         if msg.env['PATH_INFO'] == '/status':
             msg.peer.send_response(json.dumps({
                 'online_players': len(self.players),
-                'online_servers': len(self.game_servers)
+                'online_servers': len(self.game_servers),
+                'game_servers_version': self.game_servers.version,
+                'outgoing_queues': outgoing_queue_statistics.to_dict(),
+                'player_data_writer': self.data_writer.get_statistics(),
+                'accounts': self.accounts.get_statistics(),
+                'server_queue': self.dispatcher.get_statistics(),
+                'social_network': self.social_network.get_statistics()
             }, sort_keys = True, indent = 4))
         else:
             msg.peer.send_response(None)
 
+    def handle_game_server_region_message(self, msg):
+        game_server = msg.game_server
+        # The game server may have disconnected during the lookup
+        if self.game_servers.get(game_server.server_id) is game_server:
+            game_server.set_region(msg.region)
+            self.logger.info('server: region of game server %s (%s) is %s' %
+                             (game_server.server_id, game_server.detected_ip, msg.region))
+
     def handle_launcher_protocol_version_message(self, msg):
         launcher_version = StrictVersion(msg.version)
         my_version = launcher2loginserver_protocol_version
@@ -304,7 +404,7 @@ class LoginServer:
 
     def handle_map_info_message(self, msg):
         game_server = msg.peer
-        game_server.map_id = msg.map_id
+        game_server.set_map_id(msg.map_id)
 
     def handle_team_info_message(self, msg):
         game_server = msg.peer
@@ -316,11 +416,11 @@ class LoginServer:
                 self.logger.warning('server: received an invalid message from server %s about '
                                     'player %d while that player is not on that server' %
                                     (game_server.server_id, player_id))
+        self.server_list_cache.invalidate(game_server)
 
     def handle_score_info_message(self, msg):
         game_server = msg.peer
-        game_server.be_score = msg.be_score
-        game_server.ds_score = msg.ds_score
+        game_server.set_scores(msg.be_score, msg.ds_score)
 
     def handle_match_time_message(self, msg):
         game_server = msg.peer
@@ -351,7 +451,8 @@ class LoginServer:
                 # Cap playtime by the time the server has been active
                 time_played = min(time_played, server_uptime)
                 # Calculate and save the player's earned XP from this map
-                player.player_settings.progression.earn_xp(time_played, was_win)
+                player.player_settings.earn_xp(time_played, was_win)
+                player.save()
 
                 # Update the XP in the UI
                 player.send(a006d().set([
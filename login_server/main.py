@@ -18,143 +18,33 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from gevent import monkey
-monkey.patch_all()
-
 import argparse
-import configparser
-import gevent
-import gevent.queue
-import logging
-import os
-import sys
-
-from common.geventwrapper import gevent_spawn
-from common.logging import set_up_logging
-from common.migration_mechanism import run_migrations
-from common.ports import Ports
-from common.utils import SHARED_INI_PATH
-from .accounts import Accounts
-from .authcodehandler import handle_authcodes
-from .gameserverlauncherhandler import handle_game_server_launcher
-from .gameclienthandler import handle_game_client
-from .httphandler import handle_http
-from .trafficdumper import TrafficDumper, dumpfilename
-from .loginserver import LoginServer
-from .webhookhandler import handle_webhook
-
-INI_PATH = os.path.join('data', 'loginserver.ini')
-
 
-def handle_dump(dumpqueue):
-    gevent.getcurrent().name = 'trafficdumper'
-    if dumpqueue:
-        traffic_dumper = TrafficDumper(dumpqueue)
-        traffic_dumper.run()
+from .trafficdumper import dumpfilename
 
-
-def handle_server(server_queue, client_queues, server_stats_queue, ports, accounts):
-    server = LoginServer(server_queue, client_queues, server_stats_queue, ports, accounts)
-    # server.trace_as('loginserver')
-    server.run()
+BACKENDS = ('gevent', 'asyncio', 'uvloop')
 
 
 def main():
-    set_up_logging('login_server.log')
-    logger = logging.getLogger(__name__)
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--dump', action='store_true',
                         help='Dump all traffic to %s in a format suitable '
                              'for parsing with the parse.py utility.' %
                              dumpfilename)
+    parser.add_argument('-s', '--single-greenlet-connections', action='store_true',
+                        help='Handle each game client connection in a single greenlet '
+                             'instead of separate reader and writer greenlets (gevent backend only)')
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='gevent',
+                        help='Networking backend to run the login server on. The uvloop '
+                             'backend is the asyncio backend on the event loop of the uvloop package.')
     args = parser.parse_args()
 
-    # Perform data migrations on startup
-    try:
-        run_migrations('data')
-    except ValueError as e:
-        # If a migration failed, it will raise a ValueError
-        logger.fatal('Failed to run data migrations with format error: %s' % str(e))
-        sys.exit(2)
-    except OSError as e:
-        # If a migration failed, it will raise a ValueError
-        logger.fatal('Failed to run data migrations with OS error: %s' % str(e))
-        sys.exit(2)
-    
-    client_queues = {}
-    server_queue = gevent.queue.Queue()
-    server_stats_queue = gevent.queue.Queue()
-    dump_queue = gevent.queue.Queue() if args.dump else None
-
-    accounts = Accounts('data/accountdatabase.json')
-    config = configparser.ConfigParser()
-    with open(INI_PATH) as f:
-        config.read_file(f)
-    with open(SHARED_INI_PATH) as f:
-        config.read_file(f)
-
-    ports = Ports(int(config['shared']['port_offset']))
-
-    tasks = [
-        gevent_spawn("login server's handle_server",
-                     handle_server,
-                     server_queue,
-                     client_queues,
-                     server_stats_queue,
-                     ports,
-                     accounts),
-        gevent_spawn("login server's handle_authcodes",
-                     handle_authcodes,
-                     server_queue),
-        gevent_spawn("login server's handle_webhook",
-                     handle_webhook,
-                     server_stats_queue,
-                     config['loginserver']),
-        gevent_spawn("login server's handle_http",
-                     handle_http,
-                     server_queue,
-                     ports),
-        gevent_spawn("login server's handle_game_client",
-                     handle_game_client,
-                     server_queue, dump_queue),
-        gevent_spawn("login server's handle_game_server_launcher",
-                     handle_game_server_launcher,
-                     server_queue,
-                     ports)
-    ]
-    # Give the greenlets enough time to start up, otherwise killall can block
-    gevent.sleep(1)
-
-    if dump_queue:
-        tasks.append(gevent_spawn("login server's handle_dump", handle_dump, dump_queue))
-
-    try:
-        # Wait for any of the tasks to terminate
-        finished_greenlets = gevent.joinall(tasks, count=1)
-
-        logger.error('The following greenlets terminated: %s' % ','.join([g.name for g in finished_greenlets]))
-
-        exceptions = ['  %s' % g.exception for g in finished_greenlets
-                                if isinstance(g.exception, Exception)]
-        if exceptions:
-            logger.critical('\n' +
-                            '\n-------------------------------------------\n' +
-                            'The following exceptions occurred:\n' +
-                            '\n'.join(exceptions) +
-                            '\n-------------------------------------------\n'
-                            )
-
-        if dump_queue:
-            logger.info('Giving the dump greenlet some time to finish writing to disk...')
-            gevent.sleep(2)
-
-        logger.info('Killing everything and waiting 10 seconds before exiting...')
-        gevent.killall(tasks)
-        gevent.sleep(5)
+    # The monkey patching has to be done before anything else is imported
+    if args.backend == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+        from .gevent_backend import run
+    else:
+        from .asyncio_backend import run
 
-    except KeyboardInterrupt:
-        logger.info('Keyboard interrupt received. Exiting...')
-        gevent.killall(tasks)
-        accounts.save()
-    except Exception:
-        logger.exception('Main login server thread exited with an exception')
+    run(args)
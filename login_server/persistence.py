@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import collections
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import zlib
+
+
+def write_file_atomically(filename, data):
+    """ Write data to a temporary file and rename it over filename, so that readers never see half a file """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wt') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_filename, filename)
+
+
+class JsonFilePlayerStore:
+    """
+    Stores each datastore of a player (e.g. 'friends') in a JSON file of
+    its own, named after the player and the datastore.
+    """
+
+    def __init__(self, directory='data/players'):
+        self.directory = directory
+
+    def get_filename(self, login_name, datastore_name):
+        return os.path.join(self.directory, '%s_%s.json' % (login_name, datastore_name))
+
+    def read(self, login_name, datastore_names):
+        """ Return the serialized data of the given datastores of a player that were stored before """
+        items = {}
+        for datastore_name in datastore_names:
+            try:
+                with open(self.get_filename(login_name, datastore_name), 'rt') as infile:
+                    items[datastore_name] = infile.read()
+            except OSError:
+                pass
+        return items
+
+    def write(self, login_name, items):
+        """ Store the serialized data of some of the datastores of a player """
+        for datastore_name, data in items.items():
+            write_file_atomically(self.get_filename(login_name, datastore_name), data)
+
+    def close(self):
+        pass
+
+
+class SqlitePlayerStore:
+    """
+    Stores the datastores of all players in a single SQLite database in WAL
+    mode, with one row per player and datastore. Each write is done in a
+    single transaction.
+
+    Reads use a connection of their own, so that they do not have to wait
+    for a write that is in progress in another thread.
+    """
+
+    def __init__(self, filename='data/players.db'):
+        self.filename = filename
+        self.read_connection = self._connect()
+        with self.read_connection:
+            self.read_connection.execute('CREATE TABLE IF NOT EXISTS player_data ('
+                                         'login_name TEXT NOT NULL, '
+                                         'datastore TEXT NOT NULL, '
+                                         'data TEXT NOT NULL, '
+                                         'PRIMARY KEY (login_name, datastore)) WITHOUT ROWID')
+        # Created by the first write, in the thread that does the writes
+        self.write_connection = None
+
+    def _connect(self):
+        # The connections are closed from another thread than the one that uses them
+        connection = sqlite3.connect(self.filename, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA busy_timeout=5000')
+        return connection
+
+    def read(self, login_name, datastore_names):
+        """ Return the serialized data of the given datastores of a player that were stored before """
+        rows = self.read_connection.execute('SELECT datastore, data FROM player_data WHERE login_name = ?',
+                                            (login_name,))
+        return {datastore_name: data for datastore_name, data in rows if datastore_name in datastore_names}
+
+    def write(self, login_name, items):
+        """ Store the serialized data of some of the datastores of a player """
+        self.write_many((login_name, datastore_name, data) for datastore_name, data in items.items())
+
+    def write_many(self, records):
+        """ Store (login name, datastore name, data) records in a single transaction """
+        if self.write_connection is None:
+            self.write_connection = self._connect()
+        with self.write_connection:
+            self.write_connection.executemany('INSERT OR REPLACE INTO player_data (login_name, datastore, data) '
+                                              'VALUES (?, ?, ?)', records)
+
+    def read_all(self):
+        """ Return (login name, datastore name, data) records for everything in the database """
+        return self.read_connection.execute('SELECT login_name, datastore, data FROM player_data '
+                                            'ORDER BY login_name, datastore')
+
+    def close(self):
+        if self.write_connection is not None:
+            self.write_connection.close()
+        self.read_connection.close()
+
+
+class WriteBehindWriter:
+    """
+    Writes player data to a store in worker threads, so that the task that
+    handles the server queue does not have to wait for the disk.
+
+    All data of a player is written by the same worker, in the order in
+    which it was saved. When a player is saved again before the previous
+    data was written, the two are merged and only the merged data is
+    written. Data that was saved but not written yet is returned when the
+    player is loaded, so that a player that logs in right after logging
+    out does not get old data.
+    """
+
+    def __init__(self, store, worker_count=2, executor_class=concurrent.futures.ThreadPoolExecutor):
+        """
+        :param store: the JsonFilePlayerStore or SqlitePlayerStore to write to
+        :param worker_count: the number of threads that write to the store
+        :param executor_class: the concurrent.futures.Executor to run each
+                               worker in. Under gevent this must be one that
+                               uses real threads.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.store = store
+        self.executors = [executor_class(max_workers=1) for _ in range(worker_count)]
+        # The number of the most recent save of each player and the data that was
+        # saved for it since it was last written. Only changed by the saving task.
+        self.pending_saves = {}
+        # The saves that the workers have written, for the saving task to remove from pending_saves
+        self.written_saves = collections.deque()
+        self.save_count = 0
+
+        self.requested_saves = 0
+        self.completed_saves = 0
+        self.skipped_saves = 0
+        self.failed_saves = 0
+
+    def save(self, login_name, items):
+        """ Have the serialized data of some of the datastores of a player written in the background """
+        self._forget_written_saves()
+        pending_save = self.pending_saves.get(login_name)
+        if pending_save is not None:
+            items = {**pending_save[1], **items}
+        self.save_count += 1
+        self.pending_saves[login_name] = (self.save_count, items)
+        self.requested_saves += 1
+
+        executor = self.executors[zlib.crc32(login_name.encode('utf8')) % len(self.executors)]
+        executor.submit(self._write, login_name, items, self.save_count)
+
+    def load(self, login_name, datastore_names):
+        """ Return the serialized data of the given datastores of a player, including what was not written yet """
+        self._forget_written_saves()
+        items = self.store.read(login_name, datastore_names)
+        pending_save = self.pending_saves.get(login_name)
+        if pending_save is not None:
+            items.update((datastore_name, data) for datastore_name, data in pending_save[1].items()
+                         if datastore_name in datastore_names)
+        return items
+
+    def close(self):
+        """ Wait for all saves to be written, retry the ones that failed and close the store """
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+        self._forget_written_saves()
+
+        lost_login_names = []
+        for login_name, (_, items) in self.pending_saves.items():
+            try:
+                self.store.write(login_name, items)
+            except (OSError, sqlite3.Error) as e:
+                self.failed_saves += 1
+                self.logger.error('Failed to write the data of player %s again: %s' % (login_name, e))
+                lost_login_names.append(login_name)
+            else:
+                self.completed_saves += 1
+        self.pending_saves.clear()
+
+        if lost_login_names:
+            self.logger.error('The unsaved data of the following players is lost: %s' %
+                              ', '.join(sorted(lost_login_names)))
+        self.store.close()
+
+    def get_statistics(self):
+        return {
+            'requested_saves': self.requested_saves,
+            'completed_saves': self.completed_saves,
+            'skipped_saves': self.skipped_saves,
+            'failed_saves': self.failed_saves,
+            'pending_players': len(self.pending_saves),
+        }
+
+    def _forget_written_saves(self):
+        while self.written_saves:
+            login_name, save_number = self.written_saves.popleft()
+            pending_save = self.pending_saves.get(login_name)
+            if pending_save is not None and pending_save[0] == save_number:
+                del self.pending_saves[login_name]
+
+    def _write(self, login_name, items, save_number):
+        # Runs in a worker thread. The statistics are updated without a lock,
+        # because they are only used for reporting.
+        if self.pending_saves[login_name][0] != save_number:
+            # A later save includes these items as well
+            self.skipped_saves += 1
+            return
+
+        try:
+            self.store.write(login_name, items)
+        except (OSError, sqlite3.Error) as e:
+            # The data stays pending, so it is still returned on a load and
+            # is written together with the next save of the player
+            self.failed_saves += 1
+            self.logger.error('Failed to write the data of player %s: %s' % (login_name, e))
+        else:
+            self.completed_saves += 1
+            self.written_saves.append((login_name, save_number))
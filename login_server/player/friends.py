@@ -30,6 +30,8 @@ class Friends:
         self.this_player = this_player
         self.friends_dict = {}
         self.social_network = None
+        # Whether the friends have changed since they were loaded or serialized
+        self.dirty = False
 
     def connect_to_social_network(self, social_network):
         self.social_network = social_network
@@ -37,6 +39,7 @@ class Friends:
     def add(self, unique_id, login_name):
         if unique_id not in self.friends_dict:
             self.friends_dict[unique_id] = { 'login_name' : login_name }
+            self.dirty = True
             self.social_network.add_friend(self.this_player.unique_id, unique_id)
             return True
         else:
@@ -45,22 +48,24 @@ class Friends:
     def remove(self, unique_id):
         if unique_id in self.friends_dict:
             self.friends_dict.pop(unique_id, None)
+            self.dirty = True
             self.social_network.remove_friend(self.this_player.unique_id, unique_id)
             return True
         else:
             return False
 
-    def load(self, filename):
-        try:
-            with open(filename, 'rt') as infile:
-                friend_dict_with_string_keys = json.load(infile)
-                self.friends_dict = {int(k): v for k, v in friend_dict_with_string_keys.items()}
-        except OSError:
+    def deserialize(self, data):
+        """ Restore the friends from what serialize returned, or no friends if data is None """
+        if data is None:
             self.friends_dict = {}
+        else:
+            friend_dict_with_string_keys = json.loads(data)
+            self.friends_dict = {int(k): v for k, v in friend_dict_with_string_keys.items()}
+        self.dirty = False
 
-    def save(self, filename):
-        with open(filename, 'wt') as outfile:
-            json.dump(self.friends_dict, outfile, indent=4, sort_keys=True)
+    def serialize(self):
+        self.dirty = False
+        return json.dumps(self.friends_dict, indent=4, sort_keys=True)
 
     def notify_online(self):
         if self.this_player.registered:
@@ -70,6 +70,11 @@ EQUIPMENT_LIGHT_GRENADE_LAUNCHER = 8761
 EQUIPMENT_PERKS_ULTRACAP_DETERMINATION = 535109597
 
 
+def _json_keys_to_int(x):
+    if isinstance(x, dict):
+        return {int(k): v for k, v in x.items()}
+
+
 class Loadouts:
     max_loadouts = 9
 
@@ -110,6 +115,8 @@ class Loadouts:
     def __init__(self, game_setting_mode: str):
         self.game_setting_mode = game_setting_mode
         self.loadout_dict = self.defaults()
+        # Whether the loadouts have changed since they were loaded or serialized
+        self.dirty = False
 
     def defaults(self):
         default_loadouts_file = 'data/defaults/default_loadouts_%s.json' % self.game_setting_mode
@@ -124,9 +131,11 @@ class Loadouts:
     def modify(self, loadout_id, slot, equipment):
         class_id, loadout_index = self.loadout_id2key[loadout_id]
         self.loadout_dict[class_id][loadout_index][slot] = equipment
+        self.dirty = True
 
     def modify_by_class_details(self, class_id: int, loadout_index: int, slot: int, equipment: int):
         self.loadout_dict[class_id][loadout_index][slot] = equipment
+        self.dirty = True
 
     def get_loadout_modded_defs(self) -> List[Dict]:
         result = list()
@@ -138,19 +147,17 @@ class Loadouts:
         return result
 
     def _load_loadout_data(self, filename):
-        def json_keys_to_int(x):
-            if isinstance(x, dict):
-                return {int(k): v for k, v in x.items()}
-
         with open(filename, 'rt') as infile:
-            return json.load(infile, object_hook=json_keys_to_int)
+            return json.load(infile, object_hook=_json_keys_to_int)
 
-    def load(self, filename):
-        try:
-            self.loadout_dict = self._load_loadout_data(filename)
-        except OSError:
+    def deserialize(self, data):
+        """ Restore the loadouts from what serialize returned, or the defaults if data is None """
+        if data is None:
             self.loadout_dict = self.defaults()
+        else:
+            self.loadout_dict = json.loads(data, object_hook=_json_keys_to_int)
+        self.dirty = False
 
-    def save(self, filename):
-        with open(filename, 'wt') as outfile:
-            json.dump(self.loadout_dict, outfile, indent=4, sort_keys=True)
+    def serialize(self):
+        self.dirty = False
+        return json.dumps(self.loadout_dict, indent=4, sort_keys=True)
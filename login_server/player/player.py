@@ -26,12 +26,32 @@ from ipaddress import IPv4Address
 from .friends import Friends
 from .loadouts import Loadouts
 from .settings import PlayerSettings
-from common.connectionhandler import Peer
+from common.connectionhandler import Peer, OutgoingQueueLimits, OVERFLOW_POLICY_DROP
+from common.datatypes import a011b, encodedmessage
 from common.ipaddresspair import IPAddressPair
 from common.statetracer import statetracer, RefOnly
 from common.game_items import get_game_setting_modes, UNMODDED_GAME_SETTING_MODE
 
 
+# Ident of the messages that tell a player about the presence of a friend
+PRESENCE_NOTIFICATION_IDENT = a011b().ident
+
+
+def get_datastore_names():
+    """ Return the names under which the parts of the data of a player are stored """
+    return ['%s_loadouts' % mode for mode in get_game_setting_modes()] + ['friends', 'settings']
+
+
+def send_to_players(players, data):
+    """
+    Send the same message to several players. The message is serialized only
+    once and the resulting buffer is shared by all their outgoing queues.
+    """
+    data = encodedmessage.frommessage(data)
+    for player in players:
+        player.send(data)
+
+
 @statetracer('unique_id', 'login_name', 'display_name', 'address_pair', 'player_settings', 'port', 'registered',
              RefOnly('game_server'), 'vote', 'team')
 class Player(Peer):
@@ -40,9 +60,15 @@ class Player(Peer):
     max_name_length = 15
     idle_timeout = 60
 
-    loadout_file_path = 'data/players/%s_%s_loadouts.json'
-    friends_file_path = 'data/players/%s_friends.json'
-    settings_file_path = 'data/players/%s_settings.json'
+    # Friend presence notifications can be dropped for a client that is not keeping up, anything
+    # else (server list, chat, ...) that does not fit gets it disconnected. Messages are queued as
+    # an encodedmessage (see send), so max_bytes counts their actual size and they are recognized
+    # by the ident that the encodedmessage keeps of the message.
+    outgoing_queue_limits = OutgoingQueueLimits(max_messages=2000,
+                                                max_bytes=4 * 1024 * 1024,
+                                                policy=OVERFLOW_POLICY_DROP,
+                                                is_droppable=lambda item:
+                                                    item[0].ident == PRESENCE_NOTIFICATION_IDENT)
 
     def __init__(self, address):
         super().__init__()
@@ -57,6 +83,7 @@ class Player(Peer):
         self.last_received_seq = 0
         self.vote = None
         self.state = None
+        self.states = {}
         self.is_modded: bool = False
         self.login_server = None
         self.game_server = None
@@ -67,12 +94,12 @@ class Player(Peer):
         self.pings = {}
         self.activity_since_last_check = True
 
-        detected_ip = IPv4Address(address[0])
-        if detected_ip.is_global:
-            self.address_pair = IPAddressPair(detected_ip, None)
+        self.detected_ip = IPv4Address(address[0])
+        if self.detected_ip.is_global:
+            self.address_pair = IPAddressPair(self.detected_ip, None)
         else:
-            assert detected_ip.is_private
-            self.address_pair = IPAddressPair(None, detected_ip)
+            assert self.detected_ip.is_private
+            self.address_pair = IPAddressPair(None, self.detected_ip)
 
     def start_idle_timeout(self):
         if not self.activity_since_last_check:
@@ -97,7 +124,13 @@ class Player(Peer):
         if self.state:
             self.state.on_exit()
 
-        self.state = state_class(self, *args, **kwargs)
+        state = self.states.get(state_class)
+        if state is None:
+            state = state_class(self, *args, **kwargs)
+            self.states[state_class] = state
+        else:
+            state.reset(*args, **kwargs)
+        self.state = state
         self.state.on_enter()
 
     def get_unmodded_loadouts(self) -> Loadouts:
@@ -110,25 +143,47 @@ class Player(Peer):
     def get_loadout_modded_defs(self):
         return self.get_current_loadouts().get_loadout_modded_defs()
 
+    def get_datastores(self):
+        """ Return the parts of the player's data that are stored separately, by the name they are stored under """
+        datastores = {'%s_loadouts' % mode: loadouts for mode, loadouts in self.loadouts.items()}
+        datastores['friends'] = self.friends
+        datastores['settings'] = self.player_settings
+        return datastores
+
     def load(self):
         if self.registered:
-            for mode in get_game_setting_modes():
-                self.loadouts[mode].load(self.loadout_file_path % (self.login_name, mode))
-            self.friends.load(self.friends_file_path % self.login_name)
-            self.player_settings.load(self.settings_file_path % self.login_name)
+            datastores = self.get_datastores()
+            items = self.login_server.data_writer.load(self.login_name, datastores)
+            for datastore_name, datastore in datastores.items():
+                datastore.deserialize(items.get(datastore_name))
 
     def save(self):
+        """ Have the data of this player that changed since it was loaded or last saved written in the background """
         if self.registered:
-            for mode in get_game_setting_modes():
-                self.loadouts[mode].save(self.loadout_file_path % (self.login_name, mode))
-            self.friends.save(self.friends_file_path % self.login_name)
-            self.player_settings.save(self.settings_file_path % self.login_name)
+            items = {datastore_name: datastore.serialize()
+                     for datastore_name, datastore in self.get_datastores().items() if datastore.dirty}
+            if items:
+                self.login_server.data_writer.save(self.login_name, items)
+
+    def start_checkpoints(self):
+        """ Save the player periodically, so that not everything since the login is lost on a crash """
+        checkpoint_interval = self.login_server.player_checkpoint_interval
+        if self.registered and checkpoint_interval:
+            self.login_server.pending_callbacks.add(self, checkpoint_interval, self._checkpoint)
+
+    def _checkpoint(self):
+        self.save()
+        self.start_checkpoints()
 
     def handle_request(self, request):
         self.state.handle_request(request)
 
     def send(self, data):
-        super().send((data, self.last_received_seq))
+        # Serialized here rather than in the writer, so that the outgoing queue knows the size.
+        # This moves the encoding of all messages to players onto the task that handles the
+        # server queue. Under both backends the writers ran in the same thread anyway, but
+        # the encoding now delays the handling of the next message instead of the sending.
+        super().send((encodedmessage.frommessage(data), self.last_received_seq))
 
     def __repr__(self):
         return '%s(%s, %s:%s, %d:"%s")' % (self.task_name, self.task_id,
@@ -93,6 +93,17 @@ class PlayerSettings:
         self.game_setting_mode = None
         self.progression = {}
         self.init_settings_from_dict({})
+        # Whether the settings have changed since they were loaded or serialized
+        self.dirty = False
+        self._state_tracer.add_observer(self._setting_changed)
+
+    def _setting_changed(self, settings, member_name, old_value, new_value):
+        if new_value != old_value:
+            self.dirty = True
+
+    def earn_xp(self, time_played: int, was_win: bool) -> None:
+        self.progression.earn_xp(time_played, was_win)
+        self.dirty = True
 
     def init_settings_from_dict(self, d):
         for key in defaults:
@@ -101,18 +112,14 @@ class PlayerSettings:
                 val = load_transforms[key](val)
             setattr(self, key, val)
 
-    def load(self, filename):
-        try:
-            with open(filename, 'rt') as infile:
-                d = json.load(infile)
-        except OSError:
-            d = {}
-
-        self.init_settings_from_dict(d)
+    def deserialize(self, data):
+        """ Restore the settings from what serialize returned, or the defaults if data is None """
+        self.init_settings_from_dict(json.loads(data) if data is not None else {})
+        self.dirty = False
 
-    def save(self, filename):
+    def serialize(self):
         current_values = {key: getattr(self, key) for key in defaults}
         for key, transform in save_transforms.items():
             current_values[key] = transform(current_values[key])
-        with open(filename, 'wt') as outfile:
-            json.dump(current_values, outfile, indent=4, sort_keys=True)
+        self.dirty = False
+        return json.dumps(current_values, indent=4, sort_keys=True)
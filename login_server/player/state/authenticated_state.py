@@ -20,9 +20,11 @@
 #
 
 import datetime
+import functools
 
 from common.datatypes import *
-from common.game_items import get_game_setting_modes, get_class_menu_data_modded_defs, get_unmodded_class_menu_data
+from common.game_items import get_game_setting_modes, get_class_menu_data, get_class_menu_data_modded_defs, \
+    get_unmodded_class_menu_data, UNMODDED_GAME_SETTING_MODE
 from common.messages import Message, Client2LoginConnect, Client2LoginSwitchMode, \
     Login2ClientModeInfo, Login2ClientMenuData, Login2ClientLoadouts, Client2LoginLoadoutChange, \
     parse_message_from_string
@@ -30,6 +32,94 @@ from .player_state import PlayerState, handles, handles_control_message
 from common import utils
 
 
+# Messages that are replayed from the original capture. These are created at
+# import time, so that their ranges are checked when the capture is loaded.
+_map_list_fragment = originalfragment(0x1EEB3, 0x20A10)  # 00d5 (map list)
+_a018b_fragment = originalfragment(0x20B47, 0x20B4B)  # 018b
+_a0176_fragment = originalfragment(0x218FF, 0x219D1)  # 0176
+
+_original_menu_fragments = {
+    PURCHASE_TYPE_SERVER: originalfragment(0x38d17, 0x3d0fe),
+    0x01f1: originalfragment(0x54bc6, 0x54db0),  # Purpose not fully known, needed or weapons are locked
+    0x01f4: originalfragment(0x5a776, 0x6fde3),  # Item upgrades
+    # 0x01f6: originalfragment(0x5965a, 0x5a72b),  # Perks
+    0x01f7: originalfragment(0x5a733, 0x5a76e),
+    0x01f8: originalfragment(0x5737d, 0x579af),  # Armor Upgrades
+    0x01fa: originalfragment(0x221a6, 0x22723),
+    0x01fb: originalfragment(0x2272b, 0x235b8),
+    PURCHASE_TYPE_BOOSTERS: originalfragment(0x235c0, 0x239dd),
+    PURCHASE_TYPE_NAME: originalfragment(0x239e5, 0x23acf),  # Name change
+    0x0206: originalfragment(0x2620e, 0x28ac1),
+    0x0214: originalfragment(0x23ad7, 0x26206),  # Purchaseable loadouts
+    0x0218: originalfragment(0x28ac9, 0x2f4d7),
+    # Weapon name <-> ID mapping - Probably only need to construct this at some point if we wanted to add entirely new weapons
+    0x021b: originalfragment(0x3d106, 0x47586),
+    0x021c: originalfragment(0x6fdeb, 0x6fecf),
+    PURCHASE_TYPE_TAG: originalfragment(0x2f4df, 0x2f69f),  # Modify Clantag
+    0x0227: originalfragment(0x2f6a7, 0x38d0f),  # GOTY
+}
+
+
+def create_purchase_menu_fragments(class_menu_data):
+    def items_of_all_classes(get_items):
+        return {item
+                for _, class_items
+                in class_menu_data.class_items.items()
+                for item
+                in get_items(class_items)}
+
+    return {
+        0x01ed: a0177().setdata(0x01ed, class_menu_data.class_purchases, False),  # Classes
+        0x01f0: a0177().setdata(0x01f0, items_of_all_classes(lambda items: items.weapons), False),  # Weapons with categories
+        0x01f2: a0177().setdata(0x01f2, items_of_all_classes(lambda items: items.belt_items), False),  # Belt items
+        0x01f3: a0177().setdata(0x01f3, items_of_all_classes(lambda items: items.packs), False),  # Packs
+        0x01f6: a0177().setdata(0x01f6, set(class_menu_data.perks), False),  # Perks
+        0x01f9: a0177().setdata(0x01f9, items_of_all_classes(lambda items: items.skins), False),  # Skins
+        0x0220: a0177().setdata(0x0220, set(class_menu_data.voices), False),  # Voices
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_purchase_menu_fragments(game_setting_mode):
+    # The purchase menus only depend on the game setting mode, so they
+    # are serialized on first use and then sent as they are
+    menu_fragments = {menu_part: encodedmessage.frommessage(message)
+                      for menu_part, message
+                      in create_purchase_menu_fragments(get_class_menu_data(game_setting_mode)).items()}
+    menu_fragments.update(_original_menu_fragments)
+    return menu_fragments
+
+
+def _create_join_template(message, m042a_value):
+    message.findbytype(m042a).set(m042a_value)
+    slots = {
+        'server_id': message.findbytype(m02c7),
+        'unique_id': message.findbytype(m0348)
+    }
+    if message.findbytype(m02c4):
+        slots['match_id'] = message.findbytype(m02c4)
+    return MessageTemplate(message, **slots)
+
+
+def _create_server_data_template():
+    message = a0035().setserverfields(0, 0, IPv4Address('0.0.0.0'), 0, 0, 0)
+    return MessageTemplate(message,
+                           server_id=message.findbytype(m02c7),
+                           match_id=message.findbytype(m02c4),
+                           game_address=message.findbytype(m024f),
+                           ping_address=message.findbytype(m0246),
+                           region=message.findbytype(m0448))
+
+
+# Join messages only differ in the server, match and player they refer to,
+# so they are serialized once and patched for each join
+_queue_joined_template = _create_join_template(a00b0().setlength(9), 2)
+_match_joined_template = _create_join_template(a00b0().setlength(10), 2)
+_mission_ready_template = _create_join_template(a00b4(), 3)
+_server_joined_template = _create_join_template(a00b0().setlength(10), 7)
+_server_data_template = _create_server_data_template()
+
+
 class AuthenticatedState(PlayerState):
 
     @handles(packet=a0033)
@@ -46,12 +136,11 @@ class AuthenticatedState(PlayerState):
     @handles(packet=a00d5)
     def handle_a00d5(self, request):
         if request.findbytype(m0228).value == 1:
-            self.player.send(originalfragment(0x1EEB3, 0x20A10))  # 00d5 (map list)
+            self.player.send(_map_list_fragment)
         else:
-            self.player.send(a00d5().setservers(self.player.login_server
-                                                .all_game_servers()
-                                                .values(),
-                                                self.player.address_pair))  # 00d5 (server list)
+            login_server = self.player.login_server
+            self.player.send(login_server.server_list_cache.get_server_list(login_server.joinable_game_servers(),
+                                                                            self.player.address_pair))  # 00d5 (server list)
 
     @handles(packet=a0014)
     def handle_a0014(self, request):
@@ -59,7 +148,7 @@ class AuthenticatedState(PlayerState):
 
     @handles(packet=a018b)
     def handle_a018b(self, request):
-        self.player.send(originalfragment(0x20B47, 0x20B4B))  # 018b
+        self.player.send(_a018b_fragment)
 
     @handles(packet=a01b5)
     def handle_a01b5(self, request):
@@ -67,64 +156,12 @@ class AuthenticatedState(PlayerState):
 
     @handles(packet=a0176)
     def handle_a0176(self, request):
-        self.player.send(originalfragment(0x218FF, 0x219D1))  # 0176
+        self.player.send(_a0176_fragment)
 
     @handles(packet=a0177)
     def handle_menu(self, request):
         menu_part = request.findbytype(m02ab).value
-        menu_fragments = {
-            PURCHASE_TYPE_SERVER: originalfragment(0x38d17, 0x3d0fe),
-            0x01ed: a0177().setdata(0x01ed, get_unmodded_class_menu_data().class_purchases, False),  # Classes
-            0x01f0: a0177().setdata(0x01f0, {item
-                                             for _, class_items
-                                             in get_unmodded_class_menu_data().class_items.items()
-                                             for item
-                                             in class_items.weapons},
-                                    False),  # Weapons with categories
-            0x01f1: originalfragment(0x54bc6, 0x54db0),  # Purpose not fully known, needed or weapons are locked
-            0x01f2: a0177().setdata(0x01f2, {item
-                                             for _, class_items
-                                             in get_unmodded_class_menu_data().class_items.items()
-                                             for item
-                                             in class_items.belt_items},
-                                    False),  # Belt items
-            0x01f3: a0177().setdata(0x01f3, {item
-                                             for _, class_items
-                                             in get_unmodded_class_menu_data().class_items.items()
-                                             for item
-                                             in class_items.packs},
-                                    False),  # Packs
-            0x01f4: originalfragment(0x5a776, 0x6fde3),  # Item upgrades
-            # 0x01f6: originalfragment(0x5965a, 0x5a72b),  # Perks
-            0x01f6: a0177().setdata(0x01f6, {item
-                                             for item
-                                             in get_unmodded_class_menu_data().perks},
-                                    False),  # Perks
-            0x01f7: originalfragment(0x5a733, 0x5a76e),
-            0x01f8: originalfragment(0x5737d, 0x579af),  # Armor Upgrades
-            0x01f9: a0177().setdata(0x01f9, {item
-                                             for _, class_items
-                                             in get_unmodded_class_menu_data().class_items.items()
-                                             for item
-                                             in class_items.skins},
-                                    False),  # Skins
-            0x01fa: originalfragment(0x221a6, 0x22723),
-            0x01fb: originalfragment(0x2272b, 0x235b8),
-            PURCHASE_TYPE_BOOSTERS: originalfragment(0x235c0, 0x239dd),
-            PURCHASE_TYPE_NAME: originalfragment(0x239e5, 0x23acf),  # Name change
-            0x0206: originalfragment(0x2620e, 0x28ac1),
-            0x0214: originalfragment(0x23ad7, 0x26206),  # Purchaseable loadouts
-            0x0218: originalfragment(0x28ac9, 0x2f4d7),
-            # Weapon name <-> ID mapping - Probably only need to construct this at some point if we wanted to add entirely new weapons
-            0x021b: originalfragment(0x3d106, 0x47586),
-            0x021c: originalfragment(0x6fdeb, 0x6fecf),
-            0x0220: a0177().setdata(0x0220, {item
-                                             for item
-                                             in get_unmodded_class_menu_data().voices},
-                                    False),  # Voices
-            PURCHASE_TYPE_TAG: originalfragment(0x2f4df, 0x2f69f),  # Modify Clantag
-            0x0227: originalfragment(0x2f6a7, 0x38d0f),  # GOTY
-        }
+        menu_fragments = get_purchase_menu_fragments(UNMODDED_GAME_SETTING_MODE)
         if menu_part in menu_fragments:
             self.player.send(menu_fragments[menu_part])
 
@@ -166,11 +203,9 @@ class AuthenticatedState(PlayerState):
                     allowed_to_join = False
                     join_message = STDMSG_INCORRECT_PASSWORD
 
-            b0msg = a00b0().set_server(game_server).set_player(self.player.unique_id)
             if allowed_to_join:
-                b0msg.setlength(9)
-                b0msg.findbytype(m042a).set(2)
-                self.player.send(b0msg)
+                self.player.send(_queue_joined_template.render(server_id=game_server.server_id,
+                                                               unique_id=self.player.unique_id))
                 self.player.send(a0070().set([
                     m0348().set(self.player.unique_id),
                     m0095(),
@@ -179,14 +214,14 @@ class AuthenticatedState(PlayerState):
                     m02fc().set(join_message)
                 ]))
 
-                b0msg = a00b0().setlength(10).set_server(game_server).set_player(self.player.unique_id)
-                b0msg.findbytype(m042a).set(2)
-                self.player.send(b0msg)
-
-                b4msg = a00b4().set_server(game_server).set_player(self.player.unique_id)
-                b4msg.findbytype(m042a).set(3)
-                self.player.send(b4msg)
+                self.player.send(_match_joined_template.render(server_id=game_server.server_id,
+                                                               match_id=game_server.match_id,
+                                                               unique_id=self.player.unique_id))
+                self.player.send(_mission_ready_template.render(server_id=game_server.server_id,
+                                                                match_id=game_server.match_id,
+                                                                unique_id=self.player.unique_id))
             else:
+                b0msg = a00b0().set_server(game_server).set_player(self.player.unique_id)
                 b0msg.content.append(m042b().set(join_message))
                 self.player.send(b0msg)
                 self.player.send(a0070().set([
@@ -206,10 +241,16 @@ class AuthenticatedState(PlayerState):
         game_server = self.player.login_server.find_server_by_match_id(match_id)
 
         if game_server.joinable:
-            b0msg = a00b0().setlength(10).set_server(game_server).set_player(self.player.unique_id)
-            b0msg.findbytype(m042a).set(7)
-            self.player.send(b0msg)
-            self.player.send(a0035().setserverdata(game_server, self.player.address_pair))
+            self.player.send(_server_joined_template.render(server_id=game_server.server_id,
+                                                            match_id=game_server.match_id,
+                                                            unique_id=self.player.unique_id))
+            server_address = game_server.address_pair.get_address_seen_from(self.player.address_pair)
+            self.player.send(_server_data_template.render(server_id=game_server.server_id,
+                                                          match_id=game_server.match_id,
+                                                          game_address=m024f().set(server_address, game_server.port),
+                                                          ping_address=m0246().set(server_address,
+                                                                                   game_server.pingport),
+                                                          region=game_server.region))
 
             self.player.set_state(OnGameServerState, game_server)
 
@@ -218,23 +259,18 @@ class AuthenticatedState(PlayerState):
         message_type = request.findbytype(m009e).value
 
         if message_type == MESSAGE_TEAM:
-            request.content.append(m02fe().set(self.player.display_name))
-            request.content.append(m06de().set(self.player.player_settings.clan_tag))
-
             if self.player.game_server and self.player.team is not None:
-                self.player.game_server.send_all_players_on_team(request,
+                self.player.game_server.send_all_players_on_team(self._relayed_chat(request),
                                                                  self.player.team)
 
         elif message_type == MESSAGE_PRIVATE:
             addressed_player_name = request.findbytype(m034a).value
             addressed_player = self.player.login_server.find_player_by_display_name(addressed_player_name)
             if addressed_player:
-                request.content.append(m02fe().set(self.player.display_name))
-                request.content.append(m06de().set(self.player.player_settings.clan_tag))
-                self.player.send(request)
+                self.player.send(self._relayed_chat(request))
 
                 request.findbytype(m034a).set(addressed_player.display_name)
-                addressed_player.send(request)
+                addressed_player.send(self._relayed_chat(request))
             else:
                 reply = a0070().set([
                     m009e().set(MESSAGE_UNKNOWNTYPE),
@@ -253,8 +289,6 @@ class AuthenticatedState(PlayerState):
             # Handle the control message
             self.handle_control_message(msg)
         else:  # MESSAGE_PUBLIC
-            request.content.append(m02fe().set(self.player.display_name))
-            request.content.append(m06de().set(self.player.player_settings.clan_tag))
 
             # Uncomment this to easily print a mapping between message IDs and message texts
             # (only works when a map is loaded)
@@ -279,7 +313,11 @@ class AuthenticatedState(PlayerState):
             #         ]))
 
             if self.player.game_server:
-                self.player.game_server.send_all_players(request)
+                self.player.game_server.send_all_players(self._relayed_chat(request))
+
+    def _relayed_chat(self, request):
+        return request.relay(m02fe().set(self.player.display_name),
+                             m06de().set(self.player.player_settings.clan_tag))
 
     def _send_private_msg_from_server(self, player, text):
         msg = a0070().set([
@@ -320,9 +358,7 @@ class AuthenticatedState(PlayerState):
         if (self.player.login_name in self.player.login_server.accounts and
                 self.player.login_server.accounts[self.player.login_name].authcode == authcode):
 
-            self.player.login_server.accounts[self.player.login_name].password_hash = self.player.password_hash
-            self.player.login_server.accounts[self.player.login_name].authcode = None
-            self.player.login_server.accounts.save()
+            self.player.login_server.accounts.set_password_hash(self.player.login_name, self.player.password_hash)
 
             self._send_private_msg_from_server(self.player, 'Verification successful. Now restart Tribes.')
         else:
@@ -444,16 +480,14 @@ class AuthenticatedState(PlayerState):
     @handles(packet=a01c6)
     def handle_request_for_server_info(self, request):
         server_id = request.findbytype(m02c7).value
-        game_server = self.player.login_server.find_server_by_id(server_id)
+        login_server = self.player.login_server
+        game_server = login_server.find_server_by_id(server_id)
         if game_server.joinable:
-            players = self.player.login_server.find_players_by(game_server=game_server)
-            reply = a01c6()
-            reply.content = [
-                m02c7().set(server_id),
-                m0228().set(0x00000002),
-                m00e9().setservers([game_server], self.player.address_pair).setplayers(players)
-            ]
-            self.player.send(reply)
+            players = login_server.find_players_by(game_server=game_server)
+            self.player.send(login_server.server_list_cache.get_server_info(game_server,
+                                                                            players,
+                                                                            login_server.all_game_servers().values(),
+                                                                            self.player.address_pair))
 
     @handles(packet=a011b)
     def handle_edit_friend_list(self, request):
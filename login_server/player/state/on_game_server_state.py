@@ -27,8 +27,7 @@ from .authenticated_state import AuthenticatedState
 
 class OnGameServerState(AuthenticatedState):
 
-    def __init__(self, player, game_server):
-        super().__init__(player)
+    def reset(self, game_server):
         self.game_server = game_server
 
     def on_enter(self):
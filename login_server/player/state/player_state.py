@@ -19,11 +19,10 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import inspect
 import logging
-from functools import wraps
 
 from common.datatypes import *
+from common.dispatchtable import build_dispatch_table
 from common.messages import Message
 from ..player import Player
 
@@ -36,12 +35,7 @@ def handles(packet):
 
     def real_decorator(func):
         func.handles_packet = packet
-
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrapper
+        return func
 
     return real_decorator
 
@@ -55,47 +49,50 @@ def handles_control_message(messageType):
 
     def real_decorator(func):
         func.handles_message = messageType
-
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            return func(*args, **kwargs)
-        return wrapper
+        return func
 
     return real_decorator
 
 
 class PlayerState:
-    def __init__(self, player: Player):
+    """
+    Base class of the states that a player can be in. A player keeps one
+    instance of every state class it has been in, so that switching back
+    to a state does not create a new object. Arguments that a state needs
+    on entering are passed to reset instead of __init__.
+
+    The handlers of each state class are looked up once when the class is
+    created and stored in request_handlers and control_message_handlers.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.request_handlers = build_dispatch_table(cls, 'handles_packet')
+        cls.control_message_handlers = build_dispatch_table(cls, 'handles_message')
+
+    def __init__(self, player: Player, *args, **kwargs):
         self.logger = logging.getLogger(__name__)
         self.player = player
+        self.reset(*args, **kwargs)
+
+    def reset(self):
+        pass
 
     def handle_request(self, request):
-        methods = [
-            func for name, func in inspect.getmembers(self) if
-            getattr(func, 'handles_packet', None) == type(request)
-        ]
-        if not methods:
+        handler = self.request_handlers.get(type(request))
+        if handler is None:
             self.logger.warning("No handler found for request %s" % request)
             return
 
-        if len(methods) > 1:
-            raise ValueError("Duplicate handlers found for request")
-
-        methods[0](request)
+        handler(self, request)
 
     def handle_control_message(self, message: Message):
-        methods = [
-            func for name, func in inspect.getmembers(self) if
-            getattr(func, 'handles_message', None) == type(message)
-        ]
-        if not methods:
+        handler = self.control_message_handlers.get(type(message))
+        if handler is None:
             self.logger.warning("No handler found for control message %s" % str(message))
             return
 
-        if len(methods) > 1:
-            raise ValueError("Duplicate handlers found for control message")
-
-        methods[0](message)
+        handler(self, message)
 
     @handles(packet=a01c8)
     def handle_ping(self, request):
@@ -112,3 +109,5 @@ class PlayerState:
         self.logger.info("%s is exiting state %s" % (self.player, type(self).__name__))
 
 
+PlayerState.request_handlers = build_dispatch_table(PlayerState, 'handles_packet')
+PlayerState.control_message_handlers = build_dispatch_table(PlayerState, 'handles_message')
@@ -19,21 +19,53 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import functools
+
 from common.datatypes import *
 from common.game_items import get_unmodded_class_menu_data
 from .authenticated_state import AuthenticatedState
 from ..state.player_state import PlayerState, handles
 
 
-def choose_display_name(login_name, registered, names_in_use, max_name_length):
+_m0662_original_range = original_range(0x8898, 0xdaff)
+_m0633_original_range = original_range(0xdaff, 0x19116)
+_m063e_original_range = original_range(0x19116, 0x1c6ee)
+_m067e_original_range = original_range(0x1c6ee, 0x1ec45)
+
+
+@functools.lru_cache(maxsize=None)
+def _login_reply_template():
+    # Everything in the reply to a successful login is the same for every
+    # player, except for the fields that are slots in this template
+    menu_data = a003d().set_menu_data(get_unmodded_class_menu_data())
+    return MessageTemplate([
+        menu_data,
+        m0662().set_original_bytes(*_m0662_original_range),
+        m0633().set_original_bytes(*_m0633_original_range),
+        m063e().set_original_bytes(*_m063e_original_range),
+        m067e().set_original_bytes(*_m067e_original_range),
+        m0442().set_success(True),
+        m02fc().set(STDMSG_LOGIN_IS_VALID),
+        m0219(),
+        m0019(),
+        m0623(),
+        m05d6(),
+        m00ba()
+    ], unique_id=menu_data.findbytype(m0348),
+       display_name=menu_data.findbytype(m034a),
+       clan_tag=menu_data.findbytype(m06de),
+       rank_xp=menu_data.findbytype(m05dc),
+       loadouts=menu_data.findbytype(m0662))
+
+
+def choose_display_name(login_name, registered, is_name_in_use, max_name_length):
     if registered:
         display_name = login_name[:max_name_length]
     else:
         prefix = 'unvrf-'
         display_name = prefix + login_name[:max_name_length - len(prefix)]
         index = 2
-        lowercase_names_in_use = [name.lower() for name in names_in_use]
-        while display_name.lower() in lowercase_names_in_use:
+        while is_name_in_use(display_name):
             display_name = 'unv%02d-%s' % (index, login_name[:max_name_length - len(prefix)])
             index += 1
             assert index < 100
@@ -114,26 +146,18 @@ class UnauthenticatedState(PlayerState):
                                       self.player.login_server.players[new_unique_id].address_pair))
 
                 else:
-                    names_in_use = [p.display_name for p in self.player.login_server.players.values()
-                                    if p.display_name is not None]
+                    players = self.player.login_server.players
                     self.player.display_name = choose_display_name(self.player.login_name,
                                                                    self.player.registered,
-                                                                   names_in_use,
+                                                                   players.is_display_name_in_use,
                                                                    self.player.max_name_length)
                     self.player.load()
-                    self.player.send([
-                        a003d().set_menu_data(get_unmodded_class_menu_data())
-                               .set_player(self.player),
-                        m0662().set_original_bytes(0x8898, 0xdaff),
-                        m0633().set_original_bytes(0xdaff, 0x19116),
-                        m063e().set_original_bytes(0x19116, 0x1c6ee),
-                        m067e().set_original_bytes(0x1c6ee, 0x1ec45),
-                        m0442().set_success(True),
-                        m02fc().set(STDMSG_LOGIN_IS_VALID),
-                        m0219(),
-                        m0019(),
-                        m0623(),
-                        m05d6(),
-                        m00ba()
-                    ])
+                    self.player.start_checkpoints()
+                    self.player.send(_login_reply_template().render(
+                        unique_id=self.player.unique_id,
+                        display_name=self.player.display_name,
+                        clan_tag=self.player.player_settings.clan_tag,
+                        rank_xp=self.player.player_settings.progression.rank_xp,
+                        loadouts=m0662().set_loadouts(self.player.get_unmodded_loadouts())
+                    ))
                     self.player.set_state(AuthenticatedState)
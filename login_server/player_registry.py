@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from common.statetracer import TracingDict
+
+
+def _display_name_key(player):
+    return player.display_name.casefold() if player.display_name is not None else None
+
+
+def _team_key(player):
+    return (player.game_server, player.team) if player.game_server is not None else None
+
+
+# For each index: the player members it depends on and the function that
+# gives the key of a player in the index (None to leave the player out)
+_INDEXES = {
+    'display_name': (('display_name',), _display_name_key),
+    'login_name': (('login_name',), lambda player: player.login_name),
+    'game_server': (('game_server',), lambda player: player.game_server),
+    'team': (('game_server', 'team'), _team_key),
+    'detected_ip': ((), lambda player: player.detected_ip),
+}
+
+# Indexes that find_players_by can use for a member and how it turns a value
+# of that member into a key
+_INDEXES_BY_MEMBER = {
+    'display_name': ('display_name', lambda value: value.casefold() if value is not None else None),
+    'login_name': ('login_name', lambda value: value),
+    'game_server': ('game_server', lambda value: value),
+    'detected_ip': ('detected_ip', lambda value: value),
+}
+
+
+class PlayerRegistry(TracingDict):
+    """
+    The players that are connected to the login server by unique ID, with
+    indexes for looking players up by other members.
+
+    The indexes are kept up to date by observing the changes to the traced
+    members of the players, so players must not be modified through other
+    means than assigning their members.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.indexes = {name: {} for name in _INDEXES}
+        self.indexes_by_dependency = {}
+        for name, (dependencies, _) in _INDEXES.items():
+            for member_name in dependencies:
+                self.indexes_by_dependency.setdefault(member_name, []).append(name)
+        # The key under which each player is currently found in each index
+        self.player_keys = {}
+
+    def __setitem__(self, unique_id, player):
+        if unique_id in self:
+            self._remove_from_indexes(self[unique_id])
+        super().__setitem__(unique_id, player)
+        self._add_to_indexes(player)
+
+    def __delitem__(self, unique_id):
+        self._remove_from_indexes(self[unique_id])
+        super().__delitem__(unique_id)
+
+    def pop(self, unique_id, *args):
+        if unique_id in self:
+            self._remove_from_indexes(self[unique_id])
+        return super().pop(unique_id, *args)
+
+    def find_by_display_name(self, display_name):
+        """ Find a player by display name, ignoring case """
+        return self._find_first('display_name', display_name.casefold())
+
+    def find_by_login_name(self, login_name):
+        return self._find_first('login_name', login_name)
+
+    def find_by_game_server(self, game_server):
+        return self._find_all('game_server', game_server)
+
+    def find_by_team(self, game_server, team):
+        return self._find_all('team', (game_server, team))
+
+    def find_by_detected_ip(self, detected_ip):
+        return self._find_all('detected_ip', detected_ip)
+
+    def is_display_name_in_use(self, display_name):
+        return display_name.casefold() in self.indexes['display_name']
+
+    def find_players_by(self, **kwargs):
+        """ Find the players of which all the given members have the given values """
+        matching_players = None
+        for member_name, value in kwargs.items():
+            if member_name in _INDEXES_BY_MEMBER:
+                index_name, key_func = _INDEXES_BY_MEMBER[member_name]
+                matching_players = self._find_all(index_name, key_func(value))
+                break
+
+        if matching_players is None:
+            matching_players = self.values()
+        return [player for player in matching_players
+                if all(getattr(player, key) == val for key, val in kwargs.items())]
+
+    def _find_all(self, index_name, key):
+        return list(self.indexes[index_name].get(key, ()))
+
+    def _find_first(self, index_name, key):
+        players = self.indexes[index_name].get(key)
+        return next(iter(players)) if players else None
+
+    def _add_to_indexes(self, player):
+        self.player_keys[player] = {}
+        for index_name in _INDEXES:
+            self._index(player, index_name)
+        player._state_tracer.add_observer(self._player_changed)
+
+    def _remove_from_indexes(self, player):
+        player._state_tracer.remove_observer(self._player_changed)
+        for index_name in _INDEXES:
+            self._unindex(player, index_name)
+        del self.player_keys[player]
+
+    def _index(self, player, index_name):
+        key = _INDEXES[index_name][1](player)
+        if key is not None:
+            # A dict instead of a set, so that players are found in the order in which they were added
+            self.indexes[index_name].setdefault(key, {})[player] = None
+        self.player_keys[player][index_name] = key
+
+    def _unindex(self, player, index_name):
+        key = self.player_keys[player][index_name]
+        if key is not None:
+            players = self.indexes[index_name][key]
+            del players[player]
+            if not players:
+                del self.indexes[index_name][key]
+
+    def _player_changed(self, player, member_name, old_value, new_value):
+        for index_name in self.indexes_by_dependency.get(member_name, ()):
+            self._unindex(player, index_name)
+            self._index(player, index_name)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from common.datatypes import *
+
+# Address classes of players without an external address and of players
+# that do not share their external address with any game server
+ADDRESS_CLASS_LAN = 'lan'
+ADDRESS_CLASS_WAN = 'wan'
+
+
+class _CachedServerMessage:
+    def __init__(self, message, servers):
+        # Only the time remaining changes without the server changing state,
+        # so that is the only field that is filled in for every request.
+        self.time_remaining_slots = []
+        slot_fields = {}
+        for array, server in zip(message.findbytype(m00e9).arrays, servers):
+            slot_name = 'time_remaining_%d' % server.server_id
+            slot_fields[slot_name] = next(field for field in array if isinstance(field, m02f4))
+            self.time_remaining_slots.append((slot_name, server))
+        self.template = MessageTemplate(message, **slot_fields)
+
+    def render(self):
+        return self.template.render(**{slot_name: server.get_time_remaining()
+                                       for slot_name, server in self.time_remaining_slots})
+
+
+class ServerListCache:
+    """
+    Cache of the serialized server list (a00d5) and server info (a01c6)
+    messages that players request when they look at the server browser.
+
+    The cached messages must be invalidated whenever a game server changes
+    something that is shown in the server browser. Because the address of a
+    game server depends on the player that is looking at it, a message is
+    cached separately for each class of player address.
+    """
+
+    def __init__(self):
+        self.server_list_messages = {}
+        self.server_info_messages = {}
+        self.external_ips = None
+
+    def invalidate(self, game_server=None):
+        self.server_list_messages.clear()
+        self.external_ips = None
+        if game_server is None:
+            self.server_info_messages.clear()
+        else:
+            for key in [key for key in self.server_info_messages if key[0] == game_server.server_id]:
+                del self.server_info_messages[key]
+
+    def get_server_list(self, game_servers, player_address_pair):
+        address_class = self._get_address_class(game_servers, player_address_pair)
+        cached_message = self.server_list_messages.get(address_class)
+        if cached_message is None:
+            message = a00d5().setservers(game_servers, player_address_pair)
+            cached_message = _CachedServerMessage(message, [server for server in game_servers if server.joinable])
+            self.server_list_messages[address_class] = cached_message
+        return cached_message.render()
+
+    def get_server_info(self, game_server, players, game_servers, player_address_pair):
+        key = (game_server.server_id, self._get_address_class(game_servers, player_address_pair))
+        cached_message = self.server_info_messages.get(key)
+        if cached_message is None:
+            message = a01c6()
+            message.content = [
+                m02c7().set(game_server.server_id),
+                m0228().set(0x00000002),
+                m00e9().setservers([game_server], player_address_pair).setplayers(players)
+            ]
+            cached_message = _CachedServerMessage(message, [game_server])
+            self.server_info_messages[key] = cached_message
+        return cached_message.render()
+
+    def _get_address_class(self, game_servers, player_address_pair):
+        # A player sees the internal address of a game server if the player has no
+        # external address or shares it with the game server, so all players whose
+        # external address differs from that of every game server see the same addresses
+        if player_address_pair.external_ip is None:
+            return ADDRESS_CLASS_LAN
+
+        if self.external_ips is None:
+            self.external_ips = {server.address_pair.external_ip
+                                 for server in game_servers
+                                 if server.address_pair is not None}
+
+        if player_address_pair.external_ip in self.external_ips:
+            return player_address_pair.external_ip
+        else:
+            return ADDRESS_CLASS_WAN
@@ -32,20 +32,47 @@ from common.datatypes import *
 
 
 class SocialNetwork:
+    """
+    Keeps track of who is friends with whom and notifies players when the
+    presence of their friends and followers changes.
+
+    If a coalescing window is given, presence notifications are collected
+    for that many seconds. Then each receiver gets one notification per
+    sender with the sender's presence at that moment. Each notification is
+    sent as a message of its own, because the client only reads several
+    messages from one packet for the login reply.
+    """
+
+    def __init__(self, pending_callbacks=None, coalescing_window=0):
+        self.pending_callbacks = pending_callbacks
+        self.coalescing_window = coalescing_window
+        # Sender IDs by receiver ID of the presence notifications waiting to be sent
+        self.pending_notifications = {}
+        self.sent_notifications = 0
+        self.coalesced_notifications = 0
 
-    def __init__(self):
         self.players = {}
         self.player_names = {}
         self.player_states = collections.defaultdict(lambda: SOCIAL_BITMASK_OFFLINE)
         self.player_friends = collections.defaultdict(set)
+        # Reverse of player_friends: the players that have a player as their friend
+        self.player_followers = collections.defaultdict(set)
+        # Encoded a011c messages by player ID, removed when anything in them changes
+        self.friend_lists = {}
 
     def add_friend(self, player_id, friend_id):
         self.player_friends[player_id].add(friend_id)
+        self.player_followers[friend_id].add(player_id)
+        self._friend_list_changed(player_id)
+        self._friend_list_changed(friend_id)
         self._notify_specific_player(friend_id, player_id)
         self._notify_specific_player(player_id, friend_id)
 
     def remove_friend(self, player_id, friend_id):
         self.player_friends[player_id].remove(friend_id)
+        self.player_followers[friend_id].discard(player_id)
+        self._friend_list_changed(player_id)
+        self._friend_list_changed(friend_id)
         self._notify_specific_player(friend_id, player_id)
         self._notify_specific_player(player_id, friend_id)
 
@@ -54,27 +81,61 @@ class SocialNetwork:
 
         self.players[player.unique_id] = player
         self.player_states[player.unique_id] = SOCIAL_BITMASK_IN_LOBBY
-        self.player_names[player.unique_id] = player.login_name
-        self.player_names.update(friends)
-        self.player_friends[player.unique_id] = set(friends.keys())
+        self._set_name(player.unique_id, player.login_name)
+        for friend_id, friend_name in friends.items():
+            self._set_name(friend_id, friend_name)
+        self._set_friends(player.unique_id, set(friends.keys()))
+        self._presence_changed(player.unique_id)
 
         self._notify_followers_and_friends(player.unique_id, vice_versa=True)
 
     def notify_on_game_server(self, player):
         self.player_states[player.unique_id] = SOCIAL_BITMASK_IN_GAME
+        self._presence_changed(player.unique_id)
         self._notify_followers_and_friends(player.unique_id)
 
     def notify_offline(self, player):
         self.player_states[player.unique_id] = SOCIAL_BITMASK_OFFLINE
+        self._presence_changed(player.unique_id)
         self._notify_followers_and_friends(player.unique_id)
         del self.players[player.unique_id]
+        self.friend_lists.pop(player.unique_id, None)
+
+    def get_statistics(self):
+        return {
+            'sent_presence_notifications': self.sent_notifications,
+            'coalesced_presence_notifications': self.coalesced_notifications
+        }
+
+    def _set_friends(self, player_id, friend_ids):
+        old_friend_ids = self.player_friends[player_id]
+        for friend_id in old_friend_ids - friend_ids:
+            self.player_followers[friend_id].discard(player_id)
+            self._friend_list_changed(friend_id)
+        for friend_id in friend_ids - old_friend_ids:
+            self.player_followers[friend_id].add(player_id)
+            self._friend_list_changed(friend_id)
+        self.player_friends[player_id] = friend_ids
+        self._friend_list_changed(player_id)
+
+    def _set_name(self, player_id, name):
+        if self.player_names.get(player_id) != name:
+            self.player_names[player_id] = name
+            self._presence_changed(player_id)
+
+    def _presence_changed(self, player_id):
+        """ Forget the friend lists in which the player appears """
+        for other_player_id in self._get_followers(player_id) | self._get_friends(player_id):
+            self._friend_list_changed(other_player_id)
+
+    def _friend_list_changed(self, player_id):
+        self.friend_lists.pop(player_id, None)
 
     def _get_friends(self, player_id):
         return self.player_friends[player_id]
 
     def _get_followers(self, selected_player_id):
-        return {player_id for player_id, friends in
-                self.player_friends.items() if selected_player_id in friends}
+        return self.player_followers[selected_player_id]
 
     def _get_notification_type(self, sender_id, receiver_id):
         notification_type = self.player_states[sender_id]
@@ -89,23 +150,54 @@ class SocialNetwork:
         friends = self._get_friends(selected_player_id)
 
         for other_player_id in followers | friends:
-            self._notify_specific_player(selected_player_id, other_player_id)
+            self._queue_notification(selected_player_id, other_player_id)
             if vice_versa:
-                self._notify_specific_player(other_player_id, selected_player_id)
+                self._queue_notification(other_player_id, selected_player_id)
+
+    def _queue_notification(self, sender_id, receiver_id):
+        if not self.coalescing_window:
+            self._notify_specific_player(sender_id, receiver_id)
+            return
+
+        if not self.pending_notifications:
+            self.pending_callbacks.add(self, self.coalescing_window, self._send_pending_notifications)
+
+        senders = self.pending_notifications.setdefault(receiver_id, {})
+        if sender_id in senders:
+            self.coalesced_notifications += 1
+        senders[sender_id] = None
+
+    def _send_pending_notifications(self):
+        pending_notifications = self.pending_notifications
+        self.pending_notifications = {}
+        for receiver_id, sender_ids in pending_notifications.items():
+            receiver = self.players.get(receiver_id)
+            if receiver is not None:
+                for sender_id in sender_ids:
+                    receiver.send(self._create_notification(sender_id, receiver_id))
+                self.sent_notifications += len(sender_ids)
 
     def _notify_specific_player(self, sender_id, receiver_id):
         if receiver_id in self.players:
-            notification_type = self._get_notification_type(sender_id, receiver_id)
-
-            msg = a011b().set([
-                m034a().set(self.player_names[sender_id]),
-                m020d().set(sender_id),
-                m0296(),
-                m0591().set(notification_type)
-            ])
-            self.players[receiver_id].send(msg)
+            self.players[receiver_id].send(self._create_notification(sender_id, receiver_id))
+            self.sent_notifications += 1
+
+    def _create_notification(self, sender_id, receiver_id):
+        return a011b().set([
+            m034a().set(self.player_names[sender_id]),
+            m020d().set(sender_id),
+            m0296(),
+            m0591().set(self._get_notification_type(sender_id, receiver_id))
+        ])
 
     def send_friend_list(self, player_id):
+        msg = self.friend_lists.get(player_id)
+        if msg is None:
+            msg = encodedmessage.frommessage(self._create_friend_list(player_id))
+            self.friend_lists[player_id] = msg
+        self.players[player_id].send(msg)
+
+    def _create_friend_list(self, player_id):
         followers = self._get_followers(player_id)
         friends = self._get_friends(player_id)
 
@@ -118,9 +210,7 @@ class SocialNetwork:
                 m0591().set(self._get_notification_type(other_player_id, player_id)),
                 m0307()])
 
-        msg = a011c().set([
+        return a011c().set([
             m0348().set(player_id),
             m0116().set(friend_list)
         ])
-
-        self.players[player_id].send(msg)
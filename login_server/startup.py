@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import concurrent.futures
+import configparser
+import logging
+import os
+import sys
+
+from common.datatypes import load_original_capture, ORIGINAL_CAPTURE_PATH
+from common.logging import set_up_logging
+from common.migration_mechanism import run_migrations
+from common.ports import Ports
+from common.utils import SHARED_INI_PATH
+from .accounts import Accounts
+from .persistence import JsonFilePlayerStore, SqlitePlayerStore, WriteBehindWriter
+
+INI_PATH = os.path.join('data', 'loginserver.ini')
+PLAYER_DATA_DIRECTORY = os.path.join('data', 'players')
+PLAYER_DATABASE_PATH = os.path.join('data', 'players.db')
+
+
+def prepare_login_server(executor_class=concurrent.futures.ThreadPoolExecutor):
+    """
+    Set up logging, check the data files and read the configuration, which
+    is the same for every backend. Exits if anything is wrong.
+
+    Work that the accounts do in the background is run in an executor of
+    executor_class.
+
+    Returns the accounts, the configuration and the ports to use.
+    """
+    set_up_logging('login_server.log')
+    logger = logging.getLogger(__name__)
+
+    # Loading the accounts compacts their journal into accountdatabase.json,
+    # which the migrations read to find the registered players
+    accounts = Accounts('data/accountdatabase.json', executor_class)
+
+    # Perform data migrations on startup
+    try:
+        run_migrations('data')
+    except ValueError as e:
+        # If a migration failed, it will raise a ValueError
+        logger.fatal('Failed to run data migrations with format error: %s' % str(e))
+        sys.exit(2)
+    except OSError as e:
+        # If a migration failed, it will raise a ValueError
+        logger.fatal('Failed to run data migrations with OS error: %s' % str(e))
+        sys.exit(2)
+
+    # Map the capture that some messages are replayed from and check that all ranges used from it are valid
+    try:
+        load_original_capture()
+    except (ValueError, OSError) as e:
+        logger.fatal('Failed to load %s: %s' % (ORIGINAL_CAPTURE_PATH, str(e)))
+        sys.exit(2)
+
+    config = configparser.ConfigParser()
+    with open(INI_PATH) as f:
+        config.read_file(f)
+    with open(SHARED_INI_PATH) as f:
+        config.read_file(f)
+
+    ports = Ports(int(config['shared']['port_offset']))
+
+    return accounts, config, ports
+
+
+def get_login_server_options(config):
+    """ Returns the keyword arguments for LoginServer that come from the configuration """
+    loginserver_config = config['loginserver']
+    return {
+        'presence_coalescing_window': loginserver_config.getfloat('presence_coalescing_window', fallback=0.0),
+        'player_checkpoint_interval': loginserver_config.getfloat('player_checkpoint_interval', fallback=300.0)
+    }
+
+
+def create_player_data_writer(config, executor_class=concurrent.futures.ThreadPoolExecutor):
+    """ Returns the WriteBehindWriter for the player store that is configured. Exits if it is invalid. """
+    player_store = config['loginserver'].get('player_store', fallback='json')
+    if player_store == 'json':
+        return WriteBehindWriter(JsonFilePlayerStore(PLAYER_DATA_DIRECTORY), executor_class=executor_class)
+    elif player_store == 'sqlite':
+        # SQLite allows only one writer at a time anyway
+        return WriteBehindWriter(SqlitePlayerStore(PLAYER_DATABASE_PATH), worker_count=1,
+                                 executor_class=executor_class)
+    else:
+        logging.getLogger(__name__).fatal("Invalid player_store '%s' in %s, it must be json or sqlite" %
+                                          (player_store, INI_PATH))
+        sys.exit(2)
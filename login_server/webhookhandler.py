@@ -18,9 +18,9 @@
 # along with taserver.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import gevent
-import gevent.queue
 import logging
+import queue
+import time
 import urllib.error
 import urllib.request
 import urllib.parse
@@ -44,14 +44,15 @@ class WebhookHandler:
             if current_stats is None:
                 break
 
-            gevent.sleep(60)
+            # With gevent's monkey patching this does not block other greenlets
+            time.sleep(60)
 
             try:
                 current_stats = self.server_stats_queue.get_nowait()
                 if current_stats is None:
                     break
 
-            except gevent.queue.Empty:
+            except queue.Empty:
                 pass
 
             player_count = sum(gs_stats['nplayers'] for gs_stats in current_stats)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Simulates a chat storm on a full game server: every player sends chat
+# lines that are broadcast to all players on the server, after which the
+# writer of each player encodes and sends what is queued for it. This is
+# measured with each writer encoding the chat message itself, which is
+# how broadcasts were sent before, and with send_to_players, which
+# serializes each message once. Run from the root of the repository with:
+#
+#   python3 -m scripts.benchmark_chat_broadcast
+
+import argparse
+import logging
+import time
+
+import gevent.queue
+
+from common.datatypes import *
+from common.loginprotocol import LoginProtocolWriter
+from login_server.player.player import Player, send_to_players
+
+
+class DiscardingSocket:
+    """ A socket that accepts everything and remembers how much was sent """
+    def __init__(self):
+        self.sent_bytes = 0
+        self.sent_data = []
+        self.keep_data = False
+
+    def setsockopt(self, *args):
+        pass
+
+    def sendmsg(self, buffers):
+        size = sum(len(buffer) for buffer in buffers)
+        self.sent_bytes += size
+        if self.keep_data:
+            self.sent_data.append(b''.join(buffers))
+        return size
+
+
+def send_to_players_encoding_per_player(players, data):
+    for player in players:
+        player.send(data)
+
+
+def create_chat_message(sender_index, line_index):
+    return a0070().set([
+        m009e().set(MESSAGE_PUBLIC),
+        m02e6().set('chat line %d from player %d, with some more text to make it realistic' %
+                    (line_index, sender_index)),
+        m034a(),
+        m0574(),
+        m02fe().set('Player%d' % sender_index),
+        m06de().set('TAG')
+    ])
+
+
+def create_players(player_count):
+    players = []
+    for i in range(player_count):
+        player = Player(('127.0.0.1', 10000 + i))
+        player.unique_id = i + 1
+        player.outgoing_queue = gevent.queue.Queue()
+        player.last_received_seq = 0
+
+        writer = LoginProtocolWriter(DiscardingSocket(), dump_queue=None)
+        writer.outgoing_queue = player.outgoing_queue
+        # Start with a sequence number as if the player had already logged in
+        writer.seq = 0
+        players.append((player, writer))
+    return players
+
+
+def chat_storm(players, lines_per_player, broadcast_func):
+    """ Let every player send its chat lines and flush all writers after each round """
+    all_players = [player for player, _ in players]
+    for line_index in range(lines_per_player):
+        for sender_index in range(len(players)):
+            broadcast_func(all_players, create_chat_message(sender_index, line_index))
+        for _, writer in players:
+            writer.write_queued_messages()
+
+
+def measure(player_count, lines_per_player, broadcast_func, keep_data=False):
+    players = create_players(player_count)
+    for _, writer in players:
+        writer.sock.keep_data = keep_data
+
+    start_time = time.perf_counter()
+    chat_storm(players, lines_per_player, broadcast_func)
+    elapsed = time.perf_counter() - start_time
+
+    delivered = player_count * player_count * lines_per_player
+    sent_bytes = sum(writer.sock.sent_bytes for _, writer in players)
+    return delivered / elapsed, sent_bytes, [writer.sock.sent_data for _, writer in players]
+
+
+def main(args):
+    logging.disable(logging.WARNING)
+
+    # Both ways of broadcasting must put the same bytes on the wire
+    _, _, per_player_data = measure(args.players, 2, send_to_players_encoding_per_player, keep_data=True)
+    _, _, encoded_once_data = measure(args.players, 2, send_to_players, keep_data=True)
+    assert per_player_data == encoded_once_data
+
+    print('%-20s %18s %14s' % ('broadcast', 'deliveries/s', 'bytes sent'))
+    for name, broadcast_func in (('encode per player', send_to_players_encoding_per_player),
+                                 ('encode once', send_to_players)):
+        deliveries_per_second, sent_bytes, _ = measure(args.players, args.lines, broadcast_func)
+        print('%-20s %18d %14d' % (name, deliveries_per_second, sent_bytes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark broadcasting chat to all players on a game server')
+    parser.add_argument('-p', '--players', type=int, default=32,
+                        help='number of players on the game server')
+    parser.add_argument('-l', '--lines', type=int, default=50,
+                        help='number of chat lines sent by each player')
+    main(parser.parse_args())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Compares the memory use and latency of connections handled by a reader
+# and a writer greenlet with connections handled by a single greenlet. Run
+# from the root of the repository with:
+#
+#   python3 -m scripts.benchmark_connections
+#
+# The clients run in the same process as the server, so the memory figures
+# include the client side of each connection. That part is the same for both
+# ways of handling connections.
+
+import argparse
+import gc
+import os
+import statistics
+import struct
+import time
+import tracemalloc
+
+import gevent
+import gevent.queue
+import gevent.server
+from gevent import socket
+from greenlet import greenlet
+
+from common.connectionhandler import *
+
+
+class EchoMessage:
+    def __init__(self, data):
+        self.data = data
+
+
+class EchoReader(TcpMessageConnectionReader):
+    def decode(self, msg_bytes):
+        return EchoMessage(msg_bytes)
+
+
+class EchoWriter(TcpMessageConnectionWriter):
+    def encode(self, msg):
+        return msg
+
+
+class EchoPeer(Peer):
+    pass
+
+
+class EchoHandler(IncomingConnectionHandler):
+    def create_connection_instances(self, sock, address):
+        return EchoReader(sock), EchoWriter(sock), EchoPeer()
+
+
+class EchoServer:
+    def __init__(self, single_greenlet):
+        self.incoming_queue = gevent.queue.Queue()
+        self.handler = EchoHandler('echo', '127.0.0.1', 0, self.incoming_queue, single_greenlet = single_greenlet)
+        self.stream_server = gevent.server.StreamServer(('127.0.0.1', 0), self.handler._handle_and_catch,
+                                                        backlog = 1024)
+        self.connected_peers = 0
+        self.task = None
+
+    def start(self):
+        self.stream_server.start()
+        self.task = gevent.spawn(self.run)
+
+    def stop(self):
+        self.stream_server.stop()
+        self.task.kill()
+
+    def run(self):
+        while True:
+            msg = self.incoming_queue.get()
+            if isinstance(msg, PeerConnectedMessage):
+                self.connected_peers += 1
+            elif isinstance(msg, PeerDisconnectedMessage):
+                self.connected_peers -= 1
+                msg.peer.disconnect()
+            else:
+                msg.peer.send(msg.data)
+
+    def wait_for_peers(self, count):
+        while self.connected_peers != count:
+            gevent.sleep(0.01)
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def count_greenlets():
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, greenlet))
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError()
+        data += chunk
+    return data
+
+
+def measure(connection_count, single_greenlet, rounds, message_size):
+    server = EchoServer(single_greenlet)
+    server.start()
+    address = ('127.0.0.1', server.stream_server.server_port)
+
+    gc.collect()
+    greenlets_before = count_greenlets()
+    rss_before = rss_bytes()
+    tracemalloc.start()
+
+    clients = []
+    for i in range(connection_count):
+        clients.append(socket.create_connection(address))
+        if i % 100 == 99:
+            gevent.sleep(0)
+    server.wait_for_peers(connection_count)
+
+    gc.collect()
+    result = {
+        'greenlets': (count_greenlets() - greenlets_before) / connection_count,
+        'traced': tracemalloc.get_traced_memory()[0] / connection_count,
+        'rss': (rss_bytes() - rss_before) / connection_count if rss_before is not None else None,
+    }
+    # Tracing memory allocations slows everything down too much to measure latency
+    tracemalloc.stop()
+
+    # Every client sends a message and then the replies are collected
+    request = struct.pack('<H', message_size) + b'x' * message_size
+    latencies = []
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        round_start_time = time.perf_counter()
+        for client in clients:
+            client.sendall(request)
+        for client in clients:
+            recv_exactly(client, len(request))
+            latencies.append(time.perf_counter() - round_start_time)
+    total_time = time.perf_counter() - start_time
+
+    latencies.sort()
+    result['median'] = statistics.median(latencies)
+    result['p99'] = latencies[int(len(latencies) * 0.99)]
+    result['rate'] = len(latencies) / total_time
+
+    for client in clients:
+        client.close()
+    server.wait_for_peers(0)
+    server.stop()
+
+    # Give the greenlets of the connections time to finish, so that they
+    # do not affect the next measurement
+    gevent.sleep(0.5)
+    gc.collect()
+    return result
+
+
+def main(args):
+    print('%-12s %-15s %10s %14s %14s %12s %12s %12s' %
+          ('connections', 'handling', 'greenlets', 'traced (B)', 'rss (B)', 'median (ms)', 'p99 (ms)', 'msgs/s'))
+    for connection_count in args.connections:
+        for single_greenlet in (False, True):
+            result = measure(connection_count, single_greenlet, args.rounds, args.size)
+            rss = '%14d' % result['rss'] if result['rss'] is not None else '%14s' % 'n/a'
+            print('%-12d %-15s %10.1f %14d %s %12.2f %12.2f %12d' %
+                  (connection_count, 'single greenlet' if single_greenlet else 'reader+writer',
+                   result['greenlets'], result['traced'], rss,
+                   result['median'] * 1000, result['p99'] * 1000, result['rate']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark memory use and latency per connection')
+    parser.add_argument('-c', '--connections', type=int, nargs='+', default=[1000, 5000],
+                        help='numbers of simultaneous connections to measure with')
+    parser.add_argument('-r', '--rounds', type=int, default=5,
+                        help='number of times every connection sends a message and waits for the reply')
+    parser.add_argument('-s', '--size', type=int, default=100,
+                        help='size in bytes of the messages that are sent')
+    main(parser.parse_args())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures how fast the login protocol messages in common/datatypes.py can be
+# encoded and decoded. Run from the root of the repository with:
+#
+#   python3 -m scripts.benchmark_datatypes
+
+import argparse
+import io
+from ipaddress import IPv4Address
+import timeit
+
+from common.datatypes import *
+from common.game_items import get_unmodded_class_menu_data
+from login_server.player.loadouts import Loadouts
+from login_server.player.settings import PlayerSettings
+
+
+class ByteStream:
+    """ Minimal stand-in for the PacketReader that the login protocol reader uses """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, length):
+        requestedbytes = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return requestedbytes
+
+    def peek(self, length):
+        return self.data[self.pos:self.pos + length]
+
+    def at_end(self):
+        return self.pos >= len(self.data)
+
+
+class FakeAddressPair:
+    def __init__(self, ip):
+        self.ip = ip
+
+    def get_address_seen_from(self, other_address_pair):
+        return self.ip
+
+
+class FakeGameServer:
+    def __init__(self, server_id, nplayers):
+        self.server_id = server_id
+        self.match_id = server_id + 10000000
+        self.joinable = True
+        self.players = {unique_id: None for unique_id in range(nplayers)}
+        self.region = REGION_EUROPE
+        self.password_hash = None
+        self.game_setting_mode = 'ootb'
+        self.description = 'Benchmark server %d' % server_id
+        self.motd = 'Welcome to benchmark server %d' % server_id
+        self.map_id = 1456
+        self.be_score = 1
+        self.ds_score = 2
+        self.address_pair = FakeAddressPair(IPv4Address('10.0.0.%d' % (server_id % 250 + 1)))
+        self.port = 7777
+        self.pingport = 9002
+
+    def get_time_remaining(self):
+        return 1200
+
+
+class FakePlayer:
+    def __init__(self, unique_id):
+        self.unique_id = unique_id
+        self.display_name = 'player%d' % unique_id
+        self.team = unique_id % 2
+        self.player_settings = PlayerSettings()
+        self.loadouts = Loadouts('ootb')
+
+    def get_unmodded_loadouts(self):
+        return self.loadouts
+
+
+def encode(message):
+    stream = io.BytesIO()
+    if isinstance(message, list):
+        for el in message:
+            el.write(stream)
+    else:
+        message.write(stream)
+    return stream.getvalue()
+
+
+def decode(message_bytes, construct=construct_top_level_enumfield):
+    stream = ByteStream(message_bytes)
+    objs = []
+    while not stream.at_end():
+        objs.append(construct(stream))
+    return objs
+
+
+def decode_lazily(message_bytes):
+    return decode(message_bytes, construct_top_level_enumfield_lazily)
+
+
+def build_login_reply():
+    return [
+        a003d().set_menu_data(get_unmodded_class_menu_data()).set_player(FakePlayer(1)),
+        m0442().set_success(True),
+        m02fc().set(STDMSG_LOGIN_IS_VALID),
+        m0219(),
+        m0019(),
+        m0623(),
+        m05d6(),
+        m00ba()
+    ]
+
+
+def build_server_list(nservers):
+    servers = [FakeGameServer(server_id, 12) for server_id in range(1, nservers + 1)]
+    return a00d5().setservers(servers, FakeAddressPair(None))
+
+
+def build_menu_change(nrows):
+    return a006d().set([
+        m0144().set([[m0661().set(MENU_AREA_LIGHT_LOADOUT_A),
+                      m0369().set(1086),
+                      m0261().set(str(7385 + row))] for row in range(nrows)])
+    ])
+
+
+def time_per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main(args):
+    scenarios = [
+        ('login reply', build_login_reply),
+        ('server list (%d servers)' % args.servers, lambda: build_server_list(args.servers)),
+        ('menu change (%d rows)' % args.rows, lambda: build_menu_change(args.rows)),
+    ]
+
+    print('%-28s %10s %14s %14s %14s' % ('message', 'bytes', 'encode (us)', 'decode (us)', 'lazy (us)'))
+    for name, build in scenarios:
+        message = build()
+        message_bytes = encode(message)
+        for decode_func in (decode, decode_lazily):
+            if encode(decode_func(message_bytes)) != message_bytes:
+                raise RuntimeError('Decoding and re-encoding the %s did not reproduce the original bytes' % name)
+
+        encode_time = time_per_call(lambda: encode(message), args.number)
+        decode_time = time_per_call(lambda: decode(message_bytes), args.number)
+        lazy_decode_time = time_per_call(lambda: decode_lazily(message_bytes), args.number)
+        print('%-28s %10d %14.1f %14.1f %14.1f' % (name, len(message_bytes), encode_time * 1e6,
+                                                   decode_time * 1e6, lazy_decode_time * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark encoding and decoding of login protocol messages')
+    parser.add_argument('-n', '--number', type=int, default=200,
+                        help='number of times to encode/decode each message per measurement')
+    parser.add_argument('--servers', type=int, default=100,
+                        help='number of game servers in the server list message')
+    parser.add_argument('--rows', type=int, default=50,
+                        help='number of rows in the menu change message')
+    main(parser.parse_args())
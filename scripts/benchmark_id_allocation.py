@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Compares IdAllocator with searching the sorted numbers in use for the
+# lowest free one, which is how IDs were chosen before. Run from the root
+# of the repository with:
+#
+#   python3 -m scripts.benchmark_id_allocation
+
+import argparse
+import random
+import time
+
+from common.utils import IdAllocator
+
+
+def first_unused_number_above(numbers, minimum):
+    used_numbers = (n for n in numbers if n >= minimum)
+    return next(i for i, e in enumerate(sorted(used_numbers) + [None], start=minimum) if i != e)
+
+
+class SortingAllocator:
+    """ The previous way of choosing IDs, with the same interface as IdAllocator """
+    def __init__(self, minimum):
+        self.minimum = minimum
+        self.used_ids = set()
+
+    def allocate(self):
+        allocated_id = first_unused_number_above(self.used_ids, self.minimum)
+        self.used_ids.add(allocated_id)
+        return allocated_id
+
+    def release(self, used_id):
+        self.used_ids.discard(used_id)
+
+
+def measure(allocator, id_count, operations):
+    """ Fill the allocator with id_count IDs and then release and allocate random ones """
+    ids = [allocator.allocate() for _ in range(id_count)]
+
+    rng = random.Random(0)
+    start_time = time.perf_counter()
+    for _ in range(operations):
+        index = rng.randrange(id_count)
+        allocator.release(ids[index])
+        ids[index] = allocator.allocate()
+    return operations / (time.perf_counter() - start_time)
+
+
+def check_same_ids(id_count, operations):
+    """ Both ways of allocating must choose the same IDs """
+    new, old = IdAllocator(1), SortingAllocator(1)
+    rng = random.Random(1)
+    ids = []
+    for _ in range(operations):
+        if ids and rng.random() < 0.5:
+            released_id = ids.pop(rng.randrange(len(ids)))
+            new.release(released_id)
+            old.release(released_id)
+        elif len(ids) < id_count:
+            allocated_id = new.allocate()
+            assert allocated_id == old.allocate()
+            ids.append(allocated_id)
+
+
+def main(args):
+    check_same_ids(max(args.ids), 10000)
+
+    print('%-12s %-20s %16s' % ('ids in use', 'allocator', 'release+allocate/s'))
+    for id_count in args.ids:
+        for name, allocator in (('sorting', SortingAllocator(1)), ('IdAllocator', IdAllocator(1))):
+            print('%-12d %-20s %16d' % (id_count, name, measure(allocator, id_count, args.operations)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark allocating the lowest free ID')
+    parser.add_argument('-i', '--ids', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='numbers of IDs in use to measure with')
+    parser.add_argument('-n', '--operations', type=int, default=2000,
+                        help='number of times an ID is released and allocated again')
+    main(parser.parse_args())
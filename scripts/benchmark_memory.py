@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures how much memory the field objects of login protocol messages take
+# up while a message is built and encoded. Run from the root of the
+# repository with:
+#
+#   python3 -m scripts.benchmark_memory
+
+import argparse
+import tracemalloc
+
+from common.datatypes import *
+from scripts.benchmark_datatypes import build_login_reply, build_server_list, encode
+
+
+def count_fields(message):
+    if isinstance(message, list):
+        return sum(count_fields(el) for el in message)
+    elif isinstance(message, enumblockarray):
+        return 1 + sum(count_fields(el) for el in message.content)
+    elif isinstance(message, arrayofenumblockarrays) and message.arrays is not None:
+        return 1 + sum(count_fields(el) for arr in message.arrays for el in arr)
+    else:
+        return 1
+
+
+def measure(build):
+    # Build once first, so that lazily initialized module data is not counted
+    encode(build())
+
+    tracemalloc.start()
+    message = build()
+    allocated_by_message, _ = tracemalloc.get_traced_memory()
+    encode(message)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return count_fields(message), allocated_by_message, peak
+
+
+def main(args):
+    scenarios = [
+        ('login reply', build_login_reply),
+        ('server list (%d servers)' % args.servers, lambda: build_server_list(args.servers)),
+    ]
+
+    print('%-28s %8s %14s %14s %16s' % ('message', 'fields', 'message (kB)', 'peak (kB)', 'bytes per field'))
+    for name, build in scenarios:
+        nfields, allocated_by_message, peak = measure(build)
+        print('%-28s %8d %14.1f %14.1f %16.1f' % (name, nfields, allocated_by_message / 1024, peak / 1024,
+                                                   allocated_by_message / nfields))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the memory used by login protocol messages')
+    parser.add_argument('--servers', type=int, default=100,
+                        help='number of game servers in the server list message')
+    main(parser.parse_args())
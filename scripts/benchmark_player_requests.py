@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures how many requests per second go through Player.handle_request,
+# using the dispatch tables of the player states and, for comparison, the
+# lookup of handlers through inspect.getmembers that was used before. Run
+# from the root of the repository with:
+#
+#   python3 -m scripts.benchmark_player_requests
+
+import argparse
+import inspect
+import io
+import logging
+import time
+
+from common.datatypes import *
+from common.loginprotocol import PacketReader, StreamParser
+from login_server.player.player import Player
+from login_server.player.state.authenticated_state import AuthenticatedState
+
+
+class DiscardingQueue:
+    def put(self, item):
+        pass
+
+
+def handle_request_with_getmembers(state, request):
+    methods = [
+        func for name, func in inspect.getmembers(state) if
+        getattr(func, 'handles_packet', None) == type(request)
+    ]
+    methods[0](request)
+
+
+def create_region_ping(region, ping):
+    ping_field = m053d()
+    ping_field.value = ping
+    return [m0448().set(region), ping_field]
+
+
+def create_requests(count):
+    """ Create pings and keep-alives the way they come out of the login protocol reader """
+    stream = io.BytesIO()
+    for i in range(count):
+        if i % 2 == 0:
+            a01c8().set([
+                m068b().set([
+                    create_region_ping(region, 50 + region) for region in range(1, 6)
+                ])
+            ]).write(stream)
+        else:
+            a0033().write(stream)
+        stream.write(struct.pack('<LL', i, 0))
+
+    parser = StreamParser(PacketReader(iter([stream.getvalue()]).__next__), lazy=True)
+    return [parser.parse()[1][0] for _ in range(count)]
+
+
+def measure(player, requests, handle_func, duration):
+    handled = 0
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < duration:
+        for request in requests:
+            handle_func(request)
+        handled += len(requests)
+    return handled / (time.perf_counter() - start_time)
+
+
+def main(args):
+    logging.disable(logging.WARNING)
+
+    player = Player(('127.0.0.1', 7777))
+    player.outgoing_queue = DiscardingQueue()
+    player.state = AuthenticatedState(player)
+    requests = create_requests(args.requests)
+
+    # Decode the lazily parsed requests before measuring
+    for request in requests:
+        player.handle_request(request)
+
+    print('%-20s %14s' % ('dispatch', 'requests/s'))
+    print('%-20s %14d' % ('getmembers', measure(player, requests,
+                                                lambda request: handle_request_with_getmembers(player.state, request),
+                                                args.duration)))
+    print('%-20s %14d' % ('dispatch table', measure(player, requests, player.handle_request, args.duration)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the dispatching of requests to player state handlers')
+    parser.add_argument('-n', '--requests', type=int, default=1000,
+                        help='number of different requests to cycle through')
+    parser.add_argument('-d', '--duration', type=float, default=2.0,
+                        help='number of seconds to measure each way of dispatching')
+    main(parser.parse_args())
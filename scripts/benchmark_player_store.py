@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures how long it takes to read all data of a player at login and to
+# write it at logout with the json and the sqlite player store, with a
+# number of registered players already in the store. The stores are filled
+# in a temporary directory (by default in /tmp, see --directory), which
+# takes a while for the json store. Run from the root of the repository with:
+#
+#   python3 -m scripts.benchmark_player_store
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from login_server.persistence import JsonFilePlayerStore, SqlitePlayerStore
+from login_server.player.player import Player
+
+
+def create_player_items():
+    """ The serialized data of a player with default loadouts, a few friends and some XP """
+    player = Player(('127.0.0.1', 7777))
+    for unique_id in range(5):
+        player.friends.friends_dict[unique_id + 1] = {'login_name': 'friend%d' % unique_id}
+    player.player_settings.clan_tag = 'TAG'
+    player.player_settings.earn_xp(3600, True)
+    return {datastore_name: datastore.serialize() for datastore_name, datastore in player.get_datastores().items()}
+
+
+def fill_json_store(store, login_names, items):
+    for login_name in login_names:
+        for datastore_name, data in items.items():
+            # Without fsync, otherwise filling takes very long
+            with open(store.get_filename(login_name, datastore_name), 'wt') as outfile:
+                outfile.write(data)
+
+
+def fill_sqlite_store(store, login_names, items):
+    store.write_many((login_name, datastore_name, data)
+                     for login_name in login_names
+                     for datastore_name, data in items.items())
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def measure(func, login_names):
+    durations = []
+    for login_name in login_names:
+        start_time = time.perf_counter()
+        func(login_name)
+        durations.append(time.perf_counter() - start_time)
+    durations.sort()
+    return (sum(durations) / len(durations) * 1000,
+            percentile(durations, 0.5) * 1000,
+            percentile(durations, 0.99) * 1000)
+
+
+def main(args):
+    logging.disable(logging.WARNING)
+    items = create_player_items()
+    login_names = ['player%d' % i for i in range(args.players)]
+    rng = random.Random(0)
+    sample = rng.sample(login_names, min(args.samples, len(login_names)))
+    # Every datastore of the player changed during the session
+    changed_items = dict(items)
+
+    print('%d players, %d bytes of data per player in %d datastores' %
+          (args.players, sum(len(data) for data in items.values()), len(items)))
+    print('%-8s %-14s %12s %12s %12s %14s' % ('store', 'operation', 'mean (ms)', 'p50 (ms)', 'p99 (ms)', 'fill time (s)'))
+
+    for store_name in ('json', 'sqlite'):
+        directory = tempfile.mkdtemp(prefix='benchmark_player_store_', dir=args.directory)
+        try:
+            start_time = time.perf_counter()
+            if store_name == 'json':
+                store = JsonFilePlayerStore(directory)
+                fill_json_store(store, login_names, items)
+            else:
+                store = SqlitePlayerStore(os.path.join(directory, 'players.db'))
+                fill_sqlite_store(store, login_names, items)
+            fill_time = time.perf_counter() - start_time
+
+            results = [
+                ('login load', measure(lambda login_name: store.read(login_name, items), sample)),
+                ('logout save', measure(lambda login_name: store.write(login_name, changed_items), sample)),
+            ]
+            for operation, (mean, p50, p99) in results:
+                print('%-8s %-14s %12.3f %12.3f %12.3f %14.1f' % (store_name, operation, mean, p50, p99, fill_time))
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the login and logout latency of the player stores')
+    parser.add_argument('-p', '--players', type=int, default=50000,
+                        help='number of registered players in the store')
+    parser.add_argument('-s', '--samples', type=int, default=1000,
+                        help='number of players to load and save')
+    parser.add_argument('-d', '--directory', default=None,
+                        help='directory to create the stores in')
+    main(parser.parse_args())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures the CPU time spent per purchase menu (a0177) request when the
+# menus are built for every request (as the login server used to do) and
+# when the menus that were serialized on first use are sent. Run from the
+# root of the repository with:
+#
+#   python3 -m scripts.benchmark_purchase_menu
+
+import argparse
+import io
+import time
+
+from common.game_items import get_class_menu_data, get_game_setting_modes
+from login_server.player.state.authenticated_state import create_purchase_menu_fragments, get_purchase_menu_fragments
+
+
+def send(message):
+    stream = io.BytesIO()
+    message.write(stream)
+    return stream.getvalue()
+
+
+def cpu_time_per_request(handle_request, menu_parts, number):
+    start = time.process_time()
+    for _ in range(number):
+        for menu_part in menu_parts:
+            handle_request(menu_part)
+    return (time.process_time() - start) / (number * len(menu_parts))
+
+
+def main(args):
+    print('%-6s %-8s %12s %12s %10s' % ('mode', 'menu', 'before (us)', 'after (us)', 'bytes'))
+    for game_setting_mode in get_game_setting_modes():
+        class_menu_data = get_class_menu_data(game_setting_mode)
+        menu_parts = sorted(create_purchase_menu_fragments(class_menu_data).keys())
+
+        def handle_request_before(menu_part):
+            return send(create_purchase_menu_fragments(class_menu_data)[menu_part])
+
+        def handle_request_after(menu_part):
+            return send(get_purchase_menu_fragments(game_setting_mode)[menu_part])
+
+        for menu_part in menu_parts:
+            if handle_request_before(menu_part) != handle_request_after(menu_part):
+                raise RuntimeError('Precomputed menu %04X for mode %s differs from the built one' %
+                                   (menu_part, game_setting_mode))
+
+        for menu_part in menu_parts:
+            before = cpu_time_per_request(handle_request_before, [menu_part], args.number)
+            after = cpu_time_per_request(handle_request_after, [menu_part], args.number)
+            print('%-6s %-8s %12.1f %12.1f %10d' % (game_setting_mode, '%04X' % menu_part,
+                                                    before * 1e6, after * 1e6,
+                                                    len(handle_request_after(menu_part))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the handling of purchase menu requests')
+    parser.add_argument('-n', '--number', type=int, default=100,
+                        help='number of requests per measurement')
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019  Maurice van der Pot <griffon26@kfk4ever.com>
+#
+# This file is part of taserver
+#
+# taserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# taserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with taserver.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Copies the loadouts, friends and settings of all players from the JSON
+# files in data/players into the SQLite database of the sqlite player store
+# (import) or the other way around (export). Stop the login server before
+# running this from the root of the repository with for example:
+#
+#   python3 -m scripts.convert_player_data import
+
+import argparse
+import json
+import os
+
+from login_server.persistence import JsonFilePlayerStore, SqlitePlayerStore
+from login_server.player.player import get_datastore_names
+from login_server.startup import PLAYER_DATA_DIRECTORY, PLAYER_DATABASE_PATH
+
+
+def find_json_records(directory):
+    """ Yield a (login name, datastore name, data) record for each JSON file of a player in directory """
+    # Longest names first, so that a name that ends with another name is matched correctly
+    datastore_names = sorted(get_datastore_names(), key=len, reverse=True)
+    for filename in sorted(os.listdir(directory)):
+        base_name, extension = os.path.splitext(filename)
+        if extension != '.json':
+            continue
+        for datastore_name in datastore_names:
+            suffix = '_' + datastore_name
+            if base_name.endswith(suffix) and len(base_name) > len(suffix):
+                with open(os.path.join(directory, filename), 'rt') as infile:
+                    # Parsing the data checks it and stores it in the same format as the login server does
+                    data = json.dumps(json.load(infile), indent=4, sort_keys=True)
+                yield base_name[:-len(suffix)], datastore_name, data
+                break
+        else:
+            print('Skipping %s, which is not the data of a player' % filename)
+
+
+def import_json(directory, database):
+    records = list(find_json_records(directory))
+    store = SqlitePlayerStore(database)
+    store.write_many(records)
+    store.close()
+    print('Imported %d datastores of %d players into %s' %
+          (len(records), len({login_name for login_name, _, _ in records}), database))
+
+
+def export_json(directory, database):
+    store = SqlitePlayerStore(database)
+    json_store = JsonFilePlayerStore(directory)
+    count = 0
+    for login_name, datastore_name, data in store.read_all():
+        json_store.write(login_name, {datastore_name: data})
+        count += 1
+    store.close()
+    print('Exported %d datastores from %s to %s' % (count, database, directory))
+
+
+def main(args):
+    if args.action == 'import':
+        import_json(args.directory, args.database)
+    else:
+        os.makedirs(args.directory, exist_ok=True)
+        export_json(args.directory, args.database)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert player data between JSON files and an SQLite database')
+    parser.add_argument('action', choices=['import', 'export'],
+                        help='import the JSON files into the database or export the database to JSON files')
+    parser.add_argument('--directory', default=PLAYER_DATA_DIRECTORY,
+                        help='directory with the JSON files of the players')
+    parser.add_argument('--database', default=PLAYER_DATABASE_PATH,
+                        help='SQLite database of the sqlite player store')
+    main(parser.parse_args())